@@ -7,6 +7,10 @@ from collections import defaultdict
 import numpy as np
 from tqdm import tqdm
 
+from encode_state import read_manifest
+from phrase_columns import ColumnsWriter, is_columnar
+from stage_stats import StageStats
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -14,9 +18,24 @@ def main():
     )
     parser.add_argument("--meta", required=True, help="bge_m3_meta.tsv")
     parser.add_argument("--clusters", required=True, help="cluster_ids.txt")
-    parser.add_argument("--out", required=True, help="Output CSV/TSV with aggregated clusters.")
+    parser.add_argument(
+        "--emb",
+        help=(
+            "bge_m3_embeddings.dat the clusters were built from (default: next to --meta); "
+            "its manifest row count is checked against --clusters."
+        ),
+    )
+    parser.add_argument(
+        "--out",
+        required=True,
+        help=(
+            "Output TSV with aggregated clusters, or a *.cols directory "
+            "(representative as phrase, cluster_id/cluster_freq/cluster_size columns)."
+        ),
+    )
     parser.add_argument("--progress-interval", type=int, default=500000)
     args = parser.parse_args()
+    stats = StageStats("aggregate_clusters", input=args.meta, clusters=args.clusters)
 
     meta_path = Path(args.meta)
     cl_path = Path(args.clusters)
@@ -26,6 +45,18 @@ def main():
     n = len(cluster_ids)
     print(f"[info] total phrases: {n:,}", file=sys.stderr)
 
+    # число строк — из манифеста энкодера, а не по длине файлов
+    emb_path = Path(args.emb) if args.emb else meta_path.with_name("bge_m3_embeddings.dat")
+    try:
+        manifest = read_manifest(emb_path) if emb_path.exists() else None
+    except ValueError as e:
+        sys.exit(f"[error] {e}")
+    if manifest is not None and manifest["rows"] != n:
+        sys.exit(
+            f"[error] {cl_path} has {n:,} cluster ids, but {emb_path} holds "
+            f"{manifest['rows']:,} embeddings; re-run clustering"
+        )
+
     clusters = defaultdict(list)
 
     print("[info] reading metadata and grouping...", file=sys.stderr)
@@ -43,10 +74,22 @@ def main():
             clusters[cid].append((phrase, freq, length))
 
     print("[info] computing representatives...", file=sys.stderr)
+    stats.info["lines_in"] = n
 
     out_path = Path(args.out)
-    with out_path.open("w", encoding="utf-8") as fout:
-        fout.write("cluster_id\tcluster_freq\tcluster_size\trepresentative\n")
+    columnar = is_columnar(args.out)
+    if columnar:
+        fout = ColumnsWriter(
+            args.out,
+            {"cluster_id": "int64", "cluster_freq": "int64", "cluster_size": "int64"},
+            stats,
+        )
+    else:
+        fout = out_path.open("w", encoding="utf-8")
+
+    with fout:
+        if not columnar:
+            fout.write("cluster_id\tcluster_freq\tcluster_size\trepresentative\n")
 
         for cid, items in clusters.items():
             # cluster frequency
@@ -62,7 +105,14 @@ def main():
             )
             rep_phrase = items_sorted[0][0]
 
-            fout.write(f"{cid}\t{total_freq}\t{size}\t{rep_phrase}\n")
+            if columnar:
+                fout.write(rep_phrase, int(cid), total_freq, size)
+            else:
+                fout.write(f"{cid}\t{total_freq}\t{size}\t{rep_phrase}\n")
+                stats.add(rep_phrase, total_freq)
+
+    if not columnar:
+        stats.write(args.out)
 
     print(f"[done] written: {out_path}")
 
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from bge_backends import CPU_BACKENDS, autocast_context, load_model, set_cpu_threads
+from encode_bge_m3 import encode_buffer, iter_phrase_freqs
+from encode_state import open_embeddings
+
+
+def read_sample(path: Path, sample: int, seed: int) -> List[str]:
+    """
+    Случайная (детерминированная по seed) выборка фраз из входа энкодера.
+    """
+    phrases = [item[0] for item in iter_phrase_freqs(path) if item is not None]
+    if sample > 0 and sample < len(phrases):
+        rng = np.random.default_rng(seed)
+        idx = np.sort(rng.choice(len(phrases), size=sample, replace=False))
+        phrases = [phrases[i] for i in idx.tolist()]
+    return phrases
+
+
+def read_reference(ref_dir: Path, sample: int, seed: int) -> Tuple[List[str], List[int]]:
+    """
+    Выборка строк bge_m3_meta.tsv готового GPU-прогона encode_bge_m3.py:
+    (фразы, номера строк в bge_m3_embeddings.dat).
+    """
+    rows, phrases = [], []
+    with (ref_dir / "bge_m3_meta.tsv").open("r", encoding="utf-8") as f:
+        for line in f:
+            row, phrase, _ = line.rstrip("\n").split("\t", 2)
+            rows.append(int(row))
+            phrases.append(phrase)
+    if sample > 0 and sample < len(rows):
+        rng = np.random.default_rng(seed)
+        idx = np.sort(rng.choice(len(rows), size=sample, replace=False))
+        rows = [rows[i] for i in idx.tolist()]
+        phrases = [phrases[i] for i in idx.tolist()]
+    return phrases, rows
+
+
+def reference_vectors(ref_dir: Path, rows: List[int], dim: int) -> np.ndarray:
+    """
+    fp16-векторы строк rows; форма — из манифеста эталонного прогона
+    (для старых прогонов без манифеста — по размеру файла и dim модели).
+    """
+    try:
+        emb = open_embeddings(ref_dir / "bge_m3_embeddings.dat", dim)
+    except ValueError as e:
+        sys.exit(f"[error] {e}")
+    return np.asarray(emb[rows])
+
+
+def encode_timed(model, phrases: List[str], device: str, args) -> Tuple[np.ndarray, float]:
+    """
+    Кодирует выборку тем же путём, что и энкодер (буфер с сортировкой по длине),
+    после одного прогревочного батча. Возвращает (векторы fp16, секунды).
+    """
+    with autocast_context(device):
+        encode_buffer(model, phrases[: args.batch_size], args, [0, 0], device)
+        t0 = time.perf_counter()
+        vectors = []
+        for start in range(0, len(phrases), args.lookahead or args.batch_size):
+            chunk = phrases[start:start + (args.lookahead or args.batch_size)]
+            vectors.append(encode_buffer(model, chunk, args, [0, 0], device))
+        secs = time.perf_counter() - t0
+    return np.concatenate(vectors), secs
+
+
+def cosine_report(name: str, vectors: np.ndarray, ref: np.ndarray, secs: float) -> None:
+    a = vectors.astype(np.float32)
+    b = ref.astype(np.float32)
+    # векторы нормированы энкодером, но fp16 и квантизация дают небольшой дрейф нормы
+    cos = (a * b).sum(1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    print(
+        f"{name:<12} {len(a) / secs:>10,.1f} phr/s   "
+        f"cos mean={cos.mean():.5f} p1={np.quantile(cos, 0.01):.5f} "
+        f"min={cos.min():.5f} >=0.99: {(cos >= 0.99).mean():.2%}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Бенчмарк CPU-бэкендов BGE-M3: фраз/с и косинусная близость "
+            "к эталонным fp16-векторам (GPU) на выборке."
+        )
+    )
+    parser.add_argument(
+        "-i", "--input",
+        help="Вход энкодера (phrase<TAB>count или *.cols); эталон считается на GPU.",
+    )
+    parser.add_argument(
+        "--ref-dir",
+        help="Каталог готового GPU-прогона encode_bge_m3.py; эталон берётся из него.",
+    )
+    parser.add_argument("--sample", type=int, default=2000, help="Размер выборки фраз.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--backends",
+        default=",".join(CPU_BACKENDS),
+        help=f"CPU-бэкенды через запятую (из {', '.join(CPU_BACKENDS)}).",
+    )
+    parser.add_argument("--intra-op-threads", type=int, default=0)
+    parser.add_argument("--inter-op-threads", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--lookahead", type=int, default=2048)
+    parser.add_argument("--token-budget", type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.input and not args.ref_dir:
+        parser.error("нужен --input или --ref-dir")
+
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    for b in backends:
+        if b not in CPU_BACKENDS:
+            parser.error(f"неизвестный бэкенд {b!r}")
+
+    # один раз на весь прогон: число inter-op потоков torch можно задать только
+    # до первой параллельной операции, то есть до эталона и до первого бэкенда
+    set_cpu_threads(args.intra_op_threads, args.inter_op_threads)
+
+    if args.ref_dir:
+        phrases, rows = read_reference(Path(args.ref_dir), args.sample, args.seed)
+        ref = None
+    else:
+        phrases = read_sample(Path(args.input), args.sample, args.seed)
+        print(f"[info] computing fp16 reference on cuda for {len(phrases):,} phrases", file=sys.stderr)
+        model = load_model("cuda")
+        ref, secs = encode_timed(model, phrases, "cuda", args)
+        del model
+    print(f"[info] sample: {len(phrases):,} phrases", file=sys.stderr)
+
+    print(f"\n{'backend':<12} {'speed':>17}   agreement with fp16 reference")
+    if ref is not None:
+        cosine_report("cuda-fp16", ref, ref, secs)
+
+    for backend in backends:
+        try:
+            t0 = time.perf_counter()
+            model = load_model("cpu", backend, args.intra_op_threads, args.inter_op_threads)
+            load_secs = time.perf_counter() - t0
+        except RuntimeError as e:
+            print(f"[warn] {backend}: {e}", file=sys.stderr)
+            continue
+        if ref is None:
+            ref = reference_vectors(
+                Path(args.ref_dir), rows, model.get_sentence_embedding_dimension()
+            )
+        print(f"[info] {backend}: loaded in {load_secs:.1f}s", file=sys.stderr)
+        vectors, secs = encode_timed(model, phrases, "cpu", args)
+        cosine_report(backend, vectors, ref, secs)
+        del model
+
+
+if __name__ == "__main__":
+    main()
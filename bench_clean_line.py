@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import time
+from typing import Callable, List
+
+from clean_phrases_step1 import URL_RE, BRACKETS_RE, clean_line
+
+
+def clean_line_reference(line: str, min_words: int, max_words: int) -> str | None:
+    """
+    Эталон: исходная посимвольная реализация clean_line.
+    С ней сверяется быстрая версия из clean_phrases_step1.py.
+    """
+    line = URL_RE.sub(" ", line)
+    line = BRACKETS_RE.sub(" ", line)
+
+    line = line.strip().lower()
+    if not line:
+        return None
+
+    chars = []
+    for ch in line:
+        if ch.isalpha():
+            chars.append(ch)
+        else:
+            chars.append(" ")
+    cleaned = "".join(chars)
+
+    tokens = cleaned.split()
+    n = len(tokens)
+    if min_words <= n <= max_words:
+        return " ".join(tokens)
+    return None
+
+
+def read_sample(path: str, max_lines: int) -> List[str]:
+    lines: List[str] = []
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            lines.append(line)
+            if max_lines > 0 and len(lines) >= max_lines:
+                break
+    return lines
+
+
+def run(fn: Callable, lines: List[str], min_words: int, max_words: int, repeat: int):
+    """
+    Прогоняет fn по всем строкам repeat раз, возвращает (результат, лучшее время).
+    """
+    best = float("inf")
+    out = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = [fn(line, min_words, max_words) for line in lines]
+        best = min(best, time.perf_counter() - t0)
+    return out, best
+
+
+def unicode_sweep() -> int:
+    """
+    Проверяет каждый символ Unicode в нескольких контекстах
+    (внутри слова, отдельно, рядом с тегом и URL). Возвращает число расхождений.
+    """
+    templates = ("ab{}cd ef", "ab {} cd", "{}", "(x{}) w{}w.a", "www.{} a b")
+    diffs = 0
+    for cp in range(sys.maxunicode + 1):
+        ch = chr(cp)
+        for tpl in templates:
+            s = tpl.format(ch, ch)
+            if clean_line(s, 0, 99) != clean_line_reference(s, 0, 99):
+                if diffs < 10:
+                    print(f"[diff] U+{cp:04X} in {tpl!r}", file=sys.stderr)
+                diffs += 1
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Микробенчмарк clean_line и проверка побайтового совпадения "
+            "с эталонной посимвольной реализацией."
+        )
+    )
+    parser.add_argument(
+        "-i", "--input",
+        required=True,
+        help="Образец корпуса (одна фраза на строку).",
+    )
+    parser.add_argument(
+        "--max-lines",
+        type=int,
+        default=1_000_000,
+        help="Сколько строк образца взять (0 = все). По умолчанию 1000000.",
+    )
+    parser.add_argument("--min-words", type=int, default=2)
+    parser.add_argument("--max-words", type=int, default=6)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Число повторов замера, берётся лучшее время. По умолчанию 3.",
+    )
+    parser.add_argument(
+        "--unicode-sweep",
+        action="store_true",
+        help="Дополнительно сверить обе реализации на всех символах Unicode.",
+    )
+    args = parser.parse_args()
+
+    lines = read_sample(args.input, args.max_lines)
+    print(f"[info] sample: {len(lines):,} lines from {args.input}", file=sys.stderr)
+
+    ref_out, ref_t = run(clean_line_reference, lines, args.min_words, args.max_words, args.repeat)
+    new_out, new_t = run(clean_line, lines, args.min_words, args.max_words, args.repeat)
+
+    mismatches = 0
+    for line, a, b in zip(lines, ref_out, new_out):
+        if a != b:
+            if mismatches < 10:
+                print(f"[diff] {line!r}: {a!r} != {b!r}", file=sys.stderr)
+            mismatches += 1
+
+    print(f"reference : {ref_t:.3f} s ({len(lines) / ref_t:,.0f} lines/s)")
+    print(f"clean_line: {new_t:.3f} s ({len(lines) / new_t:,.0f} lines/s)")
+    print(f"speedup   : {ref_t / new_t:.2f}x")
+    print(f"mismatches: {mismatches:,}")
+
+    if args.unicode_sweep:
+        diffs = unicode_sweep()
+        print(f"unicode sweep mismatches: {diffs:,}")
+        mismatches += diffs
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
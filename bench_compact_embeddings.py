@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from cluster_leader_faiss import add_rows, leader_cluster, new_index
+from compact_embeddings import CompactEmbeddings, build_compact, compact_path, parse_kind
+from encode_state import open_embeddings
+
+
+def pair_count(sizes: np.ndarray) -> int:
+    sizes = sizes.astype(np.int64)
+    return int((sizes * (sizes - 1) // 2).sum())
+
+
+def agreement(ref: np.ndarray, other: np.ndarray) -> dict:
+    """
+    Сравнение двух разбиений одних и тех же строк по парам:
+    пара «в одном кластере» в эталоне и/или в сравниваемом.
+    """
+    n = len(ref)
+    _, ref_sizes = np.unique(ref, return_counts=True)
+    _, other_sizes = np.unique(other, return_counts=True)
+    # таблица сопряжённости: (кластер эталона, кластер сравниваемого) -> число строк
+    joint = ref.astype(np.int64) * (int(other.max()) + 1) + other
+    joint_keys, joint_sizes = np.unique(joint, return_counts=True)
+
+    both = pair_count(joint_sizes)
+    in_ref = pair_count(ref_sizes)
+    in_other = pair_count(other_sizes)
+    total = n * (n - 1) // 2
+    expected = in_ref * in_other / total if total else 0.0
+    max_index = (in_ref + in_other) / 2
+    ari = (both - expected) / (max_index - expected) if max_index != expected else 1.0
+
+    # строки, чей кластер совпал целиком (тот же набор строк)
+    ref_of = joint_keys // (int(other.max()) + 1)
+    other_of = joint_keys % (int(other.max()) + 1)
+    same = (joint_sizes == np.bincount(ref, minlength=ref.max() + 1)[ref_of]) & (
+        joint_sizes == np.bincount(other, minlength=other.max() + 1)[other_of]
+    )
+
+    return {
+        "clusters": len(other_sizes),
+        "precision": both / in_other if in_other else 1.0,
+        "recall": both / in_ref if in_ref else 1.0,
+        "ari": ari,
+        "same_cluster": joint_sizes[same].sum() / n if n else 1.0,
+    }
+
+
+def cluster(src, idx: np.ndarray, vectors: np.ndarray, k: int, threshold: float):
+    """
+    Кластеризация строк idx как в cluster_leader_faiss.py: индекс того же
+    типа, что для src (для int8 / pq — над 8-битными кодами), запросы — vectors.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index, dequantize = new_index(src)
+    if dequantize:
+        stored = np.ascontiguousarray(src.dequantize(idx), dtype=np.float32)
+        add_rows(index, stored)
+        norms = np.linalg.norm(stored, axis=1)
+    else:
+        add_rows(index, vectors)
+        norms = None
+    cluster_id, _ = leader_cluster(index, vectors, k, threshold, norms=norms)
+    return cluster_id
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Насколько кластеризация по компактным векторам (int8, trunc<K>, pca<K>, pq<M>) "
+            "расходится с кластеризацией по fp16 при том же пороге: leader-кластеризация "
+            "cluster_leader_faiss.py на случайной выборке строк."
+        )
+    )
+    parser.add_argument("--emb", required=True, help="bge_m3_embeddings.dat (эталон fp16).")
+    parser.add_argument(
+        "--kinds",
+        default="int8,pca256,pq64",
+        help="Компактные формы через запятую; недостающие строятся compact_embeddings.py.",
+    )
+    parser.add_argument("--sample", type=int, default=200_000, help="Строк в выборке (0 = все).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--k", type=int, default=32)
+    parser.add_argument("--threshold", type=float, default=0.92)
+    args = parser.parse_args()
+
+    emb_path = Path(args.emb)
+    emb = open_embeddings(emb_path)
+    n, dim = emb.shape
+
+    # выборка в исходном порядке строк: leader-кластеризация зависит от порядка
+    if 0 < args.sample < n:
+        rng = np.random.default_rng(args.seed)
+        idx = np.sort(rng.choice(n, size=args.sample, replace=False))
+    else:
+        idx = np.arange(n)
+    ref_vectors = np.asarray(emb[idx], dtype=np.float32)
+    print(f"[info] reference: fp16 on {len(idx):,} of {n:,} rows", file=sys.stderr)
+    ref = cluster(emb, idx, ref_vectors, args.k, args.threshold)
+
+    rows = [("fp16", dim * 2, agreement(ref, ref), 1.0)]
+    for kind in [k.strip() for k in args.kinds.split(",") if k.strip()]:
+        parse_kind(kind)
+        path = compact_path(emb_path, kind)
+        if not (path / "manifest.json").is_file():
+            build_compact(emb_path, kind)
+        compact = CompactEmbeddings(path)
+        vectors = compact.take(idx)
+        # косинус к эталону имеет смысл только без смены пространства
+        cos = float((vectors * ref_vectors).sum(1).mean()) if vectors.shape[1] == dim else None
+        print(f"[info] clustering {kind}...", file=sys.stderr)
+        row_bytes = compact.codes.dtype.itemsize * compact.codes.shape[1]
+        ids = cluster(compact, idx, vectors, args.k, args.threshold)
+        rows.append((kind, row_bytes, agreement(ref, ids), cos))
+
+    print(f"\nthreshold {args.threshold}, k {args.k}, {len(idx):,} rows")
+    print(
+        f"{'form':<10} {'bytes/row':>9} {'clusters':>10} {'pair prec':>9} "
+        f"{'pair rec':>9} {'ARI':>7} {'same clus':>9} {'cos':>7}"
+    )
+    for kind, row_bytes, a, cos in rows:
+        cos_str = f"{cos:.4f}" if cos is not None else "-"
+        print(
+            f"{kind:<10} {row_bytes:>9,} {a['clusters']:>10,} {a['precision']:>9.4f} "
+            f"{a['recall']:>9.4f} {a['ari']:>7.4f} {a['same_cluster']:>9.2%} {cos_str:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from itertools import islice
+
+from phrase_keys import PhraseTable, WordVocab
+
+
+def measure(build):
+    """
+    Запускает build() под tracemalloc, возвращает (результат, байты, секунды).
+    Учитывается и память numpy-массивов.
+    """
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - t0
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Сравнение памяти: Counter со строковыми ключами против "
+            "компактной таблицы phrase_keys (id слов в массивах numpy)."
+        )
+    )
+    parser.add_argument(
+        "-i", "--input",
+        required=True,
+        help="Файл очищенных фраз (выход шага 1), по одной фразе на строку.",
+    )
+    parser.add_argument(
+        "--max-lines",
+        type=int,
+        default=5_000_000,
+        help="Сколько строк взять (0 = все). По умолчанию 5000000.",
+    )
+    parser.add_argument("--max-words", type=int, default=6)
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    args = parser.parse_args()
+
+    def read_lines():
+        with open(args.input, "r", encoding="utf-8", errors="ignore") as f:
+            it = (line.strip() for line in f)
+            if args.max_lines > 0:
+                it = islice(it, args.max_lines)
+            for phrase in it:
+                if phrase:
+                    yield phrase
+
+    def build_counter():
+        return Counter(read_lines())
+
+    def build_table():
+        vocab = WordVocab()
+        table = PhraseTable(args.max_words)
+        lines = read_lines()
+        while True:
+            part = Counter(islice(lines, args.chunk_size))
+            if not part:
+                break
+            table.add_counter(vocab, part)
+        return vocab, table
+
+    counter, counter_bytes, counter_t = measure(build_counter)
+    n_types = len(counter)
+    del counter
+
+    (vocab, table), table_bytes, table_t = measure(build_table)
+
+    if len(table) != n_types:
+        print(f"[error] type count mismatch: {len(table):,} != {n_types:,}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"phrase types : {n_types:,}")
+    print(f"words        : {len(vocab):,}")
+    print(
+        f"Counter      : {counter_bytes / 1024 ** 2:,.1f} MB "
+        f"({counter_bytes / max(1, n_types):.1f} B/type, {counter_t:.2f} s)"
+    )
+    print(
+        f"PhraseTable  : {table_bytes / 1024 ** 2:,.1f} MB "
+        f"({table_bytes / max(1, n_types):.1f} B/type, {table_t:.2f} s, "
+        f"load {len(table) / len(table.counts):.2f})"
+    )
+    print(f"ratio        : {counter_bytes / max(1, table_bytes):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
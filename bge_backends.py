@@ -0,0 +1,147 @@
+import sys
+from contextlib import nullcontext
+from itertools import chain
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+from sentence_transformers.util import batch_to_device
+
+
+MODEL_NAME = "BAAI/bge-m3"
+
+# CPU backends:
+#   torch-int8 - fp32 torch model with nn.Linear dynamically quantized to int8
+#   torch      - plain fp32 torch model
+#   onnx       - ONNX Runtime export via sentence-transformers' onnx backend
+#                (needs `pip install optimum[onnxruntime]`)
+CPU_BACKENDS = ("torch-int8", "torch", "onnx")
+
+
+def set_cpu_threads(intra_op: int, inter_op: int) -> None:
+    """
+    Thread pools for torch CPU inference; 0 keeps torch's default.
+    Must run before the first parallel op: inter-op can only be set once,
+    so a repeated call with the same count (one load_model per backend)
+    leaves it alone.
+    """
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0 and torch.get_num_interop_threads() != inter_op:
+        torch.set_num_interop_threads(inter_op)
+
+
+def onnx_session_options(intra_op: int, inter_op: int):
+    import onnxruntime as ort
+
+    opts = ort.SessionOptions()
+    if intra_op > 0:
+        opts.intra_op_num_threads = intra_op
+    if inter_op > 0:
+        opts.inter_op_num_threads = inter_op
+        opts.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return opts
+
+
+def load_model(
+    device: str = "cuda",
+    cpu_backend: str = "torch-int8",
+    intra_op_threads: int = 0,
+    inter_op_threads: int = 0,
+) -> SentenceTransformer:
+    """
+    BGE-M3 for the given device. cuda: the torch model on the GPU (run it
+    under autocast_context for fp16). cpu: one of CPU_BACKENDS with the
+    requested thread counts.
+    """
+    if device == "cuda":
+        print(f"[info] loading {MODEL_NAME} on cuda...", file=sys.stderr)
+        return SentenceTransformer(MODEL_NAME).to("cuda")
+
+    if device != "cpu":
+        raise ValueError(f"unknown device {device!r} (expected cuda or cpu)")
+    if cpu_backend not in CPU_BACKENDS:
+        raise ValueError(f"unknown cpu backend {cpu_backend!r} (expected one of {CPU_BACKENDS})")
+
+    print(
+        f"[info] loading {MODEL_NAME} on cpu ({cpu_backend}, "
+        f"intra_op={intra_op_threads or 'default'}, inter_op={inter_op_threads or 'default'})...",
+        file=sys.stderr,
+    )
+
+    if cpu_backend == "onnx":
+        try:
+            opts = onnx_session_options(intra_op_threads, inter_op_threads)
+        except ImportError as e:
+            raise RuntimeError(
+                "the onnx backend requires onnxruntime (pip install optimum[onnxruntime])"
+            ) from e
+        return SentenceTransformer(
+            MODEL_NAME,
+            device="cpu",
+            backend="onnx",
+            model_kwargs={"provider": "CPUExecutionProvider", "session_options": opts},
+        )
+
+    set_cpu_threads(intra_op_threads, inter_op_threads)
+    model = SentenceTransformer(MODEL_NAME, device="cpu")
+    model.eval()
+    if cpu_backend == "torch-int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def autocast_context(device: str):
+    """
+    fp16 autocast on the GPU; CPU backends run in their own precision.
+    """
+    if device == "cuda":
+        return torch.autocast("cuda", dtype=torch.float16)
+    return nullcontext()
+
+
+def tokenize_texts(model: SentenceTransformer, texts: list) -> list:
+    """
+    input_ids of every text as model.tokenize makes them (stripped,
+    lowercased if the model does, truncated to max_seq_length), but
+    unpadded: a whole look-ahead buffer is tokenized in one call and
+    batches are padded from these ids by pad_batch.
+    """
+    if getattr(model._first_module(), "do_lower_case", False):
+        texts = [t.strip().lower() for t in texts]
+    else:
+        texts = [t.strip() for t in texts]
+    return model.tokenizer(
+        texts, add_special_tokens=True, truncation=True, max_length=model.max_seq_length
+    )["input_ids"]
+
+
+def pad_batch(model: SentenceTransformer, ids: list) -> dict:
+    """
+    model.tokenize output for already tokenized texts: input_ids padded
+    on the right with the tokenizer's pad id to the longest one, and the
+    attention mask.
+    """
+    lengths = np.fromiter(map(len, ids), dtype=np.int64, count=len(ids))
+    mask = np.arange(lengths.max()) < lengths[:, None]
+    input_ids = np.full(mask.shape, model.tokenizer.pad_token_id, dtype=np.int64)
+    input_ids[mask] = np.fromiter(chain.from_iterable(ids), dtype=np.int64, count=lengths.sum())
+    return {
+        "input_ids": torch.from_numpy(input_ids),
+        "attention_mask": torch.from_numpy(mask.astype(np.int64)),
+    }
+
+
+def forward_batch(model: SentenceTransformer, features: dict, device: str) -> np.ndarray:
+    """
+    One pre-tokenized batch (model.tokenize output) through the model:
+    what SentenceTransformer.encode does per batch minus the tokenization,
+    so tokenizing can run on another thread. Returns L2-normalized fp16
+    vectors (converted on the device, before the copy to host).
+    """
+    features = batch_to_device(features, device)
+    with torch.inference_mode():
+        emb = model(features)["sentence_embedding"]
+        emb = torch.nn.functional.normalize(emb, p=2, dim=1)
+    return emb.to(torch.float16).cpu().numpy()
@@ -4,6 +4,53 @@ import sys
 from pathlib import Path
 from collections import Counter
 
+import numpy as np
+
+from phrase_columns import PhraseColumns, is_columnar
+
+
+def iter_final_rows(path: Path):
+    """
+    Строки final_phrases: (phrase, freq, cluster_size) или None для битой строки
+    (она всё равно занимает свой phrase_id). Вход — TSV или каталог *.cols.
+    """
+    if is_columnar(str(path)):
+        cols = PhraseColumns(str(path))
+        freq = np.asarray(cols["freq"]).tolist()
+        if "cluster_size" in cols.columns:
+            sizes = np.asarray(cols["cluster_size"]).tolist()
+        else:
+            sizes = [1] * len(cols)
+        yield from zip(cols.iter_phrases(), freq, sizes)
+        return
+
+    with path.open("r", encoding="utf-8") as fin:
+        for line in fin:
+            line = line.rstrip("\n")
+            if not line:
+                yield None
+                continue
+            parts = line.split("\t")
+            if len(parts) < 2:
+                yield None
+                continue
+
+            phrase = parts[0]
+            try:
+                freq = int(parts[1])
+            except ValueError:
+                yield None
+                continue
+
+            cluster_size = 1
+            if len(parts) >= 3:
+                try:
+                    cluster_size = int(parts[2])
+                except ValueError:
+                    pass
+
+            yield phrase, freq, cluster_size
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -12,7 +59,7 @@ def main():
     parser.add_argument(
         "-i", "--input",
         required=True,
-        help="Вход: final_phrases.tsv (phrase<TAB>freq<TAB>cluster_size).",
+        help="Вход: final_phrases.tsv (phrase<TAB>freq<TAB>cluster_size) или каталог *.cols.",
     )
     parser.add_argument(
         "--out-dir",
@@ -37,31 +84,20 @@ def main():
     next_progress = args.progress_interval
 
     print(f"[info] pass 1: counting word frequencies from {in_path}", file=sys.stderr)
-    with in_path.open("r", encoding="utf-8") as fin:
-        for line in fin:
-            total_phrases += 1
-            if total_phrases >= next_progress:
-                print(f"[pass1] {total_phrases:,} phrases...", file=sys.stderr)
-                next_progress += args.progress_interval
+    for row in iter_final_rows(in_path):
+        total_phrases += 1
+        if total_phrases >= next_progress:
+            print(f"[pass1] {total_phrases:,} phrases...", file=sys.stderr)
+            next_progress += args.progress_interval
 
-            line = line.rstrip("\n")
-            if not line:
-                continue
+        if row is None:
+            continue
+        phrase, freq, _cluster_size = row
 
-            parts = line.split("\t")
-            if len(parts) < 2:
-                continue
-
-            phrase = parts[0]
-            try:
-                freq = int(parts[1])
-            except ValueError:
-                continue
-
-            words = phrase.split()
-            for w in words:
-                if w:
-                    word_freq[w] += freq
+        words = phrase.split()
+        for w in words:
+            if w:
+                word_freq[w] += freq
 
     print(f"[info] total phrases read: {total_phrases:,}", file=sys.stderr)
     print(f"[info] vocab size: {len(word_freq):,}", file=sys.stderr)
@@ -89,38 +125,21 @@ def main():
     total_phrases = 0
     next_progress = args.progress_interval
 
-    with in_path.open("r", encoding="utf-8") as fin, \
-         phrases_path.open("w", encoding="utf-8") as fphr, \
+    with phrases_path.open("w", encoding="utf-8") as fphr, \
          pw_path.open("w", encoding="utf-8") as fpw:
 
         fphr.write("phrase_id\tphrase\tfreq\tcluster_size\tlength\n")
         # phrase_words.tsv без заголовка: phrase_id<TAB>word_id
 
-        for phrase_id, line in enumerate(fin):
+        for phrase_id, row in enumerate(iter_final_rows(in_path)):
             total_phrases += 1
             if total_phrases >= next_progress:
                 print(f"[pass2] {total_phrases:,} phrases...", file=sys.stderr)
                 next_progress += args.progress_interval
 
-            line = line.rstrip("\n")
-            if not line:
+            if row is None:
                 continue
-            parts = line.split("\t")
-            if len(parts) < 2:
-                continue
-
-            phrase = parts[0]
-            try:
-                freq = int(parts[1])
-            except ValueError:
-                continue
-
-            cluster_size = 1
-            if len(parts) >= 3:
-                try:
-                    cluster_size = int(parts[2])
-                except ValueError:
-                    pass
+            phrase, freq, cluster_size = row
 
             words = phrase.split()
             length = len(words)
@@ -0,0 +1,95 @@
+import io
+import os
+from typing import Iterator, List, Tuple
+
+
+# Сколько байт за раз читает воркер внутри своего диапазона
+BLOCK_SIZE = 8 * 1024 * 1024
+
+# Диапазонов больше, чем воркеров, — чтобы выровнять нагрузку
+RANGES_PER_WORKER = 4
+
+
+def split_byte_ranges(path: str, n_parts: int) -> List[Tuple[int, int]]:
+    """
+    Делит файл на n_parts диапазонов [start, end), выровненных по концу строки.
+    Родитель читает только по одной строке на границу, содержимое файла
+    целиком не читается.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    n_parts = max(1, min(n_parts, size))
+
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, n_parts):
+            target = size * i // n_parts
+            if target <= bounds[-1]:
+                continue
+            f.seek(target)
+            f.readline()  # дочитываем строку до конца
+            pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def line_boundary(path: str, target: int) -> int:
+    """
+    Начало строки, следующей за той, в которой лежит байт target
+    (или размер файла); target <= 0 — начало файла.
+    """
+    size = os.path.getsize(path)
+    if target <= 0:
+        return 0
+    if target >= size:
+        return size
+    with open(path, "rb") as f:
+        f.seek(target)
+        f.readline()  # дочитываем строку до конца
+        return f.tell()
+
+
+def shard_byte_range(path: str, index: int, count: int) -> Tuple[int, int]:
+    """
+    Диапазон [start, end) шарда index из count: границы считаются независимо
+    для каждого шарда, поэтому процессы без общения получают одни и те же
+    непересекающиеся диапазоны, покрывающие весь файл (на маленьком файле
+    часть из них может быть пустой).
+    """
+    size = os.path.getsize(path)
+    return (
+        line_boundary(path, size * index // count),
+        line_boundary(path, size * (index + 1) // count),
+    )
+
+
+def iter_range_lines(
+    path: str,
+    start: int,
+    end: int,
+    block_size: int = BLOCK_SIZE,
+) -> Iterator[str]:
+    """
+    Отдаёт строки из байтового диапазона [start, end) файла.
+    Декодирование и разбиение на строки такие же, как у
+    open(path, "r", encoding="utf-8", errors="ignore").
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            data = f.read(min(block_size, end - pos))
+            if not data:
+                break
+            pos += len(data)
+            # блок заканчиваем на \n, чтобы не резать строку и UTF-8 символ
+            if pos < end and not data.endswith(b"\n"):
+                tail = f.readline()
+                data += tail
+                pos += len(tail)
+            text = data.decode("utf-8", errors="ignore")
+            yield from io.StringIO(text, newline=None)
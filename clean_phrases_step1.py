@@ -3,9 +3,17 @@ import argparse
 import os
 import sys
 import re
-from concurrent.futures import ProcessPoolExecutor
-from itertools import repeat
-from typing import List, Iterable
+import shutil
+import time
+from collections import Counter, deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Iterable, Tuple
+
+from byte_ranges import RANGES_PER_WORKER, iter_range_lines, split_byte_ranges
+from corpus_files import is_compressed, open_text, resolve_inputs
+from stage_stats import StageStats, phrase_length
+from step2_count_phrases import write_trimmed_counts
 
 
 # =========================
@@ -29,15 +37,41 @@ BRACKETS_RE = re.compile(
 )
 
 
+# Символы, без которых BRACKETS_RE ничего не найдёт
+BRACKET_OPENERS = ("[", "<", "{", "(", "♪")
+
+
+class _LettersTable(dict):
+    """
+    Таблица для str.translate: буква -> сама себя, всё остальное -> пробел.
+    Заполняется лениво через str.isalpha(), поэтому совпадает с ним
+    для любого символа Unicode.
+    """
+
+    def __missing__(self, cp: int) -> int:
+        v = cp if chr(cp).isalpha() else 32
+        self[cp] = v
+        return v
+
+
+LETTERS_TABLE = _LettersTable()
+
+
 def strip_tags_and_urls(line: str) -> str:
     """
     Удаляет:
       - гиперссылки (http(s)://..., www....)
       - теги субтитров: [..], <..>, {..}, (..), ♪..♪
     Заменяет их пробелами (чтобы не склеивать слова).
+    Регулярки запускаются только если в строке есть нужные символы:
+    для URL это "//" или "." вместе с "w"/"W", для тегов — открывающая скобка.
     """
-    line = URL_RE.sub(" ", line)
-    line = BRACKETS_RE.sub(" ", line)
+    if "//" in line or ("." in line and ("w" in line or "W" in line)):
+        line = URL_RE.sub(" ", line)
+    for ch in BRACKET_OPENERS:
+        if ch in line:
+            line = BRACKETS_RE.sub(" ", line)
+            break
     return line
 
 
@@ -58,14 +92,8 @@ def clean_line(line: str, min_words: int, max_words: int) -> str | None:
     if not line:
         return None
 
-    # Шаг 3: только буквы и пробелы (прочее -> пробел)
-    chars = []
-    for ch in line:
-        if ch.isalpha():
-            chars.append(ch)
-        else:
-            chars.append(" ")
-    cleaned = "".join(chars)
+    # Шаг 3: только буквы и пробелы (прочее -> пробел), одним проходом в C
+    cleaned = line.translate(LETTERS_TABLE)
 
     # Шаг 4: токенизация и фильтр по длине
     tokens = cleaned.split()
@@ -79,34 +107,321 @@ def process_chunk(
     lines: List[str],
     min_words: int,
     max_words: int,
-) -> List[str]:
+) -> Tuple[List[str], Counter]:
     """
     Обработка чанка строк. Возвращает список очищенных строк
-    (без пустых и слишком коротких/длинных).
+    (без пустых и слишком коротких/длинных) и гистограмму их длин.
     """
     out_lines: List[str] = []
+    lengths = Counter()
     for line in lines:
         r = clean_line(line, min_words, max_words)
         if r is not None:
             out_lines.append(r + "\n")
-    return out_lines
+            lengths[phrase_length(r)] += 1
+    return out_lines, lengths
+
+
+def count_clean_chunk(
+    lines: List[str],
+    min_words: int,
+    max_words: int,
+) -> Counter:
+    """
+    Режим --count: очищает чанк и сразу считает частоты фраз,
+    не возвращая сами строки.
+    """
+    c = Counter()
+    for line in lines:
+        r = clean_line(line, min_words, max_words)
+        if r is not None:
+            c[r] += 1
+    return c
+
+
+def iter_task_lines(path: str, start: int | None, end: int | None) -> Iterable[str]:
+    """
+    Строки одной задачи воркера: байтовый диапазон [start, end) несжатого
+    файла или, если start is None, весь файл (сжатый распаковывается здесь же,
+    в воркере).
+    """
+    if start is None:
+        with open_text(path) as fin:
+            yield from fin
+    else:
+        yield from iter_range_lines(path, start, end)
+
+
+def process_range(
+    path: str,
+    start: int | None,
+    end: int | None,
+    min_words: int,
+    max_words: int,
+    out_path: str,
+) -> Tuple[int, int, float, Counter]:
+    """
+    Обработка одной задачи (байтового диапазона или целого файла) прямо
+    в воркере: воркер сам читает свой кусок и пишет результат в файл-шард
+    out_path. Возвращает (число входных строк, число записанных фраз, секунды,
+    гистограмма длин фраз).
+    """
+    t0 = time.monotonic()
+    n_in = 0
+    n_out = 0
+    lengths = Counter()
+    with open(out_path, "w", encoding="utf-8") as fout:
+        for line in iter_task_lines(path, start, end):
+            n_in += 1
+            r = clean_line(line, min_words, max_words)
+            if r is not None:
+                fout.write(r + "\n")
+                n_out += 1
+                lengths[phrase_length(r)] += 1
+    return n_in, n_out, time.monotonic() - t0, lengths
+
+
+def count_task(
+    path: str,
+    start: int | None,
+    end: int | None,
+    min_words: int,
+    max_words: int,
+) -> Tuple[Counter, int, int, float]:
+    """
+    Режим --count для одной задачи: очистка и подсчёт частот в воркере.
+    Возвращает (счётчик, число входных строк, число фраз, секунды).
+    """
+    t0 = time.monotonic()
+    c = Counter()
+    n_in = 0
+    n_out = 0
+    for line in iter_task_lines(path, start, end):
+        n_in += 1
+        r = clean_line(line, min_words, max_words)
+        if r is not None:
+            c[r] += 1
+            n_out += 1
+    return c, n_in, n_out, time.monotonic() - t0
 
 
 def chunk_reader(
     fh,
     chunk_size: int,
-) -> Iterable[List[str]]:
+) -> Iterable[Tuple[List[str], int]]:
     """
-    Читает файл чанками по chunk_size строк.
+    Читает текстовый файл чанками по chunk_size строк.
+    Вместе с чанком отдаёт позицию в байтах во входном файле
+    (с точностью до буфера чтения) — для отчёта о скорости.
     """
     chunk: List[str] = []
     for line in fh:
         chunk.append(line)
         if len(chunk) >= chunk_size:
-            yield chunk
+            yield chunk, fh.buffer.tell()
             chunk = []
     if chunk:
-        yield chunk
+        yield chunk, fh.buffer.tell()
+
+
+def format_rate(lines: int, nbytes: int, elapsed: float) -> str:
+    """
+    Строка прогресса: строки, мегабайты и скорость (строк/с, МБ/с).
+    """
+    elapsed = max(elapsed, 1e-9)
+    mb = nbytes / (1024 * 1024)
+    return (
+        f"{lines:,} lines, {mb:,.1f} MB "
+        f"({lines / elapsed:,.0f} lines/s, {mb / elapsed:,.1f} MB/s)"
+    )
+
+
+def run_streaming(args, path: str, stats: StageStats) -> None:
+    """
+    Потоковый режим: родитель читает строки файла path (один несжатый вход
+    после resolve_inputs) и раздаёт чанки воркерам.
+    """
+    max_in_flight = args.max_in_flight or 2 * args.workers
+    max_in_flight = max(1, max_in_flight)
+
+    print(
+        f"[info] streaming {path} with {args.workers} workers, "
+        f"chunk_size={args.chunk_size:,}, max_in_flight={max_in_flight}",
+        file=sys.stderr,
+    )
+
+    total_lines = 0
+    total_bytes = 0
+    next_progress = args.progress_interval
+    t0 = time.monotonic()
+
+    # В режиме --count чанки сразу превращаются в частоты, файл фраз не пишется
+    counter = Counter() if args.count else None
+    worker_fn = count_clean_chunk if args.count else process_chunk
+    out_ctx = nullcontext() if args.count else open(args.output, "w", encoding="utf-8")
+
+    with open(path, "r", encoding="utf-8", errors="ignore") as fin, \
+         out_ctx as fout, \
+         ProcessPoolExecutor(max_workers=args.workers) as ex:
+
+        # Окно из не более max_in_flight чанков: новые чанки читаются только
+        # после того, как самый старый результат записан. Так в памяти живёт
+        # O(max_in_flight * chunk_size) строк, а порядок вывода сохраняется.
+        pending: deque = deque()
+
+        def drain_one():
+            nonlocal total_lines, total_bytes, next_progress
+            fut, n_lines, pos = pending.popleft()
+            if counter is not None:
+                counter.update(fut.result())
+            else:
+                out_lines, lengths = fut.result()
+                fout.writelines(out_lines)
+                stats.add_length_hist(lengths)
+            total_lines += n_lines
+            total_bytes = pos
+
+            if total_lines >= next_progress:
+                elapsed = time.monotonic() - t0
+                print(f"[progress] processed {format_rate(total_lines, total_bytes, elapsed)}",
+                      file=sys.stderr)
+                next_progress += args.progress_interval
+
+        for chunk, pos in chunk_reader(fin, args.chunk_size):
+            if len(pending) >= max_in_flight:
+                drain_one()
+            fut = ex.submit(worker_fn, chunk, args.min_words, args.max_words)
+            pending.append((fut, len(chunk), pos))
+
+        while pending:
+            drain_one()
+
+    elapsed = time.monotonic() - t0
+    print(f"[done] total processed {format_rate(total_lines, total_bytes, elapsed)}",
+          file=sys.stderr)
+    stats.info["lines_in"] = total_lines
+
+    if counter is not None:
+        write_trimmed_counts(counter, args.output, args.tail_percent, stats)
+    else:
+        stats.write(args.output)
+
+
+def build_tasks(
+    inputs: List[str],
+    n_ranges: int,
+    byte_ranges: bool,
+) -> List[Tuple[str, int | None, int | None]]:
+    """
+    Задачи для воркеров: (путь, start, end). Сжатые файлы нельзя резать
+    по байтам, поэтому каждый из них — одна задача (start = end = None).
+    Несжатые файлы при byte_ranges делятся на диапазоны по строкам.
+    """
+    tasks: List[Tuple[str, int | None, int | None]] = []
+    for path in inputs:
+        if byte_ranges and not is_compressed(path):
+            for start, end in split_byte_ranges(path, n_ranges):
+                tasks.append((path, start, end))
+        else:
+            tasks.append((path, None, None))
+    return tasks
+
+
+def run_sharded(args, inputs: List[str], stats: StageStats) -> None:
+    """
+    Шардированный режим: родитель не читает строки. Каждый воркер сам
+    читает свою задачу (байтовый диапазон или целый, возможно сжатый, файл)
+    и пишет шард; шарды затем склеиваются в исходном порядке.
+    """
+    tasks = build_tasks(inputs, args.workers * RANGES_PER_WORKER, args.byte_ranges)
+    parts_dir = args.output + ".parts"
+    part_paths = [
+        os.path.join(parts_dir, f"part-{k:05d}.txt") for k in range(len(tasks))
+    ]
+    counter = Counter() if args.count else None
+    if counter is None:
+        os.makedirs(parts_dir, exist_ok=True)
+
+    print(
+        f"[info] sharded mode: {len(tasks)} tasks over {len(inputs)} input file(s) "
+        f"with {args.workers} workers",
+        file=sys.stderr,
+    )
+
+    total_lines = 0
+    total_out = 0
+    total_bytes = 0
+    done_tasks = 0
+    next_progress = args.progress_interval
+    t0 = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        future_to_task = {}
+        for task, part_path in zip(tasks, part_paths):
+            path, start, end = task
+            if counter is not None:
+                fut = ex.submit(
+                    count_task,
+                    path, start, end,
+                    args.min_words, args.max_words,
+                )
+            else:
+                fut = ex.submit(
+                    process_range,
+                    path, start, end,
+                    args.min_words, args.max_words,
+                    part_path,
+                )
+            future_to_task[fut] = task
+
+        for fut in as_completed(future_to_task):
+            path, start, end = future_to_task[fut]
+            if counter is not None:
+                c, n_in, n_out, task_elapsed = fut.result()
+                counter.update(c)
+            else:
+                n_in, n_out, task_elapsed, lengths = fut.result()
+                stats.add_length_hist(lengths)
+            # для сжатых шардов считаем байты на диске (сжатые)
+            n_bytes = os.path.getsize(path) if start is None else end - start
+            total_lines += n_in
+            total_out += n_out
+            total_bytes += n_bytes
+            done_tasks += 1
+
+            if start is None:
+                print(
+                    f"[shard] {done_tasks}/{len(tasks)} {path}: "
+                    f"{format_rate(n_in, n_bytes, task_elapsed)}, kept {n_out:,}",
+                    file=sys.stderr,
+                )
+
+            if total_lines >= next_progress:
+                elapsed = time.monotonic() - t0
+                print(f"[progress] processed {format_rate(total_lines, total_bytes, elapsed)}",
+                      file=sys.stderr)
+                next_progress += args.progress_interval
+
+    elapsed = time.monotonic() - t0
+    print(f"[done] total processed {format_rate(total_lines, total_bytes, elapsed)}",
+          file=sys.stderr)
+    stats.info["lines_in"] = total_lines
+
+    if counter is not None:
+        print(f"[info] cleaned phrases counted: {total_out:,}", file=sys.stderr)
+        write_trimmed_counts(counter, args.output, args.tail_percent, stats)
+        return
+
+    # Склеиваем шарды в исходном порядке
+    with open(args.output, "wb") as fout:
+        for part_path in part_paths:
+            with open(part_path, "rb") as fpart:
+                shutil.copyfileobj(fpart, fout)
+            os.remove(part_path)
+    os.rmdir(parts_dir)
+    stats.write(args.output)
+
+    print(f"[done] written {total_out:,} phrases to {args.output}", file=sys.stderr)
 
 
 def main():
@@ -117,7 +432,10 @@ def main():
         "-i", "--input",
         type=str,
         required=True,
-        help="Входной файл (одна фраза на строку).",
+        help=(
+            "Входной файл (одна фраза на строку), каталог или маска (glob). "
+            "Файлы .gz/.xz/.zst распаковываются в воркерах."
+        ),
     )
     parser.add_argument(
         "-o", "--output",
@@ -155,38 +473,51 @@ def main():
         default=1_000_000,
         help="Как часто показывать прогресс (по числу обработанных строк). По умолчанию 1_000_000.",
     )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=0,
+        help=(
+            "Сколько чанков одновременно держать в обработке. Пиковая память "
+            "~ max_in_flight * chunk_size строк. По умолчанию 0 = 2 * workers."
+        ),
+    )
+    parser.add_argument(
+        "--byte-ranges",
+        action="store_true",
+        help=(
+            "Делить вход по байтовым диапазонам: каждый воркер сам читает свой "
+            "кусок файла и пишет шард, родитель не пересылает строки."
+        ),
+    )
 
-    args = parser.parse_args()
-
-    total_lines = 0
-
-    with open(args.input, "r", encoding="utf-8", errors="ignore") as fin, \
-         open(args.output, "w", encoding="utf-8") as fout, \
-         ProcessPoolExecutor(max_workers=args.workers) as ex:
+    parser.add_argument(
+        "--count",
+        action="store_true",
+        help=(
+            "Слитый режим шагов 1+2: очищать и сразу считать частоты в воркерах, "
+            "в -o пишется phrase<TAB>count (как у step2_count_phrases.py, "
+            "включая колоночный *.cols) без промежуточного файла очищенных фраз."
+        ),
+    )
+    parser.add_argument(
+        "--tail-percent",
+        type=float,
+        default=5.0,
+        help=(
+            "Только для --count: процент самых редких фраз, которые нужно удалить "
+            "(по количеству типов). По умолчанию 5.0."
+        ),
+    )
 
-        chunks = list(chunk_reader(fin, args.chunk_size))
-
-        # Чтобы прогресс был точным, считаем реальный размер каждого чанка
-        total_input_lines = sum(len(c) for c in chunks)
-        print(f"[info] total input lines: {total_input_lines:,}", file=sys.stderr)
-
-        for out_lines, chunk in zip(
-            ex.map(
-                process_chunk,
-                chunks,
-                repeat(args.min_words),
-                repeat(args.max_words),
-            ),
-            chunks,
-        ):
-            fout.writelines(out_lines)
-            total_lines += len(chunk)
-
-            if total_lines % args.progress_interval < len(chunk):
-                print(f"[progress] processed {total_lines:,} / {total_input_lines:,} lines",
-                      file=sys.stderr)
+    args = parser.parse_args()
 
-    print(f"[done] total processed lines: {total_lines:,}", file=sys.stderr)
+    inputs = resolve_inputs(args.input)
+    stats = StageStats("clean_phrases_step1", input=args.input)
+    if args.byte_ranges or len(inputs) > 1 or is_compressed(inputs[0]):
+        run_sharded(args, inputs, stats)
+    else:
+        run_streaming(args, inputs[0], stats)
 
 
 if __name__ == "__main__":
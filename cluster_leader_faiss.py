@@ -7,74 +7,230 @@ import numpy as np
 import faiss
 from tqdm import tqdm
 
+from compact_embeddings import CompactEmbeddings, open_vectors, parse_kind, pq_chunk_rows
+
+
+# строк на блок при построении индекса и при чтении запросов: float32-копия
+# данных в памяти — только один блок, а не все N x dim
+BLOCK_ROWS = 65536
+
+# запросов в одном index.search: FAISS раскидывает батч по потокам
+QUERY_BATCH = 4096
+
+
+def iter_blocks(src, block_rows: int = BLOCK_ROWS, dequantize: bool = False):
+    """
+    (start, float32 rows [start, start + block_rows)) over an fp16 memmap,
+    a compact form or an in-memory array; only one block is converted at a time.
+    dequantize: compact rows as reconstructed, not renormalized (see new_index).
+    """
+    for start in range(0, len(src), block_rows):
+        key = slice(start, start + block_rows)
+        rows = src.dequantize(key) if dequantize else src[key]
+        # FAISS работает с float32
+        yield start, np.ascontiguousarray(rows, dtype=np.float32)
+
+
+def new_index(src):
+    """
+    Empty HNSW index for src. int8 and pq compact forms are stored in the
+    index as 8-bit codes (IndexHNSWSQ / IndexHNSWPQ) with the scales /
+    centroids of the compact form, so the index is ~dim (int8) or M (pq)
+    bytes per row instead of 4 * dim; everything else is IndexHNSWFlat.
+    Returns (index, dequantize) for iter_blocks when adding rows.
+    """
+    dim = src.shape[1]
+    name, m = parse_kind(src.kind) if isinstance(src, CompactEmbeddings) else (None, None)
+    if name == "int8":
+        index = faiss.IndexHNSWSQ(
+            dim, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT
+        )
+        # сетка QT_8bit (vmin + (c + 0.5) / 255 * vdiff) совпадает с int8-сеткой
+        # c * scale / 127: код faiss = int8-код + 127, без второго округления
+        step = src.params["scale"].astype(np.float32) / 127
+        sq = faiss.downcast_index(index.storage).sq
+        faiss.copy_array_to_vector(np.concatenate([-127.5 * step, 255 * step]), sq.trained)
+    elif name == "pq":
+        # граф HNSW над PQ строится по симметричным L2-расстояниям; с METRIC_INNER_PRODUCT
+        # он выходит негодным (recall ~0.1), поэтому индекс L2, а косинус
+        # восстанавливается в leader_cluster по длинам строк (см. cosine)
+        index = faiss.IndexHNSWPQ(dim, m, 32, 8, faiss.METRIC_L2)
+        pq = faiss.downcast_index(index.storage).pq
+        faiss.copy_array_to_vector(src.params["centroids"].ravel(), pq.centroids)
+        # таблица расстояний код-код для построения графа (обычно её считает train)
+        pq.compute_sdc_table()
+    else:
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = 200
+    if name is None:
+        return index, False
+    index.storage.is_trained = True
+    index.is_trained = True
+    return index, True
+
+
+def add_rows(index, x: np.ndarray) -> None:
+    """
+    index.add, in chunks for a PQ index (encoding allocates rows x M x 256 floats).
+    """
+    step = len(x)
+    if isinstance(index, faiss.IndexHNSWPQ):
+        step = pq_chunk_rows(faiss.downcast_index(index.storage).pq.M)
+    for i in range(0, len(x), max(step, 1)):
+        index.add(x[i : i + step])
+
+
+def cosine(index, D: np.ndarray, norms: np.ndarray) -> np.ndarray:
+    """
+    Search results of a code-backed index as cosine to the stored rows
+    (queries are unit length): inner product / |r|, and for an L2 index
+    the inner product first, <q, r> = (1 + |r|^2 - |q - r|^2) / 2.
+    """
+    if index.metric_type == faiss.METRIC_L2:
+        D = (1 + norms * norms - D) / 2
+    return D / norms
+
+
+def build_index(src, block_rows: int = BLOCK_ROWS):
+    """
+    HNSW index over src, filled block by block. Returns (index, norms):
+    norms are the lengths of the stored rows for code-backed indexes (the
+    reconstructed int8 / pq rows are not unit length), None otherwise.
+    """
+    print("[info] building FAISS index (HNSW)...", file=sys.stderr)
+    index, dequantize = new_index(src)
+
+    # хранилище векторов растёт как std::vector (удвоением), и на каждом
+    # перевыделении в памяти две копии; resize вверх и обратно оставляет
+    # ёмкость, то есть место под все N строк резервируется один раз
+    storage = faiss.downcast_index(index.storage)
+    storage.codes.resize(len(src) * storage.code_size)
+    storage.codes.resize(0)
+
+    # Нормировка уже сделана при encode, но если сомневаемся, можно повторно
+    norms = np.empty(len(src), dtype=np.float32) if dequantize else None
+    with tqdm(total=len(src), desc="indexing", unit="phr") as pbar:
+        for start, block in iter_blocks(src, block_rows, dequantize):
+            add_rows(index, block)
+            if norms is not None:
+                norms[start : start + len(block)] = np.linalg.norm(block, axis=1)
+            pbar.update(len(block))
+    return index, norms
+
+
+def leader_cluster(
+    index,
+    src,
+    k: int,
+    threshold: float,
+    block_rows: int = BLOCK_ROWS,
+    query_batch: int = QUERY_BATCH,
+    norms: np.ndarray = None,
+):
+    """
+    Sequential leader clustering: each row not yet assigned opens a new
+    cluster and pulls in its unassigned kNN with sim >= threshold.
+    kNN of up to query_batch rows is searched in one call, then rows are
+    assigned in order over the precomputed lists; search results do not
+    depend on the batch, so cluster ids match query_batch=1 exactly.
+    Query rows are read from src block by block. With norms (from
+    build_index) similarities are divided by the stored row's length,
+    so the threshold is on cosine for int8 / pq indexes too.
+    Returns (cluster_id per row, number of clusters).
+    """
+    n = len(src)
+    cluster_id = np.full(n, -1, dtype=np.int32)
+    current_cluster = 0
+
+    with tqdm(total=n, desc="clustering", unit="phr") as pbar:
+        for start, block in iter_blocks(src, block_rows):
+            for qs in range(0, len(block), query_batch):
+                qe = min(qs + query_batch, len(block))
+                # уже назначенные строки лидерами не станут — их не ищем
+                rows = start + qs + np.flatnonzero(cluster_id[start + qs : start + qe] == -1)
+                pbar.update(qe - qs)
+                if not len(rows):
+                    continue
+
+                # NN search: D — (len(rows), k) similarities, I — indices
+                D, I = index.search(block[rows - start], k)
+                if norms is not None:
+                    D = cosine(index, D, norms[np.maximum(I, 0)])  # I < 0 отбрасываются ниже
+
+                for i, sims, neigh in zip(rows.tolist(), D, I):
+                    # могла попасть в кластер лидера выше по этому же батчу
+                    if cluster_id[i] != -1:
+                        continue
 
-def load_memmap(path: Path, dim: int, dtype="float16") -> np.memmap:
-    # shape: (N, dim); N нужно вычислить по размеру файла
-    bytes_per = np.dtype(dtype).itemsize
-    n = path.stat().st_size // (bytes_per * dim)
-    print(f"[info] memmap: {n:,} x {dim} ({dtype})", file=sys.stderr)
-    arr = np.memmap(path, mode="r", dtype=dtype, shape=(n, dim))
-    return arr
+                    # Новый кластер
+                    cid = current_cluster
+                    current_cluster += 1
+                    cluster_id[i] = cid
+
+                    # [0] — это i само; j < 0 — соседей меньше k
+                    sims, neigh = sims[1:], neigh[1:]
+                    neigh = neigh[(neigh >= 0) & (sims >= threshold)]
+                    cluster_id[neigh[cluster_id[neigh] == -1]] = cid
+
+    return cluster_id, current_cluster
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Leader clustering on BGE-M3 embeddings using FAISS (cosine)."
     )
-    parser.add_argument("--emb", required=True, help="bge_m3_embeddings.dat")
-    parser.add_argument("--dim", type=int, default=1024, help="Embedding dimension.")
+    parser.add_argument(
+        "--emb",
+        required=True,
+        help=(
+            "bge_m3_embeddings.dat, or a compact form built by compact_embeddings.py "
+            "(e.g. bge_m3_embeddings.int8/, bge_m3_embeddings.pq64/)."
+        ),
+    )
+    parser.add_argument(
+        "--dim",
+        type=int,
+        default=None,
+        help=(
+            "Embedding dimension. Taken from the manifest (bge_m3_embeddings.json) "
+            "written by the encoder; for older runs without one defaults to 1024."
+        ),
+    )
     parser.add_argument("--out", required=True, help="Output: cluster_id per line.")
     parser.add_argument("--k", type=int, default=32, help="K nearest neighbors to check.")
     parser.add_argument("--threshold", type=float, default=0.92,
                         help="Cosine similarity threshold.")
     parser.add_argument("--progress-interval", type=int, default=10000)
+    parser.add_argument(
+        "--block-rows",
+        type=int,
+        default=BLOCK_ROWS,
+        help="Rows converted to float32 at a time for indexing and queries.",
+    )
+    parser.add_argument(
+        "--query-batch",
+        type=int,
+        default=QUERY_BATCH,
+        help=(
+            "kNN queries per index.search call (capped by --block-rows); "
+            "1 searches one row at a time. Cluster ids do not depend on it."
+        ),
+    )
     args = parser.parse_args()
 
     emb_path = Path(args.emb)
-    emb = load_memmap(emb_path, args.dim, dtype="float16")
-    n, d = emb.shape
-
-    # FAISS работает с float32
-    print("[info] building FAISS index (HNSW)...", file=sys.stderr)
-    index = faiss.IndexHNSWFlat(d, 32, faiss.METRIC_INNER_PRODUCT)
-    index.hnsw.efConstruction = 200
-    index.verbose = True
+    # N, dim и dtype — из манифеста энкодера; запросы компактной формы декодируются в float32
+    try:
+        emb = open_vectors(emb_path, args.dim)
+    except ValueError as e:
+        sys.exit(f"[error] {e}")
 
-    # Нормировка уже сделана при encode, но если сомневаемся, можно повторно
-    emb32 = np.array(emb, dtype="float32")
-    index.add(emb32)
+    index, norms = build_index(emb, args.block_rows)
 
     print("[info] index built, starting leader clustering...", file=sys.stderr)
-
-    cluster_id = np.full(n, -1, dtype=np.int32)
-    current_cluster = 0
-
-    with tqdm(total=n, desc="clustering", unit="phr") as pbar:
-        for i in range(n):
-            if cluster_id[i] != -1:
-                pbar.update(1)
-                continue
-
-            # Новый кластер
-            cid = current_cluster
-            current_cluster += 1
-            cluster_id[i] = cid
-
-            # NN search
-            x = emb32[i : i + 1]
-            D, I = index.search(x, args.k)  # D: (1, k) similarities, I: (1, k) indices
-            sims = D[0]
-            neigh = I[0]
-
-            for sim, j in zip(sims[1:], neigh[1:]):  # [0] — это i само
-                if j < 0:
-                    continue
-                if sim < args.threshold:
-                    continue
-                if cluster_id[j] == -1:
-                    cluster_id[j] = cid
-
-            pbar.update(1)
+    cluster_id, current_cluster = leader_cluster(
+        index, emb, args.k, args.threshold, args.block_rows, args.query_batch, norms
+    )
 
     print(f"[info] total clusters: {current_cluster:,}", file=sys.stderr)
 
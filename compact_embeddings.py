@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from encode_state import open_embeddings
+
+
+# Compact forms of an fp16 embeddings file, each in <stem>.<kind>/ next to it:
+#   int8      per-dimension scalar quantization   int8[N, dim]    + scale[dim]
+#   trunc<K>  first K dimensions, renormalized    float16[N, K]
+#   pca<K>    PCA to K dimensions, renormalized   float16[N, K]   + mean, components
+#   pq<M>     product quantization, M x 8 bits    uint8[N, M]     + centroids (faiss)
+# Files: codes.npy, params.npz, manifest.json (written last).
+# Every form decodes to L2-normalized float32 rows, so cosine = inner product
+# exactly as for the fp16 vectors. cluster_leader_faiss.py keeps int8 and pq
+# as 8-bit codes inside the index (IndexHNSWSQ / IndexHNSWPQ with the same
+# scales / centroids); trunc and pca are indexed as float32 of K dims.
+
+COMPACT_FORMAT = "embeddings-compact"
+COMPACT_VERSION = 1
+
+KIND_RE = re.compile(r"^(int8|trunc(\d+)|pca(\d+)|pq(\d+))$")
+
+# rows per block when streaming the fp16 file
+BLOCK_ROWS = 65536
+
+# rows sampled to fit int8 scales / PCA / PQ codebooks
+TRAIN_ROWS = 100_000
+
+# faiss PQ encoding of n rows builds an n x M x 256 float32 distance table,
+# so rows are encoded in chunks that keep it around this size
+PQ_TABLE_BYTES = 64 * 2**20
+
+
+def parse_kind(kind: str):
+    """
+    "int8" -> ("int8", None), "pca256" -> ("pca", 256), "pq64" -> ("pq", 64).
+    """
+    m = KIND_RE.match(kind)
+    if not m:
+        raise ValueError(f"unknown compact kind {kind!r} (int8, trunc<K>, pca<K>, pq<M>)")
+    if kind == "int8":
+        return "int8", None
+    name = re.match(r"[a-z]+", kind).group(0)
+    return name, int(kind[len(name):])
+
+
+def compact_path(emb_path: Path, kind: str) -> Path:
+    return Path(emb_path).with_suffix("." + kind)
+
+
+def is_compact(path) -> bool:
+    return (Path(path) / "manifest.json").is_file()
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def _pq(dim: int, m: int, centroids: np.ndarray = None):
+    import faiss
+
+    pq = faiss.ProductQuantizer(dim, m, 8)
+    if centroids is not None:
+        faiss.copy_array_to_vector(centroids.ravel(), pq.centroids)
+    return pq
+
+
+def pq_chunk_rows(m: int) -> int:
+    return max(1, PQ_TABLE_BYTES // (m * 256 * 4))
+
+
+def train(kind: str, sample: np.ndarray) -> dict:
+    """
+    Parameters of a compact form fitted on a float32 sample of rows.
+    """
+    name, k = parse_kind(kind)
+    dim = sample.shape[1]
+    if name == "int8":
+        # шкала по каждой координате: максимум модуля на выборке
+        return {"scale": np.maximum(np.abs(sample).max(axis=0), 1e-12).astype(np.float32)}
+    if name == "trunc":
+        if not 0 < k <= dim:
+            raise ValueError(f"trunc{k}: K must be in (0, {dim}]")
+        return {}
+    if name == "pca":
+        if not 0 < k <= dim:
+            raise ValueError(f"pca{k}: K must be in (0, {dim}]")
+        mean = sample.mean(axis=0)
+        cov = np.cov(sample - mean, rowvar=False)
+        _, vecs = np.linalg.eigh(cov)  # eigenvalues ascending
+        return {"mean": mean.astype(np.float32), "components": vecs[:, ::-1][:, :k].astype(np.float32)}
+    if dim % k:
+        raise ValueError(f"pq{k}: dim {dim} is not divisible by {k}")
+    import faiss
+
+    pq = _pq(dim, k)
+    pq.train(np.ascontiguousarray(sample, dtype=np.float32))
+    return {"centroids": faiss.vector_to_array(pq.centroids).astype(np.float32)}
+
+
+def encode(kind: str, params: dict, x: np.ndarray, dim: int) -> np.ndarray:
+    name, k = parse_kind(kind)
+    if name == "int8":
+        return np.clip(np.rint(x / params["scale"] * 127), -127, 127).astype(np.int8)
+    if name == "trunc":
+        return normalize(x[:, :k]).astype(np.float16)
+    if name == "pca":
+        return normalize((x - params["mean"]) @ params["components"]).astype(np.float16)
+    pq = _pq(dim, k, params["centroids"])
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    step = pq_chunk_rows(k)
+    return np.concatenate(
+        [pq.compute_codes(x[i : i + step]) for i in range(0, len(x), step)]
+    ) if len(x) else np.empty((0, k), dtype=np.uint8)
+
+
+def decode(
+    kind: str, params: dict, codes: np.ndarray, dim: int, renormalize: bool = True
+) -> np.ndarray:
+    name, k = parse_kind(kind)
+    if name == "int8":
+        x = codes.astype(np.float32) * (params["scale"] / 127)
+    elif name in ("trunc", "pca"):
+        return codes.astype(np.float32)
+    else:
+        x = _pq(dim, k, params["centroids"]).decode(np.ascontiguousarray(codes))
+    return normalize(x) if renormalize else x
+
+
+class CompactEmbeddings:
+    """
+    Read side of a compact form: shape is (N, decoded dim) and slicing
+    decodes rows to normalized float32, so it stands in for the fp16 memmap
+    wherever rows are read in blocks (src[a:b]).
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with (self.path / "manifest.json").open("r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format") != COMPACT_FORMAT:
+            raise ValueError(f"{self.path}: not a compact embeddings directory")
+        self.kind = self.manifest["kind"]
+        self.source_dim = self.manifest["source_dim"]
+        self.codes = np.load(self.path / "codes.npy", mmap_mode="r")
+        with np.load(self.path / "params.npz") as z:
+            self.params = {key: z[key] for key in z.files}
+        self.shape = (self.manifest["rows"], self.manifest["dim"])
+        self.dtype = np.dtype(np.float32)
+        print(
+            f"[info] compact {self.kind}: {self.shape[0]:,} x {self.shape[1]} "
+            f"({self.codes.nbytes / 2**30:.2f} GiB of codes)",
+            file=sys.stderr,
+        )
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, slice):
+            raise TypeError("compact embeddings are read by row slices")
+        return decode(self.kind, self.params, self.codes[key], self.source_dim)
+
+    def dequantize(self, key) -> np.ndarray:
+        """
+        Rows key (a slice or row ids) as the quantizer reconstructs them,
+        without renormalization:
+        a faiss quantizer with the same scales / centroids re-encodes them
+        to (nearly) the same codes.
+        """
+        return decode(self.kind, self.params, self.codes[key], self.source_dim, renormalize=False)
+
+    def take(self, idx: np.ndarray) -> np.ndarray:
+        """
+        Decoded rows idx (any order), e.g. a random sample.
+        """
+        return decode(self.kind, self.params, self.codes[idx], self.source_dim)
+
+
+def open_vectors(path, dim: int = None):
+    """
+    fp16 .dat (via its manifest) or a compact <stem>.<kind>/ directory;
+    both are read as src[a:b] row blocks.
+    """
+    if is_compact(path):
+        return CompactEmbeddings(path)
+    return open_embeddings(Path(path), dim)
+
+
+def build_compact(emb_path: Path, kind: str, train_rows: int = TRAIN_ROWS, seed: int = 0) -> Path:
+    """
+    Streams the fp16 file once (after fitting on a random sample) and
+    writes <stem>.<kind>/.
+    """
+    emb = open_embeddings(Path(emb_path))
+    n, dim = emb.shape
+    out = compact_path(emb_path, kind)
+    out.mkdir(parents=True, exist_ok=True)
+    manifest_path = out / "manifest.json"
+    if manifest_path.exists():
+        manifest_path.unlink()
+
+    rng = np.random.default_rng(seed)
+    idx = np.sort(rng.choice(n, size=min(n, train_rows), replace=False)) if n else np.empty(0, int)
+    sample = np.asarray(emb[idx], dtype=np.float32)
+    print(f"[compact] {kind}: fitting on {len(idx):,} rows", file=sys.stderr)
+    params = train(kind, sample)
+    np.savez(out / "params.npz", **params)
+
+    probe = encode(kind, params, sample[:1], dim)
+    out_dim = decode(kind, params, probe, dim).shape[1]
+    codes = open_memmap(out / "codes.npy", mode="w+", dtype=probe.dtype, shape=(n, probe.shape[1]))
+    for start in range(0, n, BLOCK_ROWS):
+        end = min(start + BLOCK_ROWS, n)
+        codes[start:end] = encode(kind, params, np.asarray(emb[start:end], dtype=np.float32), dim)
+    codes.flush()
+    del codes
+
+    with manifest_path.open("w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "format": COMPACT_FORMAT,
+                "version": COMPACT_VERSION,
+                "kind": kind,
+                "source": Path(emb_path).name,
+                "source_dim": dim,
+                "rows": n,
+                "dim": out_dim,
+            },
+            f,
+            indent=2,
+        )
+    size = sum(p.stat().st_size for p in out.iterdir())
+    print(
+        f"[compact] {kind}: {size / 2**20:,.1f} MiB in {out} "
+        f"(fp16: {n * dim * 2 / 2**20:,.1f} MiB)",
+        file=sys.stderr,
+    )
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Build compact forms of bge_m3_embeddings.dat (int8, trunc<K>, pca<K>, pq<M>) "
+            "that cluster_leader_faiss.py --emb accepts directly."
+        )
+    )
+    parser.add_argument("--emb", required=True, help="bge_m3_embeddings.dat (with its manifest).")
+    parser.add_argument(
+        "--kind",
+        required=True,
+        help="Comma-separated kinds, e.g. int8,pca256,pq64.",
+    )
+    parser.add_argument("--train-rows", type=int, default=TRAIN_ROWS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    kinds = [k.strip() for k in args.kind.split(",") if k.strip()]
+    for kind in kinds:
+        parse_kind(kind)
+    for kind in kinds:
+        out = build_compact(Path(args.emb), kind, args.train_rows, args.seed)
+        print(f"[done] {kind} written to {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import glob
+import gzip
+import io
+import lzma
+import os
+from typing import List, TextIO
+
+
+# Расширения сжатых шардов корпуса
+COMPRESSED_SUFFIXES = (".gz", ".xz", ".lzma", ".zst")
+
+
+def is_compressed(path: str) -> bool:
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+
+def resolve_inputs(spec: str) -> List[str]:
+    """
+    Превращает аргумент -i в отсортированный список файлов:
+      - каталог -> все файлы в нём (без рекурсии);
+      - маска (*, ?, [..]) -> файлы по glob;
+      - иначе -> сам путь.
+    """
+    if os.path.isdir(spec):
+        paths = [
+            os.path.join(spec, name)
+            for name in os.listdir(spec)
+            if os.path.isfile(os.path.join(spec, name))
+        ]
+    elif glob.has_magic(spec):
+        paths = [p for p in glob.glob(spec) if os.path.isfile(p)]
+    else:
+        return [spec]
+
+    if not paths:
+        raise FileNotFoundError(f"no input files match {spec!r}")
+    return sorted(paths)
+
+
+def open_text(path: str) -> TextIO:
+    """
+    Открывает файл корпуса на чтение как текст (utf-8, битые байты пропускаются).
+    .gz / .xz / .lzma / .zst распаковываются на лету.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="ignore")
+    if path.endswith((".xz", ".lzma")):
+        return lzma.open(path, "rt", encoding="utf-8", errors="ignore")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError(
+                f"reading {path} requires the 'zstandard' package (pip install zstandard)"
+            ) from e
+        fh = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(fh, closefd=True)
+        return io.TextIOWrapper(reader, encoding="utf-8", errors="ignore")
+    return open(path, "r", encoding="utf-8", errors="ignore")
@@ -0,0 +1,187 @@
+import fcntl
+import json
+import os
+import sys
+from hashlib import blake2b
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+
+# Content-addressed embedding cache, one directory per model:
+#   keys.u64     uint64[rows]       - 64-bit blake2b of the phrase text, row i <-> key i
+#   vectors.f16  float16[rows, dim] - embeddings, append-only
+#   meta.json    model, backend, dim and the committed row count (written last)
+#   lock         held (flock) by the one process appending to the cache
+# Rows past meta["rows"] (a crash mid-append) are cut off on open.
+
+CACHE_FORMAT = "embedding-cache"
+CACHE_VERSION = 2
+
+
+def phrase_key(phrase: str) -> int:
+    return int.from_bytes(blake2b(phrase.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def phrase_keys(phrases: List[str]) -> np.ndarray:
+    return np.fromiter((phrase_key(p) for p in phrases), dtype=np.uint64, count=len(phrases))
+
+
+class EmbeddingCache:
+    def __init__(self, path, model_name: str, dim: int, backend: str):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.model_name = model_name
+        self.backend = backend
+        self.keys_path = self.path / "keys.u64"
+        self.vectors_path = self.path / "vectors.f16"
+        self.meta_path = self.path / "meta.json"
+
+        # appends are not safe across processes (e.g. parallel --shard runs)
+        self._lock = (self.path / "lock").open("w")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.close()
+            raise RuntimeError(
+                f"{self.path} is in use by another encoder process; "
+                f"give each concurrent run its own --cache-dir"
+            )
+
+        rows = 0
+        if self.meta_path.is_file():
+            with self.meta_path.open("r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("format") != CACHE_FORMAT:
+                raise ValueError(f"{self.path}: not an embedding cache")
+            if meta.get("version") != CACHE_VERSION:
+                # version 1 did not record the backend, so its vectors cannot be
+                # told apart between cuda fp16 and the CPU backends
+                raise ValueError(
+                    f"{self.path}: cache version {meta.get('version')} without a recorded "
+                    f"backend (need version {CACHE_VERSION}); use another --cache-dir"
+                )
+            if (meta["model"], meta["backend"], meta["dim"]) != (model_name, backend, dim):
+                raise ValueError(
+                    f"{self.path}: cache holds {meta['model']} / {meta['backend']} "
+                    f"(dim {meta['dim']}), not {model_name} / {backend} (dim {dim}); "
+                    f"use another --cache-dir"
+                )
+            rows = meta["rows"]
+
+        # drop anything appended after the last commit
+        for p, row_bytes in ((self.keys_path, 8), (self.vectors_path, 2 * dim)):
+            if not p.exists():
+                p.touch()
+            if p.stat().st_size != rows * row_bytes:
+                os.truncate(p, rows * row_bytes)
+
+        self.rows = rows          # rows appended to the files
+        self.reserved = rows      # rows promised to plan() callers
+        self.base_rows = rows
+        keys = np.fromfile(self.keys_path, dtype=np.uint64)
+        # lookup index: keys sorted once per open, searchsorted per buffer
+        self._order = np.argsort(keys, kind="stable")
+        self._sorted = keys[self._order]
+        self._new = {}  # key -> row for rows reserved in this session
+        self._mapped = None
+        self._mapped_rows = -1
+        self._fkeys = self.keys_path.open("ab")
+        self._fvec = self.vectors_path.open("ab")
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Row of every key, -1 if it is not cached.
+        """
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._sorted):
+            pos = np.minimum(np.searchsorted(self._sorted, keys), len(self._sorted) - 1)
+            found = self._sorted[pos] == keys
+            rows[found] = self._order[pos[found]]
+        if self._new:
+            for i in np.flatnonzero(rows < 0).tolist():
+                rows[i] = self._new.get(int(keys[i]), -1)
+        return rows
+
+    def plan(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Cache rows for texts: hits resolve to existing rows, distinct misses
+        get the next free rows reserved. Returns (rows, todo, keys): todo are
+        the positions in texts to encode, and their vectors must be passed
+        to append() together with keys, in the order plan() was called.
+        """
+        keys = phrase_keys(texts)
+        rows = self.lookup(keys)
+        miss = np.flatnonzero(rows < 0)
+        self.hits += len(texts) - len(miss)
+        self.misses += len(miss)
+
+        uniq, first, inverse = np.unique(keys[miss], return_index=True, return_inverse=True)
+        start = self.reserved
+        rows[miss] = start + inverse
+        self.reserved += len(uniq)
+        self._new.update(zip(uniq.tolist(), range(start, self.reserved)))
+        return rows, miss[first], uniq
+
+    def append(self, keys: np.ndarray, vectors: np.ndarray) -> None:
+        self._fkeys.write(np.ascontiguousarray(keys, dtype=np.uint64).tobytes())
+        self._fvec.write(np.ascontiguousarray(vectors, dtype=np.float16).tobytes())
+        self.rows += len(keys)
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        if not len(rows):
+            return np.empty((0, self.dim), dtype=np.float16)
+        if int(rows.max()) >= self._mapped_rows:
+            self._fvec.flush()
+            self._mapped = np.memmap(
+                self.vectors_path, dtype=np.float16, mode="r", shape=(self.rows, self.dim)
+            ) if self.rows else None
+            self._mapped_rows = self.rows
+        return np.asarray(self._mapped[rows])
+
+    def commit(self) -> None:
+        """
+        Make appended rows durable: data first, then meta.json with the new
+        row count (atomic replace), so a crash never exposes a torn row.
+        """
+        for f in (self._fkeys, self._fvec):
+            f.flush()
+            os.fsync(f.fileno())
+        tmp = self.meta_path.with_name(self.meta_path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "format": CACHE_FORMAT,
+                    "version": CACHE_VERSION,
+                    "model": self.model_name,
+                    "backend": self.backend,
+                    "dim": self.dim,
+                    "rows": self.rows,
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp, self.meta_path)
+
+    def close(self) -> None:
+        self.commit()
+        self._fkeys.close()
+        self._fvec.close()
+        self._mapped = None
+        self._lock.close()
+
+    def report(self) -> None:
+        total = self.hits + self.misses
+        size = self.rows * (8 + 2 * self.dim)
+        print(
+            f"[cache] {self.hits:,} hits / {self.misses:,} misses "
+            f"({self.hits / total if total else 0:.1%} hit rate); "
+            f"{self.rows:,} rows ({self.rows - self.base_rows:,} new), "
+            f"{size / 2**30:.2f} GiB in {self.path}",
+            file=sys.stderr,
+        )
@@ -1,143 +1,723 @@
 #!/usr/bin/env python3
 import argparse
+import os
+import queue
 import sys
+import threading
+import time
 from pathlib import Path
 
 import numpy as np
-import torch
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
+from bge_backends import (
+    CPU_BACKENDS,
+    MODEL_NAME,
+    autocast_context,
+    forward_batch,
+    load_model,
+    pad_batch,
+    tokenize_texts,
+)
+from byte_ranges import shard_byte_range
+from compact_embeddings import build_compact, parse_kind
+from embedding_cache import EmbeddingCache
+from encode_state import (
+    STATE_NAME,
+    STATE_VERSION,
+    backend_tag,
+    load_state,
+    parse_shard,
+    save_state,
+    manifest_path,
+    shard_dir,
+    write_manifest,
+)
+from phrase_columns import PhraseColumns, is_columnar, source_stamp
 
-def count_lines(path: Path, progress_step=1_000_000):
-    total = 0
-    with path.open("r", encoding="utf-8", errors="ignore") as f:
-        for _ in f:
-            total += 1
-            if total % progress_step == 0:
-                print(f"[count] {total:,}...", file=sys.stderr)
-    print(f"[count] total lines = {total:,}", file=sys.stderr)
-    return total
+
+def input_slice(path: Path, shard=None):
+    """
+    [start, end) of the input a run covers: byte offsets for TSV (line
+    aligned), row numbers for *.cols. With --shard i/N the i-th of N
+    contiguous slices, so merged shards keep the input order.
+    """
+    if is_columnar(str(path)):
+        n = len(PhraseColumns(str(path)))
+        if shard is None:
+            return 0, n
+        i, count = shard
+        return n * i // count, n * (i + 1) // count
+    if shard is None:
+        return 0, path.stat().st_size
+    return shard_byte_range(str(path), *shard)
+
+
+# на сколько строк (минимум) за раз растёт файл векторов
+GROW_ROWS = 65536
+
+
+class EmbeddingFile:
+    """
+    fp16 (rows, dim) file written through a memmap that grows in chunks as
+    rows arrive (no line count up front) and is truncated to the exact row
+    count by close(), so it never carries zero padding rows.
+    """
+
+    def __init__(self, path: Path, dim: int, resume: bool = False):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * np.dtype("float16").itemsize
+        if not resume:
+            path.write_bytes(b"")
+        self.capacity = path.stat().st_size // self.row_bytes
+        self._map = None
+        self._remap()
+
+    def _remap(self):
+        self._map = np.memmap(
+            self.path, dtype="float16", mode="r+", shape=(self.capacity, self.dim)
+        ) if self.capacity else None
+
+    def write(self, row: int, vectors: np.ndarray) -> None:
+        end = row + len(vectors)
+        if end > self.capacity:
+            self.flush()
+            self._map = None
+            # растём хотя бы на четверть, чтобы число перемапливаний было логарифмическим
+            self.capacity = max(end, self.capacity + max(GROW_ROWS, self.capacity // 4))
+            os.truncate(self.path, self.capacity * self.row_bytes)
+            self._remap()
+        self._map[row:end] = vectors
+
+    def flush(self) -> None:
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self, rows: int) -> None:
+        self.flush()
+        self._map = None
+        os.truncate(self.path, rows * self.row_bytes)
+
+
+def parse_line(raw: bytes):
+    line = raw.decode("utf-8", errors="ignore").rstrip("\r\n")
+    if not line:
+        return None
+
+    # file is of format "phrase<TAB>count"
+    try:
+        phrase, count_str = line.rsplit("\t", 1)
+        return phrase, int(count_str)
+    except ValueError:
+        return None
+
+
+def iter_input(path: Path, start: int = 0, end: int = None):
+    """
+    Yield (position, item) for every input row in [start, end), where item
+    is (phrase, freq) or None for a malformed TSV line (it still counts
+    towards line_idx) and position is where the next row begins: a byte
+    offset for TSV, a row number for *.cols. Passing a saved position back
+    as `start` continues right after that row.
+    """
+    if is_columnar(str(path)):
+        cols = PhraseColumns(str(path))
+        end = len(cols) if end is None else end
+        counts = np.asarray(cols["count"][start:end]).tolist()
+        phrases = cols.iter_phrases(np.arange(start, end))
+        for pos, item in enumerate(zip(phrases, counts), start + 1):
+            yield pos, item
+        return
+
+    with path.open("rb") as fin:
+        fin.seek(start)
+        pos = start
+        for raw in fin:
+            if end is not None and pos >= end:
+                break
+            pos += len(raw)
+            yield pos, parse_line(raw)
+
+
+def iter_phrase_freqs(path: Path):
+    """
+    Yield (phrase, freq) for every input row, or None for a malformed
+    TSV line (it still counts towards line_idx).
+    """
+    for _, item in iter_input(path):
+        yield item
+
+
+def plan_batches(lengths: np.ndarray, batch_size: int, token_budget: int) -> list:
+    """
+    Sort a look-ahead buffer by token length and cut it into batches of
+    similar length, so each batch is padded only to its own longest text.
+    With token_budget > 0 a batch grows while batch_len * max_len stays
+    within the budget (short phrases -> big batches), otherwise it holds
+    batch_size texts. Returns index arrays into the buffer.
+    """
+    order = np.argsort(lengths, kind="stable")
+    batches = []
+    start = 0
+    while start < len(order):
+        if token_budget > 0:
+            end = start + 1
+            # lengths are ascending, so the batch max is the last element
+            while end < len(order) and (end + 1 - start) * lengths[order[end]] <= token_budget:
+                end += 1
+        else:
+            end = min(start + batch_size, len(order))
+        batches.append(order[start:end])
+        start = end
+    return batches
+
+
+def buffer_batches(model, texts: list, args):
+    """
+    Tokenize a buffer once and plan its batches: (input_ids of every text,
+    index arrays of the batches) — length buckets with --lookahead,
+    otherwise the buffer itself (--batch-size texts in file order).
+    The same ids give the bucket lengths and, padded, the batch inputs.
+    """
+    ids = tokenize_texts(model, texts)
+    if args.lookahead <= 0:
+        return ids, [np.arange(len(texts))]
+    lengths = np.fromiter(map(len, ids), dtype=np.int64, count=len(ids))
+    return ids, plan_batches(lengths, args.batch_size, args.token_budget)
+
+
+def tokenize_batch(model, ids: list, idx: np.ndarray):
+    """
+    Model inputs for the texts idx of a tokenized buffer plus (real, padded)
+    token counts for the padding report.
+    """
+    features = pad_batch(model, [ids[i] for i in idx])
+    mask = features["attention_mask"]
+    return features, int(mask.sum()), int(mask.numel())
+
+
+def encode_buffer(model, texts: list, args, padding_stats: list, device: str = "cuda") -> np.ndarray:
+    """
+    Encode a buffer of texts on the calling thread and return fp16 vectors
+    in the buffer's original order; vectors of each length bucket are
+    scattered back to their source positions. main() runs the same steps
+    as a pipeline (see run_pipeline).
+    """
+    out = None
+    ids, batches = buffer_batches(model, texts, args)
+    for idx in batches:
+        features, real, padded = tokenize_batch(model, ids, idx)
+        vectors = forward_batch(model, features, device)
+        if out is None:
+            out = np.empty((len(texts), vectors.shape[1]), dtype="float16")
+        out[idx] = vectors
+        padding_stats[0] += real
+        padding_stats[1] += padded
+    return out
+
+
+def read_buffers(path: Path, offset: int, end: int, line_idx: int, max_lines: int, buffer_size: int):
+    """
+    Yield buffers of up to buffer_size phrases from input positions
+    [offset, end), stopping after max_lines input lines if max_lines > 0:
+    dicts with texts, meta rows (phrase, freq, n_words) and the
+    line_idx / offset right after the buffer's last line (its checkpoint).
+    """
+    texts, meta = [], []
+    start_lines = line_idx
+    for pos, item in iter_input(path, offset, end):
+        if max_lines > 0 and line_idx >= max_lines:
+            break
+        line_idx += 1
+        offset = pos
+
+        if item is None:
+            # пустая или битая строка — пропускаем, но line_idx уже учтён
+            continue
+        phrase, freq = item
+        texts.append(phrase)
+        meta.append((phrase, freq, len(phrase.split())))
+
+        if len(texts) >= buffer_size:
+            yield {"texts": texts, "meta": meta, "lines": line_idx, "offset": offset}
+            texts, meta = [], []
+            start_lines = line_idx
+
+    # final incomplete buffer; also carries the position of trailing skipped lines
+    if line_idx > start_lines:
+        yield {"texts": texts, "meta": meta, "lines": line_idx, "offset": offset}
+
+
+class Stage:
+    """
+    Time accounting of one pipeline stage: busy doing its own work,
+    starved (waiting for input) and blocked (waiting for room downstream).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def report(self, wall: float) -> str:
+        def pct(t):
+            return f"{t:8.1f}s {t / wall if wall else 0:6.1%}"
+
+        return (
+            f"[pipeline] {self.name:<14} busy {pct(self.busy)} | "
+            f"starved {pct(self.starved)} | blocked {pct(self.blocked)}"
+        )
+
+
+QUEUE_POLL_SEC = 0.5
+
+
+def run_pipeline(model, args, buffers, cache, write_buffer, padding_stats) -> list:
+    """
+    Three overlapped stages joined by bounded queues (--queue-depth batches):
+      read+tokenize  reads buffers, cache lookups, one tokenizer call per buffer,
+                     length buckets, padded batch inputs
+      model          forward passes only (own autocast: it is thread-local)
+      write          scatters buckets back, cache appends, write_buffer()
+    The first two run on worker threads, write on the calling thread.
+    Tokenizer and model both release the GIL, so they really overlap.
+    Returns the stages for the utilization report.
+    """
+    reader, encoder, writer = Stage("read+tokenize"), Stage("model"), Stage("write")
+    tokenized_q = queue.Queue(maxsize=args.queue_depth)
+    encoded_q = queue.Queue(maxsize=args.queue_depth)
+    failed = threading.Event()
+    errors = []
+
+    def put(q, item, stage):
+        # очередь ограничена: ждём места, пока соседние стадии живы
+        t0 = time.perf_counter()
+        while not failed.is_set():
+            try:
+                q.put(item, timeout=QUEUE_POLL_SEC)
+                break
+            except queue.Full:
+                continue
+        stage.blocked += time.perf_counter() - t0
+
+    def get(q, stage):
+        t0 = time.perf_counter()
+        while True:
+            try:
+                item = q.get(timeout=QUEUE_POLL_SEC)
+                break
+            except queue.Empty:
+                if failed.is_set():
+                    raise RuntimeError("pipeline stage failed")
+        stage.starved += time.perf_counter() - t0
+        return item
+
+    def read_stage():
+        try:
+            it = iter(buffers)
+            while not failed.is_set():
+                t0 = time.perf_counter()
+                buf = next(it, None)
+                if buf is None:
+                    reader.busy += time.perf_counter() - t0
+                    break
+                texts = buf["texts"]
+                if cache is not None:
+                    buf["rows"], todo, buf["keys"] = cache.plan(texts)
+                    todo_texts = [texts[i] for i in todo.tolist()]
+                else:
+                    todo_texts = texts
+                buf["todo"] = len(todo_texts)
+                ids, batches = buffer_batches(model, todo_texts, args) if todo_texts else ([], [])
+                reader.busy += time.perf_counter() - t0
+
+                for idx in batches:
+                    t0 = time.perf_counter()
+                    features, real, padded = tokenize_batch(model, ids, idx)
+                    padding_stats[0] += real
+                    padding_stats[1] += padded
+                    reader.busy += time.perf_counter() - t0
+                    put(tokenized_q, ("batch", idx, features), reader)
+                put(tokenized_q, ("end", buf), reader)
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+        finally:
+            put(tokenized_q, None, reader)
+
+    def model_stage():
+        try:
+            with autocast_context(args.device):
+                while True:
+                    item = get(tokenized_q, encoder)
+                    if item is None:
+                        break
+                    if item[0] == "batch":
+                        t0 = time.perf_counter()
+                        vectors = forward_batch(model, item[2], args.device)
+                        encoder.busy += time.perf_counter() - t0
+                        item = ("batch", item[1], vectors)
+                    put(encoded_q, item, encoder)
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+        finally:
+            put(encoded_q, None, encoder)
+
+    threads = [
+        threading.Thread(target=read_stage, name="read+tokenize", daemon=True),
+        threading.Thread(target=model_stage, name="model", daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    try:
+        parts = []
+        while True:
+            item = get(encoded_q, writer)
+            if item is None:
+                break
+            t0 = time.perf_counter()
+            if item[0] == "batch":
+                parts.append(item[1:])
+            else:
+                buf = item[1]
+                out = np.empty((buf["todo"], model.get_sentence_embedding_dimension()), dtype="float16")
+                for idx, vectors in parts:
+                    out[idx] = vectors
+                parts = []
+                if cache is not None:
+                    cache.append(buf["keys"], out)
+                    out = cache.vectors(buf["rows"])
+                write_buffer(buf, out)
+            writer.busy += time.perf_counter() - t0
+    except BaseException as e:
+        errors.append(e)
+        failed.set()
+    finally:
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    return [reader, encoder, writer]
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Encode phrases using BGE-M3 (1024-dim, fp16)"
     )
-    parser.add_argument("-i", "--input", required=True)
+    parser.add_argument(
+        "-i", "--input",
+        required=True,
+        help="phrase<TAB>count TSV or a columnar *.cols directory (phrase_columns.py).",
+    )
     parser.add_argument("-d", "--out-dir", required=True)
     parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=16384,
+        help=(
+            "Phrases buffered before encoding; each buffer is sorted by token length "
+            "and encoded in length buckets, rows are written back in input order. "
+            "0 = encode in file order, --batch-size phrases at a time."
+        ),
+    )
+    parser.add_argument(
+        "--token-budget",
+        type=int,
+        default=0,
+        help=(
+            "With --lookahead: size batches by padded tokens (batch_len * max_len "
+            "<= budget) instead of a fixed --batch-size. 0 = off."
+        ),
+    )
+    parser.add_argument(
+        "--device",
+        choices=("cuda", "cpu"),
+        default="cuda",
+        help="cuda = torch fp16 on the GPU (default); cpu = --cpu-backend with thread tuning.",
+    )
+    parser.add_argument(
+        "--cpu-backend",
+        choices=CPU_BACKENDS,
+        default="torch-int8",
+        help=(
+            "With --device cpu: torch-int8 (dynamic int8 quantization of Linear layers), "
+            "torch (fp32) or onnx (ONNX Runtime, needs optimum[onnxruntime])."
+        ),
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=0,
+        help="With --device cpu: threads inside one op (0 = library default, usually all cores).",
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=0,
+        help="With --device cpu: threads running independent ops in parallel (0 = library default).",
+    )
     parser.add_argument("--max-lines", type=int, default=0)
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=4,
+        help=(
+            "Commit a checkpoint (flush memmap + meta, then rewrite bge_m3_state.json) "
+            "every N encoded buffers (--lookahead phrases, or --batch-size with "
+            "--lookahead 0). 0 = only at the end."
+        ),
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=8,
+        help=(
+            "Batches held between pipeline stages (read+tokenize -> model -> write); "
+            "bounds the memory of tokenized inputs and encoded vectors in flight."
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help=(
+            "Persistent embedding cache keyed by phrase text (embedding_cache.py): "
+            "only phrases missing from it are encoded, new vectors are appended. "
+            "Reuse the same directory across runs with different upstream filters; "
+            "a cache is tied to one backend (cuda fp16 or one --cpu-backend)."
+        ),
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help=(
+            "i/N (0 <= i < N): encode only the i-th of N contiguous input slices into "
+            "<out-dir>/shard-iiii-of-NNNN/ (restartable with --resume like a full run); "
+            "merge_bge_shards.py stitches finished shards into <out-dir>."
+        ),
+    )
+    parser.add_argument(
+        "--compact",
+        help=(
+            "After encoding, also write compact forms next to the .dat "
+            "(compact_embeddings.py kinds, comma-separated: int8, trunc<K>, pca<K>, pq<M>); "
+            "cluster_leader_faiss.py --emb accepts them directly."
+        ),
+    )
+    parser.add_argument(
+        "--compact-only",
+        action="store_true",
+        help="With --compact: delete the fp16 .dat (and its manifest) once the compact forms are written.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Continue an interrupted run in --out-dir from its last checkpoint: "
+            "the input is seeked to the saved offset, rows after the checkpoint are re-encoded."
+        ),
+    )
     args = parser.parse_args()
+    if args.shard is not None and args.max_lines > 0:
+        parser.error("--max-lines cannot be combined with --shard")
+    compact_kinds = [k.strip() for k in (args.compact or "").split(",") if k.strip()]
+    for kind in compact_kinds:
+        try:
+            parse_kind(kind)
+        except ValueError as e:
+            parser.error(str(e))
+    if compact_kinds and args.shard is not None:
+        parser.error("--compact needs the whole file: run compact_embeddings.py after merge_bge_shards.py")
+    if args.compact_only and not compact_kinds:
+        parser.error("--compact-only requires --compact")
 
     in_path = Path(args.input)
     out_dir = Path(args.out_dir)
+    if args.shard is not None:
+        out_dir = shard_dir(out_dir, args.shard)
     out_dir.mkdir(parents=True, exist_ok=True)
+    slice_start, slice_end = input_slice(in_path, args.shard)
+    if args.shard is not None:
+        print(
+            f"[info] shard {args.shard[0]}/{args.shard[1]}: input [{slice_start:,}, {slice_end:,}) "
+            f"-> {out_dir}",
+            file=sys.stderr,
+        )
 
-    # ---------------------------
-    # 1. Count phrases (по строкам файла)
-    # ---------------------------
-    total_lines = count_lines(in_path)
-    if args.max_lines > 0 and args.max_lines < total_lines:
-        total_lines = args.max_lines
-        print(f"[info] truncating to {total_lines:,} lines", file=sys.stderr)
+    emb_path = out_dir / "bge_m3_embeddings.dat"
+    meta_path = out_dir / "bge_m3_meta.tsv"
+    state_path = out_dir / STATE_NAME
+    input_stamp = source_stamp(str(in_path))
+
+    state = load_state(state_path) if args.resume else None
+    if args.resume and state is None:
+        print(f"[info] no checkpoint in {out_dir}, starting from scratch", file=sys.stderr)
+    if state is not None:
+        if state.get("version") != STATE_VERSION or state.get("input_stamp") != input_stamp:
+            sys.exit(
+                f"[error] {state_path} was written for a different input or encoder version; "
+                f"rerun without --resume"
+            )
+        if state.get("shard") != (list(args.shard) if args.shard else None):
+            sys.exit(f"[error] checkpoint was made for shard {state.get('shard')}")
+        if state.get("max_lines", 0) != args.max_lines:
+            sys.exit(f"[error] checkpoint was made with --max-lines {state.get('max_lines', 0)}")
+        if state.get("done"):
+            print(f"[done] {out_dir} is already complete ({state['rows']:,} rows)", file=sys.stderr)
+            return
+        # вектора разных бэкендов в одном .dat не смешиваются
+        encoded_on = backend_tag(state.get("device"), state.get("cpu_backend"))
+        if encoded_on != backend_tag(args.device, args.cpu_backend):
+            flags = f"--device {state.get('device')}"
+            if state.get("device") != "cuda":
+                flags += f" --cpu-backend {state.get('cpu_backend')}"
+            sys.exit(
+                f"[error] checkpoint was encoded on {encoded_on}; resume with {flags} "
+                f"or rerun without --resume"
+            )
 
     # ---------------------------
-    # 2. Load model
+    # 1. Load model
     # ---------------------------
-    print("[info] loading BGE-M3...", file=sys.stderr)
-    model = SentenceTransformer("BAAI/bge-m3")
-    model = model.to("cuda")
+    model = load_model(
+        args.device, args.cpu_backend, args.intra_op_threads, args.inter_op_threads
+    )
     dim = model.get_sentence_embedding_dimension()
     print(f"[info] embedding dim = {dim}", file=sys.stderr)
+    # вектора cuda fp16 и CPU-бэкендов в одном кэше не смешиваются
+    backend = backend_tag(args.device, args.cpu_backend)
+    cache = EmbeddingCache(args.cache_dir, MODEL_NAME, dim, backend) if args.cache_dir else None
+    if cache is not None:
+        print(f"[cache] {cache.rows:,} cached vectors in {args.cache_dir}", file=sys.stderr)
 
     # ---------------------------
-    # 3. Prepare memmap
+    # 2. Prepare output files (без предварительного подсчёта строк:
+    #    файл векторов растёт по мере записи)
     # ---------------------------
-    emb_path = out_dir / "bge_m3_embeddings.dat"
-    meta_path = out_dir / "bge_m3_meta.tsv"
-
-    # резервируем по числу строк файла (может оказаться чуть с запасом,
-    # если какие-то строки будут пропущены)
-    emb = np.memmap(
-        emb_path, dtype="float16", mode="w+", shape=(total_lines, dim)
-    )
+    if state is not None:
+        if state["dim"] != dim:
+            sys.exit(f"[error] checkpoint dim {state['dim']} != model dim {dim}")
+        # строки после чекпоинта перезапишутся, хвост meta отрезаем
+        emb = EmbeddingFile(emb_path, dim, resume=True)
+        os.truncate(meta_path, state["meta_bytes"])
+        line_idx = state["lines_read"]
+        row = state["rows"]
+        offset = state["input_offset"]
+        print(
+            f"[info] resuming at row {row:,} (line {line_idx:,}, input offset {offset:,})",
+            file=sys.stderr,
+        )
+    else:
+        if state_path.exists():
+            state_path.unlink()
+        emb = EmbeddingFile(emb_path, dim)
+        meta_path.write_bytes(b"")
+        line_idx = 0      # сколько строк файла прочитали
+        row = 0           # сколько фраз реально закодировали
+        offset = slice_start  # позиция во входе сразу после строки line_idx
 
     # ---------------------------
-    # 4. Streaming encoding FP16
+    # 3. Streaming encoding (stored as FP16 on every device)
     # ---------------------------
-    line_idx = 0          # сколько строк файла прочитали
-    row = 0               # сколько фраз реально закодировали
-    batch_texts = []
-    batch_meta = []
-
-    with in_path.open("r", encoding="utf-8", errors="ignore") as fin, \
-            meta_path.open("w", encoding="utf-8") as fmeta, \
-            torch.autocast("cuda", dtype=torch.float16):
+    buffer_size = args.lookahead if args.lookahead > 0 else args.batch_size
+    padding_stats = [0, 0]  # real tokens, padded tokens
+    buffers_since_checkpoint = 0
 
-        progress = tqdm(total=total_lines, desc="encoding", unit="line")
+    with meta_path.open("a", encoding="utf-8") as fmeta:
 
-        for line in fin:
-            if line_idx >= total_lines:
-                break
-            line_idx += 1
-            progress.update(1)
+        def checkpoint(done=False):
+            # сначала данные на диск, потом атомарная замена состояния
+            if cache is not None:
+                cache.commit()
+            emb.flush()
+            fmeta.flush()
+            os.fsync(fmeta.fileno())
+            save_state(state_path, {
+                "version": STATE_VERSION,
+                "input": str(in_path),
+                "input_stamp": input_stamp,
+                "max_lines": args.max_lines,
+                "shard": list(args.shard) if args.shard else None,
+                "input_end": slice_end,
+                "dim": dim,
+                "device": args.device,
+                "cpu_backend": args.cpu_backend,
+                "rows": row,
+                "lines_read": line_idx,
+                "input_offset": offset,
+                "meta_bytes": os.fstat(fmeta.fileno()).st_size,
+                "done": done,
+            })
 
-            line = line.rstrip("\n")
-            if not line:
-                continue
+        def write_buffer(buf, vectors):
+            nonlocal row, line_idx, offset, buffers_since_checkpoint
+            emb.write(row, vectors)
 
-            # file is of format "phrase<TAB>count"
-            try:
-                phrase, count_str = line.rsplit("\t", 1)
-                freq = int(count_str)
-            except ValueError:
-                # битая строка — пропускаем, но line_idx уже учтён
-                continue
-
-            batch_texts.append(phrase)
-            batch_meta.append((phrase, freq, len(phrase.split())))
-
-            if len(batch_texts) >= args.batch_size:
-                vectors = model.encode(
-                    batch_texts,
-                    batch_size=args.batch_size,
-                    convert_to_numpy=True,
-                    normalize_embeddings=True,
-                ).astype("float16")
-
-                n = vectors.shape[0]
-                emb[row:row + n, :] = vectors
-
-                for phr, fr, ln in batch_meta:
-                    fmeta.write(f"{row}\t{phr}\t{fr}\t{ln}\n")
-                    row += 1
-
-                batch_texts.clear()
-                batch_meta.clear()
-
-        # Final incomplete batch
-        if batch_texts:
-            vectors = model.encode(
-                batch_texts,
-                batch_size=len(batch_texts),
-                convert_to_numpy=True,
-                normalize_embeddings=True,
-            ).astype("float16")
-
-            n = vectors.shape[0]
-            emb[row:row + n, :] = vectors
-            for phr, fr, ln in batch_meta:
+            for phr, fr, ln in buf["meta"]:
                 fmeta.write(f"{row}\t{phr}\t{fr}\t{ln}\n")
                 row += 1
 
+            progress.update(buf["offset"] - offset)
+            line_idx, offset = buf["lines"], buf["offset"]
+
+            buffers_since_checkpoint += 1
+            if args.checkpoint_every > 0 and buffers_since_checkpoint >= args.checkpoint_every:
+                checkpoint()
+                buffers_since_checkpoint = 0
+
+        # прогресс — по позиции во входе (байты TSV или строки *.cols)
+        progress = tqdm(
+            total=slice_end - slice_start,
+            initial=offset - slice_start,
+            desc="encoding",
+            unit="row" if is_columnar(str(in_path)) else "B",
+            unit_scale=True,
+        )
+        t0 = time.perf_counter()
+        stages = run_pipeline(
+            model,
+            args,
+            read_buffers(in_path, offset, slice_end, line_idx, args.max_lines, buffer_size),
+            cache,
+            write_buffer,
+            padding_stats,
+        )
+        wall = time.perf_counter() - t0
         progress.close()
+        # точный размер .dat, потом манифест, потом состояние "готово"
+        emb.close(row)
+        write_manifest(
+            emb_path, row, dim, model=MODEL_NAME, backend=backend, meta=meta_path.name
+        )
+        checkpoint(done=True)
+
+    if cache is not None:
+        cache.close()
+        cache.report()
 
-    del emb
     print(f"[done] embeddings saved to {emb_path}", file=sys.stderr)
     print(f"[done] meta saved to      {meta_path}", file=sys.stderr)
     print(f"[done] encoded rows:      {row:,}", file=sys.stderr)
     print(f"[info] total lines read:  {line_idx:,}", file=sys.stderr)
+    if padding_stats[1]:
+        print(
+            f"[info] padding: {padding_stats[0]:,} real / {padding_stats[1]:,} padded tokens "
+            f"({padding_stats[0] / padding_stats[1]:.1%} useful)",
+            file=sys.stderr,
+        )
+    for stage in stages:
+        print(stage.report(wall), file=sys.stderr)
+
+    for kind in compact_kinds:
+        build_compact(emb_path, kind)
+    if args.compact_only:
+        manifest_path(emb_path).unlink()
+        emb_path.unlink()
+        print(f"[info] removed fp16 {emb_path}, keeping compact forms", file=sys.stderr)
 
 
 if __name__ == "__main__":
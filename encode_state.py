@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+
+# Состояние прогона encode_bge_m3.py в его --out-dir (или каталоге шарда):
+# последний закоммиченный буфер — строки, позиция во входе, размер meta.
+# Отдельно от энкодера, чтобы merge_bge_shards.py работал без torch.
+STATE_NAME = "bge_m3_state.json"
+STATE_VERSION = 2
+
+# Манифест готовых векторов рядом с .dat: число строк, dim и dtype,
+# чтобы кластеризация и агрегация не угадывали N по размеру файла.
+MANIFEST_FORMAT = "embeddings"
+MANIFEST_VERSION = 1
+
+# dim прогонов без манифеста (прежнее значение --dim по умолчанию, BGE-M3)
+LEGACY_DIM = 1024
+
+
+def load_state(path: Path):
+    if not path.is_file():
+        return None
+    with path.open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def backend_tag(device: str, cpu_backend: str) -> str:
+    """
+    Which numerics produced the vectors: "cuda-fp16", "cpu-torch-int8", ...
+    Vectors of different tags must not be mixed in one output.
+    """
+    return "cuda-fp16" if device == "cuda" else f"cpu-{cpu_backend}"
+
+
+def parse_shard(value: str):
+    try:
+        i, n = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {n}), got {i}")
+    return i, n
+
+
+def shard_dir(out_dir: Path, shard) -> Path:
+    i, n = shard
+    return out_dir / f"shard-{i:04d}-of-{n:04d}"
+
+
+def save_state(path: Path, state: dict) -> None:
+    """
+    Atomic replace: the state file always describes a fully flushed prefix
+    of the memmap and meta, so a crash at any point resumes from the last
+    complete checkpoint.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def manifest_path(emb_path: Path) -> Path:
+    return Path(emb_path).with_suffix(".json")
+
+
+def write_manifest(emb_path: Path, rows: int, dim: int, dtype: str = "float16", **info) -> None:
+    """
+    Written after the .dat is complete (truncated to rows * dim).
+    """
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "version": MANIFEST_VERSION,
+        "data": Path(emb_path).name,
+        "rows": rows,
+        "dim": dim,
+        "dtype": dtype,
+    }
+    manifest.update(info)
+    save_state(manifest_path(emb_path), manifest)
+
+
+def read_manifest(emb_path: Path):
+    """
+    Manifest of emb_path, None for runs that predate manifests. Raises if
+    the .dat does not hold exactly rows * dim values (unfinished or padded).
+    """
+    path = manifest_path(emb_path)
+    if not path.is_file():
+        return None
+    manifest = load_state(path)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise ValueError(f"{path}: not an embeddings manifest")
+    expected = manifest["rows"] * manifest["dim"] * np.dtype(manifest["dtype"]).itemsize
+    actual = Path(emb_path).stat().st_size
+    if actual != expected:
+        raise ValueError(
+            f"{emb_path}: {actual:,} bytes, manifest says {manifest['rows']:,} x "
+            f"{manifest['dim']} {manifest['dtype']} ({expected:,} bytes)"
+        )
+    return manifest
+
+
+def open_embeddings(emb_path: Path, dim: int = None) -> np.memmap:
+    """
+    (N, dim) memmap of an embeddings file: shape and dtype from its manifest,
+    or for old runs without one N from the file size and dim (default
+    LEGACY_DIM; zero rows of an over-allocated file then count as vectors).
+    """
+    manifest = read_manifest(emb_path)
+    if manifest is not None:
+        if dim is not None and dim != manifest["dim"]:
+            raise ValueError(f"--dim {dim} does not match manifest dim {manifest['dim']}")
+        n, dim, dtype = manifest["rows"], manifest["dim"], manifest["dtype"]
+    else:
+        dim = dim or LEGACY_DIM
+        dtype = "float16"
+        n = Path(emb_path).stat().st_size // (np.dtype(dtype).itemsize * dim)
+        print(
+            f"[warn] no manifest for {emb_path}; N = {n:,} inferred from file size "
+            f"with dim {dim}",
+            file=sys.stderr,
+        )
+    print(f"[info] memmap: {n:,} x {dim} ({dtype})", file=sys.stderr)
+    return np.memmap(emb_path, mode="r", dtype=dtype, shape=(n, dim))
@@ -2,42 +2,19 @@
 import argparse
 import sys
 
+import numpy as np
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Удалить фразы, у которых количество < MIN_COUNT."
-    )
-    parser.add_argument(
-        "-i", "--input",
-        required=True,
-        help="Входной файл частотного словаря: phrase<TAB>count",
-    )
-    parser.add_argument(
-        "-o", "--output",
-        required=True,
-        help="Файл для записи отфильтрованного словаря.",
-    )
-    parser.add_argument(
-        "--min-count",
-        type=int,
-        default=5,
-        help="Минимальное количество вхождений. По умолчанию 5.",
-    )
-    parser.add_argument(
-        "--progress-interval",
-        type=int,
-        default=1_000_000,
-        help="Как часто показывать прогресс по строкам.",
-    )
+from phrase_columns import PhraseColumns, is_columnar, open_phrase_writer, write_subset
+from stage_stats import StageStats
 
-    args = parser.parse_args()
 
+def filter_tsv(args, stats: StageStats):
     kept = 0
     total = 0
     next_progress = args.progress_interval
 
     with open(args.input, "r", encoding="utf-8", errors="ignore") as fin, \
-         open(args.output, "w", encoding="utf-8") as fout:
+         open_phrase_writer(args.output, {"count": "int64"}, stats) as fout:
 
         for line in fin:
             total += 1
@@ -59,9 +36,55 @@ def main():
                 continue
 
             if count >= args.min_count:
-                fout.write(line + "\n")
+                fout.write(phrase, count)
                 kept += 1
 
+        stats.info["lines_in"] = total
+
+    return kept, total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Удалить фразы, у которых количество < MIN_COUNT."
+    )
+    parser.add_argument(
+        "-i", "--input",
+        required=True,
+        help="Входной файл частотного словаря: phrase<TAB>count или каталог *.cols.",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        required=True,
+        help="Файл для записи отфильтрованного словаря (*.cols — колоночный формат).",
+    )
+    parser.add_argument(
+        "--min-count",
+        type=int,
+        default=5,
+        help="Минимальное количество вхождений. По умолчанию 5.",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=int,
+        default=1_000_000,
+        help="Как часто показывать прогресс по строкам.",
+    )
+
+    args = parser.parse_args()
+
+    stats = StageStats("filter_min_count", input=args.input, min_count=args.min_count)
+
+    if is_columnar(args.input):
+        # фильтр — одна маска по столбцу count, без разбора строк
+        cols = PhraseColumns(args.input)
+        total = len(cols)
+        stats.info["lines_in"] = total
+        keep = np.flatnonzero(np.asarray(cols["count"]) >= args.min_count)
+        kept = write_subset(cols, args.output, keep, stats=stats)
+    else:
+        kept, total = filter_tsv(args, stats)
+
     print(f"[done] total lines processed: {total:,}", file=sys.stderr)
     print(f"[done] kept phrases: {kept:,}", file=sys.stderr)
     print(f"[done] removed: {total - kept:,}", file=sys.stderr)
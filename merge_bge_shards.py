@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import argparse
+import re
+import sys
+from pathlib import Path
+
+from encode_state import (
+    STATE_NAME,
+    backend_tag,
+    load_state,
+    read_manifest,
+    shard_dir,
+    write_manifest,
+)
+
+
+SHARD_RE = re.compile(r"^shard-(\d+)-of-(\d+)$")
+
+# bytes per read/write when concatenating shard embeddings
+COPY_BLOCK = 64 * 1024 * 1024
+
+
+def find_shards(out_dir: Path) -> int:
+    """
+    Shard count N from the shard-iiii-of-NNNN directories in out_dir.
+    """
+    counts = {int(m.group(2)) for p in out_dir.iterdir() if (m := SHARD_RE.match(p.name))}
+    if not counts:
+        sys.exit(f"[error] no shard-*-of-* directories in {out_dir}")
+    if len(counts) > 1:
+        sys.exit(f"[error] shards of different runs in {out_dir}: N = {sorted(counts)}")
+    return counts.pop()
+
+
+def check_shards(out_dir: Path, n: int):
+    """
+    States of all N shards and the model / backend they share; every shard
+    must be finished and encoded from the same input with the same dim,
+    model and backend (vectors of cuda fp16 and CPU backends differ).
+    """
+    states = []
+    models = []
+    for i in range(n):
+        d = shard_dir(out_dir, (i, n))
+        state = load_state(d / STATE_NAME)
+        if state is None:
+            sys.exit(f"[error] shard {i}/{n} has not started ({d})")
+        if not state.get("done"):
+            sys.exit(
+                f"[error] shard {i}/{n} is incomplete ({state['rows']:,} rows so far); "
+                f"finish it with --shard {i}/{n} --resume"
+            )
+        try:
+            manifest = read_manifest(d / "bge_m3_embeddings.dat")
+        except ValueError as e:
+            sys.exit(f"[error] shard {i}/{n}: {e}")
+        states.append(state)
+        models.append(manifest.get("model") if manifest else None)
+
+    first = states[0]
+    backend = backend_tag(first.get("device"), first.get("cpu_backend"))
+    for i, state in enumerate(states):
+        if state["input_stamp"] != first["input_stamp"] or state["dim"] != first["dim"]:
+            sys.exit(f"[error] shard {i}/{n} was encoded from a different input or model")
+        if models[i] != models[0]:
+            sys.exit(
+                f"[error] shard {i}/{n} was encoded with {models[i]}, shard 0 with {models[0]}"
+            )
+        shard_backend = backend_tag(state.get("device"), state.get("cpu_backend"))
+        if shard_backend != backend:
+            sys.exit(
+                f"[error] shard {i}/{n} was encoded on {shard_backend}, shard 0 on {backend}; "
+                f"re-encode it with the same --device / --cpu-backend"
+            )
+    return states, models[0], backend
+
+
+def copy_prefix(src: Path, fout, nbytes: int) -> None:
+    """
+    First nbytes of src appended to fout, block by block; nbytes is the
+    shard's rows * dim from its checkpoint, so a shard .dat that is shorter
+    fails here instead of silently shifting the rows after it.
+    """
+    with src.open("rb") as fin:
+        while nbytes > 0:
+            data = fin.read(min(COPY_BLOCK, nbytes))
+            if not data:
+                raise RuntimeError(f"{src} is shorter than its checkpoint says")
+            fout.write(data)
+            nbytes -= len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Stitch finished encode_bge_m3.py --shard i/N runs into the canonical "
+            "bge_m3_embeddings.dat and bge_m3_meta.tsv (rows in input order)"
+        )
+    )
+    parser.add_argument(
+        "-d", "--out-dir",
+        required=True,
+        help="--out-dir the shards were encoded with (holds the shard-*-of-* directories).",
+    )
+    args = parser.parse_args()
+
+    out_dir = Path(args.out_dir)
+    n = find_shards(out_dir)
+    states, model, backend = check_shards(out_dir, n)
+    dim = states[0]["dim"]
+    total = sum(s["rows"] for s in states)
+    print(f"[info] merging {n} shards, {total:,} rows, dim {dim}", file=sys.stderr)
+
+    emb_path = out_dir / "bge_m3_embeddings.dat"
+    meta_path = out_dir / "bge_m3_meta.tsv"
+    base = 0
+    with emb_path.open("wb") as femb, meta_path.open("wb") as fmeta:
+        for i, state in enumerate(states):
+            d = shard_dir(out_dir, (i, n))
+            rows = state["rows"]
+            copy_prefix(d / "bge_m3_embeddings.dat", femb, rows * dim * 2)
+
+            # shard rows are numbered from 0; shift them to global row ids
+            written = 0
+            with (d / "bge_m3_meta.tsv").open("rb") as fin:
+                for line in fin:
+                    row, rest = line.split(b"\t", 1)
+                    fmeta.write(b"%d\t" % (base + int(row)))
+                    fmeta.write(rest)
+                    written += 1
+            if written != rows:
+                sys.exit(f"[error] {d}: meta has {written:,} rows, checkpoint says {rows:,}")
+
+            print(f"[merge] shard {i}/{n}: rows [{base:,}, {base + rows:,})", file=sys.stderr)
+            base += rows
+
+    write_manifest(
+        emb_path, total, dim, model=model, backend=backend, meta=meta_path.name, shards=n
+    )
+
+    print(f"[done] embeddings saved to {emb_path}", file=sys.stderr)
+    print(f"[done] meta saved to      {meta_path}", file=sys.stderr)
+    print(f"[done] merged rows:       {total:,}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
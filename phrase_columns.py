@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+# Колоночный формат обмена между шагами пайплайна — каталог <name>.cols:
+#   meta.json            {"format", "version", "rows", "columns": {name: dtype}}
+#   phrase.heap          все фразы подряд в utf-8 (куча строк)
+#   phrase.offsets.npy   int64[rows + 1]: фраза i = heap[off[i]:off[i + 1]]
+#   <column>.npy         числовые столбцы (count, length, cluster_id, ...)
+# Всё открывается через mmap, поэтому загрузка миллионов строк мгновенна.
+# meta.json пишется последним: каталог без него считается недописанным.
+
+FORMAT = "phrase-columns"
+VERSION = 1
+SUFFIX = ".cols"
+
+# dtype столбца -> typecode array.array для потоковой записи
+TYPECODES = {"int32": "i", "int64": "q", "float32": "f", "float64": "d"}
+
+# Сколько строк за раз собирает write_subset при копировании кучи
+TAKE_BLOCK_ROWS = 1_000_000
+
+# Столбцы-частоты (по первому найденному взвешивается сводка stage_stats)
+WEIGHT_COLUMNS = ("count", "freq", "cluster_freq")
+
+
+def weight_index(columns) -> Optional[int]:
+    names = list(columns)
+    for name in WEIGHT_COLUMNS:
+        if name in names:
+            return names.index(name)
+    return None
+
+
+def is_columnar(path: str) -> bool:
+    """
+    Путь указывает на колоночный артефакт (каталог *.cols или каталог с meta.json).
+    """
+    return path.rstrip("/").endswith(SUFFIX) or os.path.isfile(os.path.join(path, "meta.json"))
+
+
+def source_stamp(path: str) -> List[List[int]]:
+    """
+    Отпечаток входа для проверки кэша: (размер, mtime_ns) файла,
+    а для *.cols — кучи строк и meta.json.
+    """
+    if is_columnar(path):
+        files = [os.path.join(path, "phrase.heap"), os.path.join(path, "meta.json")]
+    else:
+        files = [path]
+    return [[os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files]
+
+
+def _write_meta(path: str, rows: int, columns: Dict[str, str]) -> None:
+    meta = {"format": FORMAT, "version": VERSION, "rows": rows, "columns": columns}
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+class ColumnsWriter:
+    """
+    Потоковая запись колоночного артефакта: фразы сразу уходят в кучу
+    на диске, числа копятся в компактных array.array и сохраняются в close().
+    """
+
+    def __init__(self, path: str, columns: Dict[str, str], stats=None):
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.path = path
+        self.columns = dict(columns)
+        self.stats = stats
+        self._weight = weight_index(self.columns)
+        self._heap = open(os.path.join(path, "phrase.heap"), "wb")
+        self._pos = 0
+        self._offsets = array("q", [0])
+        self._values = [array(TYPECODES[dtype]) for dtype in self.columns.values()]
+
+    def write(self, phrase: str, *values) -> None:
+        b = phrase.encode("utf-8")
+        self._heap.write(b)
+        self._pos += len(b)
+        self._offsets.append(self._pos)
+        for arr, v in zip(self._values, values):
+            arr.append(v)
+        if self.stats is not None:
+            self.stats.add(phrase, None if self._weight is None else values[self._weight])
+
+    def close(self) -> None:
+        self._heap.close()
+        np.save(os.path.join(self.path, "phrase.offsets.npy"), np.frombuffer(self._offsets, dtype=np.int64))
+        for (name, dtype), arr in zip(self.columns.items(), self._values):
+            np.save(os.path.join(self.path, f"{name}.npy"), np.frombuffer(arr, dtype=dtype))
+        _write_meta(self.path, len(self._offsets) - 1, self.columns)
+        if self.stats is not None:
+            self.stats.write(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._heap.close()
+
+
+class TsvWriter:
+    """
+    Тот же интерфейс, что у ColumnsWriter, но пишет phrase<TAB>v1<TAB>v2...
+    """
+
+    def __init__(self, path: str, columns: Dict[str, str], stats=None):
+        self.path = path
+        self.columns = dict(columns)
+        self.stats = stats
+        self._weight = weight_index(self.columns)
+        self._f = open(path, "w", encoding="utf-8")
+
+    def write(self, phrase: str, *values) -> None:
+        if len(values) == 1:
+            self._f.write(f"{phrase}\t{values[0]}\n")
+        else:
+            self._f.write(phrase + "\t" + "\t".join(str(v) for v in values) + "\n")
+        if self.stats is not None:
+            self.stats.add(phrase, None if self._weight is None else values[self._weight])
+
+    def close(self) -> None:
+        self._f.close()
+        if self.stats is not None:
+            self.stats.write(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()
+
+
+def open_phrase_writer(path: str, columns: Dict[str, str], stats=None):
+    """
+    Писатель phrase + числовые столбцы: колоночный для *.cols, иначе TSV.
+    stats (stage_stats.StageStats) собирает сводку по записанным строкам
+    и пишет её рядом с выходом при закрытии.
+    """
+    if is_columnar(path):
+        return ColumnsWriter(path, columns, stats)
+    return TsvWriter(path, columns, stats)
+
+
+class PhraseColumns:
+    """
+    Чтение колоночного артефакта через mmap. Числовые столбцы — массивы
+    numpy (cols["count"]), фразы декодируются только по запросу.
+    """
+
+    def __init__(self, path: str):
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.isfile(meta_path):
+            raise FileNotFoundError(f"{path}: no meta.json (not a {FORMAT} artifact or not finished)")
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") != FORMAT or meta.get("version") != VERSION:
+            raise ValueError(f"{path}: unsupported format {meta.get('format')} v{meta.get('version')}")
+
+        self.path = path
+        self.rows = int(meta["rows"])
+        self.dtypes: Dict[str, str] = meta["columns"]
+
+        heap_path = os.path.join(path, "phrase.heap")
+        if os.path.getsize(heap_path) > 0:
+            self.heap = np.memmap(heap_path, dtype=np.uint8, mode="r")
+        else:
+            self.heap = np.zeros(0, dtype=np.uint8)
+        self.offsets = np.load(os.path.join(path, "phrase.offsets.npy"), mmap_mode="r")
+        self.columns = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in self.dtypes
+        }
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def phrase(self, i: int) -> str:
+        return self.heap[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def iter_phrases(self, idx: Optional[np.ndarray] = None, block_rows: int = 100_000) -> Iterator[str]:
+        """
+        Фразы по порядку (или по индексам idx). Куча читается блоками
+        строк, а не по одному срезу memmap на фразу.
+        """
+        n = self.rows if idx is None else len(idx)
+        for a in range(0, n, block_rows):
+            b = min(a + block_rows, n)
+            if idx is None:
+                off = np.asarray(self.offsets[a:b + 1])
+                blob = self.heap[off[0]:off[-1]].tobytes()
+                off = (off - off[0]).tolist()
+            else:
+                heap, off = gather_heap(self, np.asarray(idx[a:b], dtype=np.int64))
+                blob = heap.tobytes()
+                off = off.tolist()
+            for k in range(b - a):
+                yield blob[off[k]:off[k + 1]].decode("utf-8")
+
+    def lengths_in_words(self, block_rows: int = 1_000_000) -> np.ndarray:
+        """
+        Число слов в каждой фразе: столбец length, если он есть, иначе
+        пробелов + 1 (фразы нормализованы через " ".join) — векторно
+        по куче, блоками строк.
+        """
+        if "length" in self.columns:
+            return np.asarray(self.columns["length"])
+        lengths = np.zeros(self.rows, dtype=np.int64)
+        for a in range(0, self.rows, block_rows):
+            b = min(a + block_rows, self.rows)
+            off = np.asarray(self.offsets[a:b + 1])
+            spaces = np.zeros(off[-1] - off[0] + 1, dtype=np.int64)
+            np.cumsum(self.heap[off[0]:off[-1]] == ord(" "), out=spaces[1:])
+            rel = off - off[0]
+            lengths[a:b] = spaces[rel[1:]] - spaces[rel[:-1]] + 1
+            lengths[a:b][rel[1:] == rel[:-1]] = 0
+        return lengths
+
+
+def gather_heap(cols: PhraseColumns, idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Собирает кучу и смещения для подмножества строк idx (векторно).
+    """
+    off = np.asarray(cols.offsets)
+    starts = off[idx]
+    lengths = off[idx + 1] - starts
+    new_off = np.zeros(len(idx) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_off[1:])
+    gather = np.repeat(starts - new_off[:-1], lengths) + np.arange(new_off[-1], dtype=np.int64)
+    return np.asarray(cols.heap)[gather], new_off
+
+
+def write_subset(
+    cols: PhraseColumns,
+    path: str,
+    idx: np.ndarray,
+    columns: Optional[Dict[str, np.ndarray]] = None,
+    stats=None,
+) -> int:
+    """
+    Пишет строки idx артефакта cols в новый артефакт path (или TSV).
+    columns — столбцы результата; по умолчанию все столбцы cols, взятые по idx.
+    stats, если задан, заполняется векторно и пишется рядом с выходом.
+    Возвращает число записанных строк.
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    if columns is None:
+        columns = {name: np.asarray(arr)[idx] for name, arr in cols.columns.items()}
+    dtypes = {name: str(arr.dtype) for name, arr in columns.items()}
+
+    if stats is not None:
+        w = weight_index(columns)
+        weights = None if w is None else list(columns.values())[w]
+        stats.add_arrays(cols.lengths_in_words()[idx], weights)
+
+    if not is_columnar(path):
+        with TsvWriter(path, dtypes) as w:
+            values = [arr.tolist() for arr in columns.values()]
+            for k, phrase in enumerate(cols.iter_phrases(idx)):
+                w.write(phrase, *(v[k] for v in values))
+        if stats is not None:
+            stats.write(path)
+        return len(idx)
+
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    pos = 0
+    with open(os.path.join(path, "phrase.heap"), "wb") as fheap:
+        for a in range(0, len(idx), TAKE_BLOCK_ROWS):
+            heap, off = gather_heap(cols, idx[a:a + TAKE_BLOCK_ROWS])
+            fheap.write(heap.tobytes())
+            offsets.append(off[1:] + pos)
+            pos += int(off[-1])
+    np.save(os.path.join(path, "phrase.offsets.npy"), np.concatenate(offsets))
+    for name, arr in columns.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(arr))
+    _write_meta(path, len(idx), dtypes)
+    if stats is not None:
+        stats.write(path)
+    return len(idx)
+
+
+def iter_tsv_rows(path: str, n_values: int) -> Iterator[Tuple[str, List[int]]]:
+    """
+    Разбор phrase<TAB>v1...<TAB>vn: фраза — всё до последних n_values полей.
+    Битые строки пропускаются, как и в скриптах шагов.
+    """
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            parts = line.rsplit("\t", n_values)
+            if len(parts) != n_values + 1:
+                continue
+            try:
+                values = [int(v) for v in parts[1:]]
+            except ValueError:
+                continue
+            yield parts[0], values
+
+
+def export_tsv(src: str, dst: str) -> int:
+    cols = PhraseColumns(src)
+    return write_subset(cols, dst, np.arange(len(cols)))
+
+
+def import_tsv(src: str, dst: str, names: Iterable[str], dtype: str = "int64") -> int:
+    names = list(names)
+    n = 0
+    with ColumnsWriter(dst, {name: dtype for name in names}) as w:
+        for phrase, values in iter_tsv_rows(src, len(names)):
+            w.write(phrase, *values)
+            n += 1
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Конвертация между TSV (phrase<TAB>числа...) и колоночным форматом *.cols."
+    )
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_to_cols = sub.add_parser("to-cols", help="TSV -> *.cols")
+    p_to_cols.add_argument("-i", "--input", required=True)
+    p_to_cols.add_argument("-o", "--output", required=True)
+    p_to_cols.add_argument(
+        "--columns",
+        default="count",
+        help="Имена числовых столбцов после фразы через запятую. По умолчанию count.",
+    )
+
+    p_to_tsv = sub.add_parser("to-tsv", help="*.cols -> TSV (для людей)")
+    p_to_tsv.add_argument("-i", "--input", required=True)
+    p_to_tsv.add_argument("-o", "--output", required=True)
+
+    args = parser.parse_args()
+
+    if args.cmd == "to-cols":
+        n = import_tsv(args.input, args.output, args.columns.split(","))
+    else:
+        n = export_tsv(args.input, args.output)
+    print(f"[done] written {n:,} rows to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+from collections import Counter
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+
+# Доля заполнения, после которой таблица удваивается
+MAX_LOAD = 0.7
+
+# Множитель для перемешивания хеша (64-битная золотая константа)
+HASH_MULT = np.uint64(0x9E3779B97F4A7C15)
+
+
+class WordVocab:
+    """
+    Таблица интернирования слов: слово -> id. id 0 зарезервирован
+    под «пустую» позицию в ключе фразы короче max_words.
+    """
+
+    def __init__(self):
+        self.word2id = {}
+        self.words: List[str] = [""]
+
+    def __len__(self) -> int:
+        return len(self.words) - 1
+
+    def word_id(self, w: str) -> int:
+        wid = self.word2id.get(w)
+        if wid is None:
+            wid = len(self.words)
+            self.word2id[w] = wid
+            self.words.append(w)
+        return wid
+
+    def encode(self, phrases: Iterable[str], width: int) -> np.ndarray:
+        """
+        Фразы -> ключи shape (n, width) uint32: id слов, справа дополненные нулями.
+        """
+        flat: List[int] = []
+        for phrase in phrases:
+            ids = [self.word_id(w) for w in phrase.split()]
+            if len(ids) > width:
+                raise ValueError(
+                    f"phrase {phrase!r} has {len(ids)} words, key width is {width}"
+                )
+            flat.extend(ids)
+            flat.extend([0] * (width - len(ids)))
+        return np.array(flat, dtype=np.uint32).reshape(-1, width)
+
+    def encode_counter(self, c: Counter, width: int) -> Tuple[np.ndarray, np.ndarray]:
+        keys = self.encode(c.keys(), width)
+        counts = np.fromiter(c.values(), dtype=np.int64, count=len(c))
+        return keys, counts
+
+    def decode(self, keys: np.ndarray) -> Iterator[str]:
+        """
+        Ключи -> строки фраз (слова через один пробел).
+        """
+        words = self.words
+        for row in keys.tolist():
+            yield " ".join([words[i] for i in row if i])
+
+    def remap_from(self, words: List[str]) -> np.ndarray:
+        """
+        Массив для перевода id чужого словаря (words, с "" на позиции 0)
+        в id этого словаря: new_keys = mapping[old_keys].
+        """
+        mapping = np.zeros(len(words), dtype=np.uint32)
+        for i in range(1, len(words)):
+            mapping[i] = self.word_id(words[i])
+        return mapping
+
+
+def hash_keys(keys: np.ndarray) -> np.ndarray:
+    """
+    64-битный хеш каждой строки ключей (векторно, по столбцам).
+    """
+    h = np.zeros(keys.shape[0], dtype=np.uint64)
+    for j in range(keys.shape[1]):
+        h ^= keys[:, j].astype(np.uint64)
+        h *= HASH_MULT
+        h ^= h >> np.uint64(29)
+    return h
+
+
+class PhraseTable:
+    """
+    Хеш-таблица с открытой адресацией (линейное пробирование) на массивах numpy:
+    ключ — фраза в виде width id слов uint32, значение — частота uint32
+    (частота одной фразы в корпусе заведомо меньше 2^32).
+    Пустой слот — count == 0. Вставка идёт пачками, векторно.
+    Около (4 * width + 4) / MAX_LOAD байт на фразу против ~100+ байт
+    у Counter со строковыми ключами.
+    """
+
+    def __init__(self, width: int, capacity: int = 1 << 16):
+        capacity = 1 << max(4, (capacity - 1).bit_length())
+        self.width = width
+        self.keys = np.zeros((capacity, width), dtype=np.uint32)
+        self.counts = np.zeros(capacity, dtype=np.uint32)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.counts.nbytes
+
+    def _grow(self, need: int) -> None:
+        capacity = len(self.counts)
+        while need > capacity * MAX_LOAD:
+            capacity *= 2
+        if capacity == len(self.counts):
+            return
+        keys, counts = self.items()
+        self.keys = np.zeros((capacity, self.width), dtype=np.uint32)
+        self.counts = np.zeros(capacity, dtype=np.uint32)
+        self.size = 0
+        self.add_batch(keys, counts)
+
+    def add_batch(self, keys: np.ndarray, counts: np.ndarray) -> None:
+        """
+        Прибавляет counts к частотам ключей keys. Ключи внутри пачки
+        должны быть уникальны (пачка — уже агрегированный чанк).
+        """
+        if len(keys) == 0:
+            return
+        counts = counts.astype(np.uint32, copy=False)
+        self._grow(self.size + len(keys))
+
+        mask = np.uint64(len(self.counts) - 1)
+        slots = (hash_keys(keys) & mask).astype(np.int64)
+        pending = np.arange(len(keys))
+
+        while pending.size:
+            s = slots[pending]
+            occupied = self.counts[s] != 0
+
+            # слот занят этим же ключом — прибавляем
+            match = occupied & (self.keys[s] == keys[pending]).all(axis=1)
+            self.counts[s[match]] += counts[pending[match]]
+
+            # слот пуст — занимает первый из претендентов на него
+            empty_idx = np.flatnonzero(~occupied)
+            _, first = np.unique(s[empty_idx], return_index=True)
+            win_idx = empty_idx[first]
+            winners = pending[win_idx]
+            self.keys[s[win_idx]] = keys[winners]
+            self.counts[s[win_idx]] = counts[winners]
+            self.size += len(winners)
+
+            done = match.copy()
+            done[win_idx] = True
+            # занят другим ключом — к следующему слоту; проигравшие
+            # претенденты остаются на месте и сравнятся с победителем
+            advance = occupied & ~match
+            slots[pending[advance]] = (s[advance] + 1) & int(mask)
+            pending = pending[~done]
+
+    def add_counter(self, vocab: WordVocab, c: Counter) -> None:
+        if c:
+            self.add_batch(*vocab.encode_counter(c, self.width))
+
+    def items(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (ключи, частоты) всех занятых слотов в порядке слотов.
+        """
+        used = self.counts != 0
+        return self.keys[used], self.counts[used]
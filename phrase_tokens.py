@@ -0,0 +1,202 @@
+import json
+import os
+import sys
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from phrase_columns import PhraseColumns, is_columnar, source_stamp
+from phrase_keys import WordVocab
+
+
+# Токенизированное представление phrase<TAB>count в формате CSR:
+#   word_ids  int32[n_tokens]  — id слов всех фраз подряд
+#   offsets   int64[rows + 1]  — слова фразы i = word_ids[off[i]:off[i + 1]]
+#   count     int64[rows]      — частота фразы
+#   words     id -> слово (id 0 — пустое, как в phrase_keys.WordVocab)
+# Кэш лежит рядом со входом в каталоге <input>.tokens и переиспользуется,
+# пока вход не изменился (размер и mtime).
+
+TOKENS_SUFFIX = ".tokens"
+TOKENS_VERSION = 1
+
+# Ранг слова вне словаря / фразы, не прошедшей частотный фильтр
+UNRANKED = np.iinfo(np.int64).max
+
+
+def parse_count_line(line: str) -> Optional[Tuple[str, int]]:
+    """
+    phrase<TAB>count -> (phrase, count); None для пустой или битой строки.
+    """
+    line = line.rstrip("\n")
+    if not line:
+        return None
+    try:
+        phrase, count_str = line.rsplit("\t", 1)
+        return phrase, int(count_str)
+    except ValueError:
+        return None
+
+
+def iter_phrase_counts(path: str) -> Iterator[Tuple[str, int]]:
+    """
+    Все корректные строки входа (TSV или *.cols) в порядке файла.
+    """
+    if is_columnar(path):
+        cols = PhraseColumns(path)
+        yield from zip(cols.iter_phrases(), np.asarray(cols["count"]).tolist())
+        return
+    with open(path, "r", encoding="utf-8", errors="ignore") as fin:
+        for line in fin:
+            parsed = parse_count_line(line)
+            if parsed is not None:
+                yield parsed
+
+
+def tokens_cache_path(path: str) -> str:
+    return path.rstrip("/") + TOKENS_SUFFIX
+
+
+class PhraseTokens:
+    def __init__(self, words: List[str], word_ids: np.ndarray, offsets: np.ndarray, counts: np.ndarray):
+        self.words = words
+        self.word_ids = word_ids
+        self.offsets = offsets
+        self.counts = counts
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def word_freq(self) -> np.ndarray:
+        """
+        Частота каждого слова (по id), взвешенная частотой фраз:
+        один np.bincount по всем токенам.
+        """
+        weights = np.repeat(np.asarray(self.counts, dtype=np.float64), self.lengths)
+        freq = np.bincount(self.word_ids, weights=weights, minlength=len(self.words))
+        return np.rint(freq).astype(np.int64)
+
+    def max_rank(self, rank_of_id: np.ndarray) -> np.ndarray:
+        """
+        Максимальный ранг слов каждой фразы: гатер рангов по word_ids
+        и np.maximum.reduceat по границам фраз. Фраза входит в top-N
+        ровно тогда, когда результат <= N (то же, что logical_and.reduceat
+        по маске rank <= N, но сразу для всех N). У пустой фразы — 0.
+        """
+        result = np.zeros(len(self), dtype=np.int64)
+        nonempty = np.flatnonzero(self.lengths > 0)
+        if len(nonempty):
+            token_ranks = rank_of_id[self.word_ids]
+            result[nonempty] = np.maximum.reduceat(token_ranks, self.offsets[:-1][nonempty])
+        return result
+
+    def rank_of_id(self, ranks: Dict[str, int]) -> np.ndarray:
+        """
+        word -> ранг в массив по id словаря; слова без ранга — UNRANKED.
+        """
+        result = np.full(len(self.words), UNRANKED, dtype=np.int64)
+        word2id = {w: i for i, w in enumerate(self.words)}
+        for w, r in ranks.items():
+            wid = word2id.get(w)
+            if wid:
+                result[wid] = r
+        return result
+
+    def save(self, cache_dir: str, stamp: List[List[int]]) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        meta_path = os.path.join(cache_dir, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        with open(os.path.join(cache_dir, "words.txt"), "w", encoding="utf-8") as f:
+            for w in self.words[1:]:
+                f.write(w + "\n")
+        np.save(os.path.join(cache_dir, "word_ids.npy"), self.word_ids)
+        np.save(os.path.join(cache_dir, "offsets.npy"), self.offsets)
+        np.save(os.path.join(cache_dir, "count.npy"), self.counts)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": TOKENS_VERSION, "source_stamp": stamp, "rows": len(self)},
+                f,
+                indent=2,
+            )
+
+    @classmethod
+    def load(cls, cache_dir: str, stamp: List[List[int]]) -> Optional["PhraseTokens"]:
+        """
+        Кэш из cache_dir, если он дописан и построен по этому же входу, иначе None.
+        """
+        meta_path = os.path.join(cache_dir, "meta.json")
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != TOKENS_VERSION or meta.get("source_stamp") != stamp:
+            return None
+        with open(os.path.join(cache_dir, "words.txt"), "r", encoding="utf-8") as f:
+            words = [""] + [w.rstrip("\n") for w in f]
+        return cls(
+            words,
+            np.load(os.path.join(cache_dir, "word_ids.npy"), mmap_mode="r"),
+            np.load(os.path.join(cache_dir, "offsets.npy"), mmap_mode="r"),
+            np.load(os.path.join(cache_dir, "count.npy"), mmap_mode="r"),
+        )
+
+
+def encode_phrases(rows: Iterable[Tuple[str, int]], progress_interval: int = 0) -> PhraseTokens:
+    """
+    Один проход split() по всем фразам: слова интернируются в WordVocab
+    (id в порядке первого появления), id и границы фраз копятся в array.array.
+    """
+    vocab = WordVocab()
+    word_id = vocab.word_id
+    word_ids = array("i")
+    offsets = array("q", [0])
+    counts = array("q")
+    n = 0
+    next_progress = progress_interval
+
+    for phrase, count in rows:
+        word_ids.extend([word_id(w) for w in phrase.split()])
+        offsets.append(len(word_ids))
+        counts.append(count)
+        n += 1
+        if progress_interval and n >= next_progress:
+            print(f"[tokens] encoded {n:,} phrases, {len(vocab):,} words", file=sys.stderr)
+            next_progress += progress_interval
+
+    return PhraseTokens(
+        vocab.words,
+        np.frombuffer(word_ids, dtype=np.int32),
+        np.frombuffer(offsets, dtype=np.int64),
+        np.frombuffer(counts, dtype=np.int64),
+    )
+
+
+def load_tokens(path: str, use_cache: bool = True, progress_interval: int = 0) -> PhraseTokens:
+    """
+    CSR-представление входа path: из кэша <path>.tokens, если он свежий,
+    иначе кодирует вход и (при use_cache) сохраняет кэш для следующих шагов.
+    """
+    cache_dir = tokens_cache_path(path)
+    stamp = source_stamp(path)
+    if use_cache:
+        tokens = PhraseTokens.load(cache_dir, stamp)
+        if tokens is not None:
+            print(f"[tokens] loaded {len(tokens):,} phrases from cache {cache_dir}", file=sys.stderr)
+            return tokens
+
+    tokens = encode_phrases(iter_phrase_counts(path), progress_interval)
+    print(
+        f"[tokens] encoded {len(tokens):,} phrases, {len(tokens.words) - 1:,} words, "
+        f"{len(tokens.word_ids):,} tokens",
+        file=sys.stderr,
+    )
+    if use_cache:
+        tokens.save(cache_dir, stamp)
+        print(f"[tokens] cache written to {cache_dir}", file=sys.stderr)
+    return tokens
@@ -3,8 +3,42 @@ import argparse
 import sys
 from pathlib import Path
 
+import numpy as np
 from tqdm import tqdm
 
+from phrase_columns import PhraseColumns, is_columnar, open_phrase_writer, write_subset
+from stage_stats import StageStats
+
+# Столбцы финального словаря: phrase<TAB>freq<TAB>cluster_size
+FINAL_COLUMNS = {"freq": "int64", "cluster_size": "int64"}
+
+
+def select_columnar(args, stats: StageStats) -> None:
+    """
+    То же для колоночного входа: фильтры — маски по столбцам,
+    сортировка — устойчивый argsort (порядок равных как у list.sort).
+    """
+    cols = PhraseColumns(args.input)
+    freq = np.asarray(cols["cluster_freq"])
+    size = np.asarray(cols["cluster_size"])
+    print(f"[info] total clusters read: {len(cols):,}", file=sys.stderr)
+    stats.info["lines_in"] = len(cols)
+
+    idx = np.flatnonzero((freq >= args.min_freq) & (size >= args.min_size))
+    print(f"[info] clusters after filters: {len(idx):,}", file=sys.stderr)
+
+    idx = idx[np.argsort(-freq[idx], kind="stable")]
+    if args.top_k > 0 and len(idx) > args.top_k:
+        idx = idx[: args.top_k]
+        print(f"[info] taking top-{args.top_k} clusters", file=sys.stderr)
+
+    n = write_subset(
+        cols, args.output, idx,
+        {"freq": freq[idx], "cluster_size": size[idx]},
+        stats=stats,
+    )
+    print(f"[done] written {n:,} phrases to {args.output}", file=sys.stderr)
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -13,12 +47,15 @@ def main():
     parser.add_argument(
         "-i", "--input",
         required=True,
-        help="Вход: clusters_aggregated.tsv (cluster_id,cluster_freq,cluster_size,representative).",
+        help=(
+            "Вход: clusters_aggregated.tsv (cluster_id,cluster_freq,cluster_size,representative) "
+            "или clusters_aggregated.cols из aggregate_clusters.py."
+        ),
     )
     parser.add_argument(
         "-o", "--output",
         required=True,
-        help="Выход: final_phrases.tsv (phrase<TAB>freq<TAB>cluster_size).",
+        help="Выход: final_phrases.tsv (phrase<TAB>freq<TAB>cluster_size) или *.cols.",
     )
     parser.add_argument(
         "--top-k",
@@ -50,6 +87,15 @@ def main():
     in_path = Path(args.input)
     out_path = Path(args.output)
 
+    stats = StageStats(
+        "select_final_phrases",
+        input=args.input, top_k=args.top_k, min_freq=args.min_freq, min_size=args.min_size,
+    )
+
+    if is_columnar(args.input):
+        select_columnar(args, stats)
+        return
+
     rows = []
     total = 0
     next_progress = args.progress_interval
@@ -89,6 +135,7 @@ def main():
 
     print(f"[info] total clusters read: {total:,}", file=sys.stderr)
     print(f"[info] clusters after filters: {len(rows):,}", file=sys.stderr)
+    stats.info["lines_in"] = total
 
     # сортировка по частоте (убывание)
     rows.sort(key=lambda x: x[1], reverse=True)
@@ -98,10 +145,10 @@ def main():
         print(f"[info] taking top-{args.top_k} clusters", file=sys.stderr)
 
     # запись финального словаря
-    with out_path.open("w", encoding="utf-8") as fout:
+    with open_phrase_writer(args.output, FINAL_COLUMNS, stats) as fout:
         # без заголовка, чтобы удобно было дальше обрабатывать
         for phrase, freq, size in rows:
-            fout.write(f"{phrase}\t{freq}\t{size}\n")
+            fout.write(phrase, freq, size)
 
     print(f"[done] written {len(rows):,} phrases to {out_path}", file=sys.stderr)
 
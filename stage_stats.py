@@ -0,0 +1,177 @@
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from itertools import repeat
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from phrase_columns import source_stamp
+
+
+# Сводка по выходу шага лежит рядом с ним: <output>.stats.json
+SIDECAR_SUFFIX = ".stats.json"
+
+# Квантили частот, которые пишутся в сводку
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# add() только копит строки, гистограммы обновляются пачками такого размера
+STATS_CHUNK = 65536
+
+
+def sidecar_path(output: str) -> str:
+    return output.rstrip("/") + SIDECAR_SUFFIX
+
+
+def phrase_length(phrase: str) -> int:
+    # фразы в пайплайне нормализованы через " ".join, поэтому слов = пробелов + 1
+    return phrase.count(" ") + 1 if phrase else 0
+
+
+class StageStats:
+    """
+    Статистика выхода шага, собираемая попутно с его записью:
+    число строк, гистограмма длин (в словах), она же взвешенная частотой,
+    гистограмма частот (для точных квантилей) и время работы шага.
+    Создаётся в начале шага, записывается рядом с выходом в write().
+    """
+
+    def __init__(self, stage: str, **info):
+        self.stage = stage
+        self.info = dict(info)
+        self.t0 = time.monotonic()
+        self.rows = 0
+        self.length_hist: Counter = Counter()
+        self.weighted_hist: Counter = Counter()
+        self.count_hist: Counter = Counter()
+        # строки add(), ещё не сведённые в гистограммы
+        self._phrases: List[str] = []
+        self._counts: List[Optional[int]] = []
+
+    def add(self, phrase: str, count: Optional[int] = None) -> None:
+        """
+        Одна записанная строка; вызывается писателями на каждую строку,
+        поэтому только копит её, а считает flush() пачкой через add_arrays().
+        """
+        self._phrases.append(phrase)
+        self._counts.append(count)
+        if len(self._phrases) >= STATS_CHUNK:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._phrases:
+            return
+        phrases = self._phrases
+        # слов = пробелов + 1 (см. phrase_length), у пустой фразы — 0
+        lengths = np.fromiter(map(str.count, phrases, repeat(" ")), np.int64, len(phrases)) + 1
+        lengths[np.fromiter(map(len, phrases), np.int64, len(phrases)) == 0] = 0
+        counts = self._counts
+        self._phrases = []
+        self._counts = []
+        if None not in counts:
+            self.add_arrays(lengths, np.array(counts, dtype=np.int64))
+            return
+        # строки без частоты идут только в гистограмму длин
+        has = np.fromiter((c is not None for c in counts), bool, len(counts))
+        self.add_arrays(lengths[~has])
+        if has.any():
+            self.add_arrays(lengths[has], np.array([c for c in counts if c is not None], np.int64))
+
+    def add_length_hist(self, hist: Dict[int, int]) -> None:
+        """
+        Для выходов без частот (шаг 1): гистограмма длин, посчитанная воркером.
+        """
+        self.rows += sum(hist.values())
+        self.length_hist.update(hist)
+
+    def add_arrays(self, lengths: np.ndarray, counts: Optional[np.ndarray] = None) -> None:
+        """
+        Векторный вариант add() для колоночных выходов.
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.rows += len(lengths)
+        if not len(lengths):
+            return
+        per_length = np.bincount(lengths)
+        values = np.flatnonzero(per_length)
+        self.length_hist.update(dict(zip(values.tolist(), per_length[values].tolist())))
+        if counts is not None:
+            counts = np.asarray(counts, dtype=np.int64)
+            weighted = np.bincount(lengths, weights=counts)
+            self.weighted_hist.update(
+                {n: int(round(weighted[n])) for n in values.tolist()}
+            )
+            values, n = np.unique(counts, return_counts=True)
+            self.count_hist.update(dict(zip(values.tolist(), n.tolist())))
+
+    def quantiles(self) -> Dict[str, int]:
+        """
+        Точные квантили частоты строки по гистограмме частот.
+        """
+        self.flush()
+        if not self.count_hist:
+            return {}
+        values = sorted(self.count_hist)
+        cum = np.cumsum([self.count_hist[v] for v in values])
+        total = int(cum[-1])
+        result = {"min": values[0]}
+        for q in QUANTILES:
+            k = int(np.searchsorted(cum, q * total, side="left"))
+            result[f"p{q * 100:g}"] = values[min(k, len(values) - 1)]
+        result["max"] = values[-1]
+        return result
+
+    def to_dict(self, output: str) -> dict:
+        self.flush()
+        d = {
+            "stage": self.stage,
+            "output": output,
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "elapsed_sec": round(time.monotonic() - self.t0, 3),
+            "rows": self.rows,
+            "length_hist": {str(k): v for k, v in sorted(self.length_hist.items())},
+        }
+        if self.count_hist:
+            d["count_total"] = sum(self.weighted_hist.values())
+            d["weighted_length_hist"] = {
+                str(k): v for k, v in sorted(self.weighted_hist.items())
+            }
+            d["count_quantiles"] = self.quantiles()
+        d.update(self.info)
+        return d
+
+    def write(self, output: str) -> None:
+        """
+        Пишет <output>.stats.json; вызывается после закрытия основного выхода,
+        отпечаток которого сохраняется для проверки свежести в read_stats().
+        """
+        d = self.to_dict(output)
+        d["output_stamp"] = source_stamp(output)
+        with open(sidecar_path(output), "w", encoding="utf-8") as f:
+            json.dump(d, f, ensure_ascii=False, indent=2)
+
+
+def read_stats(output: str) -> Optional[dict]:
+    """
+    Сводка выхода output, если она есть и выход с тех пор не менялся.
+    """
+    path = sidecar_path(output)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        d = json.load(f)
+    if d.get("output_stamp") != source_stamp(output):
+        return None
+    return d
+
+
+def scan_stats(rows: Iterable, stage: str = "scan") -> StageStats:
+    """
+    Сводка пересчётом: rows — пары (phrase, count) или (phrase, None).
+    """
+    stats = StageStats(stage)
+    for phrase, count in rows:
+        stats.add(phrase, count)
+    return stats
@@ -1,10 +1,62 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
+import heapq
+import math
+import multiprocessing as mp
 import os
+import queue
+import resource
+import shutil
 import sys
-from collections import Counter
+import tempfile
+import zlib
+from collections import Counter, defaultdict
 from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import List, Iterable
+from itertools import islice
+from typing import List, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from byte_ranges import RANGES_PER_WORKER, iter_range_lines, split_byte_ranges
+from phrase_columns import open_phrase_writer
+from phrase_keys import PhraseTable, WordVocab
+from stage_stats import StageStats
+
+
+# Грубая оценка сверху: сколько байт RAM занимает Counter на байт входного
+# файла, когда почти все фразы разные (объект str + запись в dict + int)
+COUNTER_BYTES_PER_INPUT_BYTE = 8
+
+# Каждый воркер фазы 1 держит открытыми файлы всех корзин сразу, а фаза 3
+# сливает все отсортированные корзины за один проход, поэтому корзин не больше
+# MAX_BUCKETS и не больше половины лимита открытых файлов (ulimit -n)
+MAX_BUCKETS = 512
+
+# Столбцы результата: phrase<TAB>count в TSV или count.npy в *.cols
+COUNT_COLUMNS = {"count": "int64"}
+
+
+def max_buckets() -> int:
+    """
+    Потолок числа корзин: MAX_BUCKETS, но с запасом под лимит открытых
+    файлов процесса (stdin/stdout, вход, пул процессов, вывод).
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return MAX_BUCKETS
+    return max(1, min(MAX_BUCKETS, soft // 2))
+
+
+def parse_size(s: str) -> int:
+    """
+    "16G", "512M", "800K" -> байты. Число без суффикса — мегабайты.
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    s = s.strip().upper().rstrip("B")
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(float(s) * units["M"])
 
 
 def chunk_reader(fh, chunk_size: int) -> Iterable[List[str]]:
@@ -21,17 +73,704 @@ def chunk_reader(fh, chunk_size: int) -> Iterable[List[str]]:
         yield chunk
 
 
-def count_chunk(lines: List[str]) -> Counter:
+def count_lines_into(c: Counter, lines: Iterable[str]) -> int:
     """
-    Считает частоты фраз в одном чанке.
-    Фразы уже очищены на предыдущем шаге.
+    Добавляет частоты фраз из lines в счётчик c.
+    Фразы уже очищены на предыдущем шаге. Возвращает число строк.
     """
-    c = Counter()
+    n = 0
     for line in lines:
+        n += 1
         phrase = line.strip()
         if phrase:
             c[phrase] += 1
-    return c
+    return n
+
+
+def accumulator_worker(
+    path: str,
+    task_q,
+    result_q,
+    compact_width: int = 0,
+    chunk_size: int = 100_000,
+) -> None:
+    """
+    Долгоживущий воркер: копит одну таблицу частот по всем своим задачам.
+    Задача — список строк или байтовый диапазон (start, end) файла path.
+    После каждой задачи шлёт ("lines", n), по сигналу None отдаёт
+    ("partial", таблица) — родитель получает ровно одну таблицу на воркер.
+    Таблица — Counter или, при compact_width > 0, компактные ключи
+    (слова воркера, ключи, частоты) из phrase_keys.
+    """
+    c = Counter()
+    vocab = WordVocab()
+    table = PhraseTable(compact_width) if compact_width else None
+    while True:
+        task = task_q.get()
+        if task is None:
+            break
+        if isinstance(task, tuple):
+            lines = iter_range_lines(path, task[0], task[1])
+        else:
+            lines = task
+
+        if table is None:
+            result_q.put(("lines", count_lines_into(c, lines)))
+            continue
+
+        # компактный режим: строковые ключи живут только в пределах чанка
+        it = iter(lines)
+        n = 0
+        while True:
+            part = Counter()
+            k = count_lines_into(part, islice(it, chunk_size))
+            if k == 0:
+                break
+            n += k
+            table.add_counter(vocab, part)
+        result_q.put(("lines", n))
+
+    if table is None:
+        result_q.put(("partial", c))
+    else:
+        result_q.put(("partial", (vocab.words, *table.items())))
+
+
+def merge_partials(partials: List[Counter]) -> Counter:
+    """
+    Сливает частичные счётчики воркеров: самый большой берётся за основу,
+    остальные добавляются в него (без повторной вставки всех его ключей).
+    """
+    if not partials:
+        return Counter()
+    partials.sort(key=len, reverse=True)
+    total = partials[0]
+    for c in partials[1:]:
+        total.update(c)
+    return total
+
+
+def merge_compact_partials(partials: List[tuple], width: int) -> Tuple[WordVocab, PhraseTable]:
+    """
+    Сливает компактные таблицы воркеров: id слов каждого воркера
+    переводятся в общий словарь, ключи вставляются пачкой.
+    """
+    vocab = WordVocab()
+    table = PhraseTable(width, capacity=max((len(p[2]) for p in partials), default=1))
+    for words, keys, counts in partials:
+        mapping = vocab.remap_from(words)
+        table.add_batch(mapping[keys], counts)
+    return vocab, table
+
+
+def count_with_accumulators(args) -> Tuple[list, int]:
+    """
+    Подсчёт частот пулом из --workers воркеров-накопителей.
+    Задачи идут через очередь ограниченного размера (--max-in-flight),
+    поэтому чанки не копятся в памяти, а в родителя возвращаются только
+    --workers частичных таблиц вместо счётчика на каждый чанк.
+    Возвращает (частичные таблицы воркеров, число строк).
+    """
+    compact_width = args.max_words if args.compact_keys else 0
+    max_in_flight = max(1, args.max_in_flight or 2 * args.workers)
+    task_q = mp.Queue(maxsize=max_in_flight)
+    result_q = mp.Queue()
+
+    workers = [
+        mp.Process(
+            target=accumulator_worker,
+            args=(args.input, task_q, result_q, compact_width, args.chunk_size),
+            daemon=True,
+        )
+        for _ in range(args.workers)
+    ]
+    for w in workers:
+        w.start()
+
+    total_lines = 0
+    next_progress = args.progress_interval
+    partials: list = []
+
+    def handle(msg) -> None:
+        nonlocal total_lines, next_progress
+        kind, payload = msg
+        if kind == "partial":
+            partials.append(payload)
+            return
+        total_lines += payload
+        if total_lines >= next_progress:
+            print(f"[progress] processed {total_lines:,} lines", file=sys.stderr)
+            next_progress += args.progress_interval
+
+    def check_workers() -> None:
+        for w in workers:
+            if w.exitcode not in (None, 0):
+                raise RuntimeError(f"worker {w.pid} exited with code {w.exitcode}")
+
+    def drain_ready() -> None:
+        while True:
+            try:
+                handle(result_q.get_nowait())
+            except queue.Empty:
+                return
+
+    def put_task(task) -> None:
+        # Очередь ограничена: ждём места, попутно забирая прогресс воркеров
+        while True:
+            try:
+                task_q.put(task, timeout=1.0)
+                break
+            except queue.Full:
+                drain_ready()
+                check_workers()
+        drain_ready()
+
+    if args.byte_ranges:
+        ranges = split_byte_ranges(args.input, args.workers * RANGES_PER_WORKER)
+        print(f"[info] byte-range mode: {len(ranges)} ranges", file=sys.stderr)
+        for start, end in ranges:
+            put_task((start, end))
+    else:
+        with open(args.input, "r", encoding="utf-8", errors="ignore") as fin:
+            for chunk in chunk_reader(fin, args.chunk_size):
+                put_task(chunk)
+
+    for _ in workers:
+        put_task(None)
+    while len(partials) < len(workers):
+        try:
+            handle(result_q.get(timeout=1.0))
+        except queue.Empty:
+            check_workers()
+    for w in workers:
+        w.join()
+
+    return partials, total_lines
+
+
+def tail_size(vocab_size: int, tail_percent: float) -> int:
+    """
+    Сколько самых редких типов фраз отрезать, с логом как раньше.
+    """
+    tail_percent = max(0.0, min(100.0, tail_percent))
+    if tail_percent <= 0.0 or vocab_size == 0:
+        print("[info] tail trimming disabled", file=sys.stderr)
+        return 0
+    tail_n = int(vocab_size * (tail_percent / 100.0))
+    print(
+        f"[info] removed tail {tail_percent:.2f}% "
+        f"({tail_n:,} phrase types), kept {vocab_size - tail_n:,}",
+        file=sys.stderr,
+    )
+    return tail_n
+
+
+def nth_phrase(phrases: List[str], k: int) -> str:
+    """
+    k-я (с нуля) по алфавиту фраза из списка различных фраз, без полной
+    сортировки: quickselect, опорная фраза берётся из отсортированной
+    выборки на позиции, пропорциональной k, так что за проход обычно
+    остаётся небольшая часть списка. Детерминирован — случайности нет.
+    """
+    while True:
+        sample = sorted(phrases[:: max(1, len(phrases) // 1024)])
+        pivot = sample[min(k * len(sample) // len(phrases), len(sample) - 1)]
+        lower = [p for p in phrases if p < pivot]
+        if k < len(lower):
+            phrases = lower
+            continue
+        if k == len(lower):
+            return pivot
+        k -= len(lower) + 1
+        phrases = [p for p in phrases if p > pivot]
+
+
+def write_trimmed_counts(
+    counter: Counter,
+    out_path: str,
+    tail_percent: float,
+    stats: Optional[StageStats] = None,
+) -> None:
+    """
+    Удаляет хвост tail_percent самых редких фраз (по количеству типов)
+    и пишет phrase<TAB>count по убыванию частоты.
+
+    Частоты — небольшие целые, поэтому вместо сортировки всех пар
+    фразы раскладываются по корзинам «частота -> фразы», отсечка хвоста
+    считается по размерам корзин, а вывод идёт корзина за корзиной
+    от большей частоты к меньшей. Фразы внутри корзины не сортируются
+    (порядок появления в счётчике); в пограничной корзине остаются
+    алфавитно первые — берутся фразы меньше nth_phrase, так что отрезаемая
+    часть хвоста та же, что в компактном и внешнем режимах, и не зависит
+    от того, в каком порядке воркеры вернули счётчики.
+    stats, если задан, собирает сводку по записанным строкам (<out_path>.stats.json).
+    """
+    vocab_size = len(counter)
+    print(f"[info] vocabulary size before trimming: {vocab_size:,}", file=sys.stderr)
+    if stats is not None:
+        stats.info["types_before_trim"] = vocab_size
+
+    by_count = defaultdict(list)
+    for phrase, count in counter.items():
+        by_count[count].append(phrase)
+
+    keep_n = vocab_size - tail_size(vocab_size, tail_percent)
+
+    written = 0
+    with open_phrase_writer(out_path, COUNT_COLUMNS, stats) as fout:
+        for count in sorted(by_count, reverse=True):
+            if written >= keep_n:
+                break
+            phrases = by_count.pop(count)
+            if keep_n - written < len(phrases):
+                cut = nth_phrase(phrases, keep_n - written)
+                phrases = [p for p in phrases if p < cut]
+            for phrase in phrases:
+                fout.write(phrase, count)
+                written += 1
+
+    print(f"[done] written {written:,} phrases to {out_path}", file=sys.stderr)
+
+
+def write_trimmed_table(
+    vocab: WordVocab,
+    table: PhraseTable,
+    out_path: str,
+    tail_percent: float,
+    stats: Optional[StageStats] = None,
+) -> None:
+    """
+    То же, что write_trimmed_counts, для компактной таблицы: порядок
+    (-count, phrase) считается одним lexsort по массивам, в строки
+    декодируются только оставшиеся фразы и только при записи.
+    Слова перенумеровываются по алфавиту: раз в словах только буквы
+    (они больше пробела), порядок кортежей id совпадает с порядком строк.
+    """
+    keys, counts = table.items()
+    vocab_size = len(counts)
+    print(f"[info] vocabulary size before trimming: {vocab_size:,}", file=sys.stderr)
+    if stats is not None:
+        stats.info["types_before_trim"] = vocab_size
+
+    keep_n = vocab_size - tail_size(vocab_size, tail_percent)
+
+    sorted_words = [""] + sorted(vocab.words[1:])
+    rank = np.zeros(len(vocab.words), dtype=np.uint32)
+    rank[[vocab.word2id[w] for w in sorted_words[1:]]] = np.arange(
+        1, len(sorted_words), dtype=np.uint32
+    )
+    ranked = rank[keys]
+
+    # lexsort: последний ключ — главный
+    sort_keys = [ranked[:, j] for j in range(ranked.shape[1] - 1, -1, -1)]
+    sort_keys.append(-counts.astype(np.int64))
+    order = np.lexsort(sort_keys)[:keep_n]
+
+    decoder = WordVocab()
+    decoder.words = sorted_words
+    with open_phrase_writer(out_path, COUNT_COLUMNS, stats) as fout:
+        for phrase, count in zip(decoder.decode(ranked[order]), counts[order].tolist()):
+            fout.write(phrase, count)
+
+    print(f"[done] written {len(order):,} phrases to {out_path}", file=sys.stderr)
+
+
+def bucket_of(phrase: str, n_buckets: int) -> int:
+    """
+    Номер корзины фразы. crc32, а не hash(): результат не зависит
+    от PYTHONHASHSEED и одинаков во всех процессах.
+    """
+    return zlib.crc32(phrase.encode("utf-8")) % n_buckets
+
+
+def make_tmp_dir(args, kind: str) -> str:
+    """
+    Свой каталог прогона для временных файлов: новый подкаталог в --tmp-dir
+    (по умолчанию рядом с выходом). В конце удаляется только он, чужие
+    файлы в --tmp-dir не трогаются.
+    """
+    parent = args.tmp_dir or os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f"{os.path.basename(args.output)}.{kind}-", dir=parent)
+
+
+def bucket_part_path(tmp_dir: str, bucket: int, range_id: int) -> str:
+    return os.path.join(tmp_dir, f"b{bucket:05d}-r{range_id:05d}.tsv")
+
+
+def partition_range(
+    path: str,
+    start: int,
+    end: int,
+    range_id: int,
+    n_buckets: int,
+    tmp_dir: str,
+    chunk_size: int,
+) -> int:
+    """
+    Фаза 1 внешнего подсчёта: читает диапазон [start, end), агрегирует
+    частоты локально (не больше chunk_size разных фраз в памяти)
+    и сбрасывает phrase<TAB>count в файлы корзин по хешу фразы.
+    Возвращает число прочитанных строк.
+    """
+    outs = [
+        open(bucket_part_path(tmp_dir, b, range_id), "w", encoding="utf-8")
+        for b in range(n_buckets)
+    ]
+
+    def flush(c: Counter) -> None:
+        for phrase, count in c.items():
+            outs[bucket_of(phrase, n_buckets)].write(f"{phrase}\t{count}\n")
+        c.clear()
+
+    n = 0
+    c = Counter()
+    try:
+        for line in iter_range_lines(path, start, end):
+            n += 1
+            phrase = line.strip()
+            if phrase:
+                c[phrase] += 1
+                if len(c) >= chunk_size:
+                    flush(c)
+        flush(c)
+    finally:
+        for f in outs:
+            f.close()
+    return n
+
+
+def count_bucket(tmp_dir: str, bucket: int, n_ranges: int) -> Counter:
+    """
+    Фаза 2 внешнего подсчёта: сводит все части одной корзины в точные
+    частоты и пишет их в b<bucket>.sorted.tsv по (-count, phrase).
+    Возвращает гистограмму корзины: count -> число фраз с такой частотой.
+    """
+    c = Counter()
+    for r in range(n_ranges):
+        part_path = bucket_part_path(tmp_dir, bucket, r)
+        with open(part_path, "r", encoding="utf-8") as f:
+            for line in f:
+                phrase, count_str = line.rstrip("\n").rsplit("\t", 1)
+                c[phrase] += int(count_str)
+        os.remove(part_path)
+
+    items = sorted(c.items(), key=lambda x: (-x[1], x[0]))
+    sorted_path = os.path.join(tmp_dir, f"b{bucket:05d}.sorted.tsv")
+    with open(sorted_path, "w", encoding="utf-8") as fout:
+        for phrase, count in items:
+            fout.write(f"{phrase}\t{count}\n")
+
+    return Counter(c.values())
+
+
+def iter_sorted_bucket(path: str) -> Iterator[Tuple[int, str]]:
+    """
+    Ключи (-count, phrase) отсортированной корзины — для heapq.merge.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            phrase, count_str = line.rstrip("\n").rsplit("\t", 1)
+            yield -int(count_str), phrase
+
+
+def run_external(args, stats: StageStats) -> None:
+    """
+    Внешний (spill-to-disk) подсчёт с бюджетом памяти --max-memory:
+      1) воркеры читают свои байтовые диапазоны и раскладывают фразы
+         по корзинам на диске (hash-partitioning);
+      2) каждая корзина считается точно и сортируется независимо;
+      3) хвост отрезается по общей гистограмме частот, корзины сливаются
+         k-way merge в порядке убывания частоты (при равенстве — по фразе).
+    В памяти одновременно не больше одной корзины на воркер.
+    """
+    max_memory = parse_size(args.max_memory)
+    input_size = os.path.getsize(args.input)
+    budget_per_worker = max(1, max_memory // args.workers)
+    n_buckets = -(-input_size * COUNTER_BYTES_PER_INPUT_BYTE // budget_per_worker)
+    n_buckets = max(1, n_buckets)
+    cap = max_buckets()
+    if n_buckets > cap:
+        print(
+            f"[warn] {n_buckets:,} buckets needed for this budget, capped at {cap:,} "
+            f"(open files limit); peak memory may exceed --max-memory",
+            file=sys.stderr,
+        )
+        n_buckets = cap
+
+    ranges = split_byte_ranges(args.input, args.workers * RANGES_PER_WORKER)
+    tmp_dir = make_tmp_dir(args, "buckets")
+
+    print(
+        f"[info] external mode: max_memory={max_memory / 1024 ** 2:,.0f} MB, "
+        f"{n_buckets:,} buckets, {len(ranges)} ranges, tmp_dir={tmp_dir}",
+        file=sys.stderr,
+    )
+
+    total_lines = 0
+    hist: Counter = Counter()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        # Фаза 1: раскладка по корзинам
+        futures = [
+            ex.submit(
+                partition_range,
+                args.input, start, end, range_id,
+                n_buckets, tmp_dir, args.chunk_size,
+            )
+            for range_id, (start, end) in enumerate(ranges)
+        ]
+        next_progress = args.progress_interval
+        for fut in as_completed(futures):
+            total_lines += fut.result()
+            if total_lines >= next_progress:
+                print(f"[progress] partitioned {total_lines:,} lines", file=sys.stderr)
+                next_progress += args.progress_interval
+
+        print(f"[info] total lines processed: {total_lines:,}", file=sys.stderr)
+        stats.info["lines_in"] = total_lines
+
+        # Фаза 2: точный подсчёт по корзинам
+        futures = [
+            ex.submit(count_bucket, tmp_dir, b, len(ranges))
+            for b in range(n_buckets)
+        ]
+        for k, fut in enumerate(as_completed(futures), start=1):
+            hist.update(fut.result())
+            if k % max(1, n_buckets // 10) == 0:
+                print(f"[progress] counted {k:,} / {n_buckets:,} buckets", file=sys.stderr)
+
+    vocab_size = sum(hist.values())
+    print(f"[info] vocabulary size before trimming: {vocab_size:,}", file=sys.stderr)
+
+    # Фаза 3: хвост считается по гистограмме, корзины сливаются по порядку
+    keep_n = vocab_size - tail_size(vocab_size, args.tail_percent)
+
+    sorted_paths = [
+        os.path.join(tmp_dir, f"b{b:05d}.sorted.tsv") for b in range(n_buckets)
+    ]
+    merged = heapq.merge(*(iter_sorted_bucket(p) for p in sorted_paths))
+
+    written = 0
+    stats.info["types_before_trim"] = vocab_size
+    with open_phrase_writer(args.output, COUNT_COLUMNS, stats) as fout:
+        for neg_count, phrase in islice(merged, keep_n):
+            fout.write(phrase, -neg_count)
+            written += 1
+
+    shutil.rmtree(tmp_dir)
+    print(f"[done] written {written:,} phrases to {args.output}", file=sys.stderr)
+
+
+def phrase_hashes(phrases: List[str]) -> np.ndarray:
+    """
+    64-битные хеши фраз (blake2b), одинаковые во всех процессах.
+    """
+    return np.fromiter(
+        (
+            int.from_bytes(hashlib.blake2b(p.encode("utf-8"), digest_size=8).digest(), "little")
+            for p in phrases
+        ),
+        dtype=np.uint64,
+        count=len(phrases),
+    )
+
+
+def sketch_columns(phrases: List[str], depth: int, width: int) -> np.ndarray:
+    """
+    Индексы ячеек Count-Min для каждой фразы в каждой строке скетча,
+    shape (depth, n). Строки получаются из двух половин одного хеша:
+    h_i = h1 + i * h2 (Kirsch–Mitzenmacher).
+    """
+    h = phrase_hashes(phrases)
+    h1 = h & np.uint64(0xFFFFFFFF)
+    h2 = (h >> np.uint64(32)) | np.uint64(1)
+    rows = np.arange(depth, dtype=np.uint64)[:, None]
+    return ((h1[None, :] + rows * h2[None, :]) % np.uint64(width)).astype(np.int64)
+
+
+def sketch_add(sketch: np.ndarray, c: Counter, cap: int) -> None:
+    """
+    Добавляет частоты из c в скетч с насыщением на cap: нам важно только,
+    дотягивает ли фраза до порога, поэтому ячейки хватает uint8.
+    """
+    if not c:
+        return
+    phrases = list(c.keys())
+    counts = np.minimum(np.fromiter(c.values(), dtype=np.int64, count=len(c)), cap)
+    cols = sketch_columns(phrases, *sketch.shape)
+    for i in range(sketch.shape[0]):
+        uniq, inv = np.unique(cols[i], return_inverse=True)
+        add = np.bincount(inv, weights=counts).astype(np.int64)
+        sketch[i, uniq] = np.minimum(sketch[i, uniq].astype(np.int64) + add, cap)
+
+
+def sketch_estimate(sketch: np.ndarray, phrases: List[str]) -> np.ndarray:
+    """
+    Оценка Count-Min (минимум по строкам): никогда не меньше
+    min(истинная частота, cap).
+    """
+    cols = sketch_columns(phrases, *sketch.shape)
+    rows = np.arange(sketch.shape[0])[:, None]
+    return sketch[rows, cols].min(axis=0)
+
+
+def sketch_dtype(cap: int):
+    return np.uint8 if cap <= np.iinfo(np.uint8).max else np.uint32
+
+
+def sketch_range(
+    path: str,
+    start: int,
+    end: int,
+    depth: int,
+    width: int,
+    cap: int,
+    chunk_size: int,
+) -> Tuple[np.ndarray, int, int]:
+    """
+    Проход 1 приближённого режима: Count-Min скетч по диапазону [start, end).
+    Возвращает (скетч, число строк, число фраз).
+    """
+    sketch = np.zeros((depth, width), dtype=sketch_dtype(cap))
+    n_lines = 0
+    n_phrases = 0
+    c = Counter()
+    for line in iter_range_lines(path, start, end):
+        n_lines += 1
+        phrase = line.strip()
+        if phrase:
+            c[phrase] += 1
+            n_phrases += 1
+            if len(c) >= chunk_size:
+                sketch_add(sketch, c, cap)
+                c.clear()
+    sketch_add(sketch, c, cap)
+    return sketch, n_lines, n_phrases
+
+
+def candidates_range(
+    path: str,
+    start: int,
+    end: int,
+    sketch_path: str,
+    min_count: int,
+    chunk_size: int,
+) -> Counter:
+    """
+    Проход 2: точные частоты только для фраз, чья оценка по скетчу
+    не меньше min_count. Остальные (в основном единичные) фразы
+    в счётчик не попадают вовсе.
+    """
+    sketch = np.load(sketch_path, mmap_mode="r")
+    exact = Counter()
+    c = Counter()
+
+    def flush() -> None:
+        phrases = list(c.keys())
+        est = sketch_estimate(sketch, phrases)
+        for phrase, e in zip(phrases, est):
+            if e >= min_count:
+                exact[phrase] += c[phrase]
+        c.clear()
+
+    for line in iter_range_lines(path, start, end):
+        phrase = line.strip()
+        if phrase:
+            c[phrase] += 1
+            if len(c) >= chunk_size:
+                flush()
+    if c:
+        flush()
+    return exact
+
+
+def run_approx(args, stats: StageStats) -> None:
+    """
+    Приближённый режим для тяжёлых фраз (--approx-min-count N):
+      1) воркеры строят Count-Min скетчи своих диапазонов, родитель их суммирует;
+      2) второй проход считает точно только кандидатов с оценкой >= N.
+    Скетч никогда не занижает частоту, поэтому все фразы с частотой >= N
+    попадают в вывод с точными частотами; отсекаются только фразы < N.
+    """
+    min_count = args.approx_min_count
+    depth, width = args.sketch_depth, args.sketch_width
+    ranges = split_byte_ranges(args.input, args.workers)
+    tmp_dir = make_tmp_dir(args, "sketch")
+    sketch_path = os.path.join(tmp_dir, "count_min.npy")
+
+    sketch_mb = depth * width * np.dtype(sketch_dtype(min_count)).itemsize / 1024 ** 2
+    print(
+        f"[info] approx mode: min_count={min_count}, count-min {depth} x {width:,} "
+        f"({sketch_mb:,.0f} MB per worker)",
+        file=sys.stderr,
+    )
+
+    total_lines = 0
+    total_phrases = 0
+    sketch = None
+
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        futures = [
+            ex.submit(
+                sketch_range,
+                args.input, start, end,
+                depth, width, min_count, args.chunk_size,
+            )
+            for start, end in ranges
+        ]
+        for fut in as_completed(futures):
+            part, n_lines, n_phrases = fut.result()
+            total_lines += n_lines
+            total_phrases += n_phrases
+            if sketch is None:
+                sketch = part
+            else:
+                # сумма скетчей с тем же насыщением на min_count
+                merged = np.minimum(sketch.astype(np.int64) + part, min_count)
+                sketch = merged.astype(part.dtype)
+            print(f"[progress] sketched {total_lines:,} lines", file=sys.stderr)
+
+        if sketch is None:
+            sketch = np.zeros((depth, width), dtype=sketch_dtype(min_count))
+        np.save(sketch_path, sketch)
+        del sketch
+
+        # Гарантия Count-Min: оценка <= истина + eps * N с вероятностью >= 1 - delta
+        eps = math.e / width
+        delta = math.exp(-depth)
+        print(f"[info] total lines processed: {total_lines:,}", file=sys.stderr)
+        stats.info["lines_in"] = total_lines
+        print(
+            f"[info] count-min error bound: estimate <= true + {eps * total_phrases:,.1f} "
+            f"(eps={eps:.2e} * N={total_phrases:,}) with probability >= {1 - delta:.4f}",
+            file=sys.stderr,
+        )
+
+        futures = [
+            ex.submit(
+                candidates_range,
+                args.input, start, end,
+                sketch_path, min_count, args.chunk_size,
+            )
+            for start, end in ranges
+        ]
+        candidates = merge_partials([fut.result() for fut in futures])
+
+    shutil.rmtree(tmp_dir)
+
+    kept = Counter({p: n for p, n in candidates.items() if n >= min_count})
+    false_pos = len(candidates) - len(kept)
+    print(
+        f"[info] candidates: {len(candidates):,}, "
+        f"false positives (exact < {min_count}): {false_pos:,} "
+        f"({false_pos / max(1, len(candidates)) * 100:.2f} %)",
+        file=sys.stderr,
+    )
+    if args.tail_percent > 0.0:
+        print("[info] --tail-percent is not applied in approx mode (min-count cut instead)",
+              file=sys.stderr)
+    write_trimmed_counts(kept, args.output, 0.0, stats)
 
 
 def main():
@@ -51,7 +790,10 @@ def main():
         "-o", "--output",
         type=str,
         required=True,
-        help="Файл для записи частотного словаря (phrase<TAB>count).",
+        help=(
+            "Файл для записи частотного словаря (phrase<TAB>count). "
+            "Путь *.cols — колоночный формат phrase_columns (mmap, без разбора TSV)."
+        ),
     )
     parser.add_argument(
         "--chunk-size",
@@ -77,63 +819,113 @@ def main():
         default=5.0,
         help="Процент самых редких фраз, которые нужно удалить (по количеству типов). По умолчанию 5.0.",
     )
+    parser.add_argument(
+        "--byte-ranges",
+        action="store_true",
+        help=(
+            "Делить вход по байтовым диапазонам: каждый воркер сам читает свой "
+            "кусок файла и возвращает счётчик, родитель не пересылает строки."
+        ),
+    )
 
-    args = parser.parse_args()
-
-    global_counter: Counter = Counter()
-    total_lines = 0
-
-    print(f"[info] counting frequencies from {args.input}", file=sys.stderr)
-    print(f"[info] using {args.workers} workers, chunk_size={args.chunk_size}", file=sys.stderr)
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=0,
+        help=(
+            "Сколько задач (чанков или диапазонов) может ждать в очереди к воркерам. "
+            "По умолчанию 0 = 2 * workers."
+        ),
+    )
+    parser.add_argument(
+        "--compact-keys",
+        action="store_true",
+        help=(
+            "Хранить фразы не строками, а id слов в массивной хеш-таблице "
+            "(phrase_keys.PhraseTable): в разы меньше памяти на фразу."
+        ),
+    )
+    parser.add_argument(
+        "--max-words",
+        type=int,
+        default=6,
+        help="Для --compact-keys: макс. число слов во фразе (ширина ключа). По умолчанию 6.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=str,
+        default=None,
+        help=(
+            "Включить внешний подсчёт с диском вместо RAM и задать бюджет памяти "
+            "на все воркеры, например 16G или 512M (без суффикса — МБ). "
+            "Вывод тот же, при равных частотах фразы упорядочены по алфавиту."
+        ),
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        type=str,
+        default=None,
+        help=(
+            "Каталог для временных файлов (корзины внешнего подсчёта, скетч). "
+            "Каждый прогон пишет в свой подкаталог <output>.buckets-XXXX / "
+            "<output>.sketch-XXXX (по умолчанию рядом с выходом) и удаляет только его."
+        ),
+    )
 
-    with open(args.input, "r", encoding="utf-8", errors="ignore") as fin, \
-         ProcessPoolExecutor(max_workers=args.workers) as ex:
+    parser.add_argument(
+        "--approx-min-count",
+        type=int,
+        default=0,
+        help=(
+            "Приближённый режим: Count-Min скетч + точный подсчёт только фраз, "
+            "которые могут набрать не меньше N вхождений. В вывод попадают "
+            "ровно фразы с частотой >= N (с точными частотами). 0 = выключено."
+        ),
+    )
+    parser.add_argument(
+        "--sketch-width",
+        type=int,
+        default=1 << 24,
+        help="Ширина Count-Min скетча (ячеек в строке). По умолчанию 2^24.",
+    )
+    parser.add_argument(
+        "--sketch-depth",
+        type=int,
+        default=4,
+        help="Число строк (хеш-функций) Count-Min скетча. По умолчанию 4.",
+    )
 
-        future_to_len = {}
-        for chunk in chunk_reader(fin, args.chunk_size):
-            fut = ex.submit(count_chunk, chunk)
-            future_to_len[fut] = len(chunk)
+    args = parser.parse_args()
+    stats = StageStats("step2_count_phrases", input=args.input)
 
-        next_progress = args.progress_interval
+    if args.approx_min_count > 0:
+        print(f"[info] counting frequencies from {args.input}", file=sys.stderr)
+        run_approx(args, stats)
+        return
 
-        for fut in as_completed(future_to_len):
-            c = fut.result()
-            global_counter.update(c)
-            total_lines += future_to_len[fut]
+    if args.max_memory:
+        print(f"[info] counting frequencies from {args.input}", file=sys.stderr)
+        run_external(args, stats)
+        return
 
-            if total_lines >= next_progress:
-                print(f"[progress] processed {total_lines:,} lines", file=sys.stderr)
-                next_progress += args.progress_interval
+    print(f"[info] counting frequencies from {args.input}", file=sys.stderr)
+    print(f"[info] using {args.workers} workers, chunk_size={args.chunk_size}", file=sys.stderr)
 
-    vocab_size = len(global_counter)
+    partials, total_lines = count_with_accumulators(args)
     print(f"[info] total lines processed: {total_lines:,}", file=sys.stderr)
-    print(f"[info] vocabulary size before trimming: {vocab_size:,}", file=sys.stderr)
+    stats.info["lines_in"] = total_lines
+    print(f"[info] merging {len(partials)} partial tables", file=sys.stderr)
 
-    # Удаляем хвост tail-percent самых редких фраз
-    tail_percent = max(0.0, min(100.0, args.tail_percent))
-    items = list(global_counter.items())
-
-    if tail_percent > 0.0 and vocab_size > 0:
-        items.sort(key=lambda x: x[1])  # по возрастанию частоты
-        tail_n = int(vocab_size * (tail_percent / 100.0))
-        if tail_n > 0:
-            items = items[tail_n:]
+    if args.compact_keys:
+        vocab, table = merge_compact_partials(partials, args.max_words)
         print(
-            f"[info] removed tail {tail_percent:.2f}% "
-            f"({tail_n:,} phrase types), kept {len(items):,}",
+            f"[info] compact keys: {len(vocab):,} words, "
+            f"table {table.nbytes / 1024 ** 2:,.1f} MB",
             file=sys.stderr,
         )
+        write_trimmed_table(vocab, table, args.output, args.tail_percent, stats)
     else:
-        print("[info] tail trimming disabled", file=sys.stderr)
-
-    # Сортируем по убыванию частоты
-    items.sort(key=lambda x: x[1], reverse=True)
-
-    with open(args.output, "w", encoding="utf-8") as fout:
-        for phrase, count in items:
-            fout.write(f"{phrase}\t{count}\n")
-
-    print(f"[done] written {len(items):,} phrases to {args.output}", file=sys.stderr)
+        write_trimmed_counts(merge_partials(partials), args.output, args.tail_percent, stats)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,72 @@
 import argparse
 import sys
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+import numpy as np
+
+from byte_ranges import RANGES_PER_WORKER, iter_range_lines, split_byte_ranges
+from phrase_columns import PhraseColumns, is_columnar
+from phrase_tokens import load_tokens, parse_count_line
+from stage_stats import StageStats
+
+
+def count_words_range(path: str, start: int, end: int) -> Tuple[Counter, int]:
+    """
+    Воркер: взвешенный счётчик слов по фразам из диапазона [start, end) —
+    байтовому для TSV, по номерам строк для *.cols.
+    Порядок ключей Counter — порядок первого появления слова в диапазоне.
+    """
+    c: Counter = Counter()
+    rows = 0
+    if is_columnar(path):
+        cols = PhraseColumns(path)
+        counts = np.asarray(cols["count"][start:end]).tolist()
+        pairs = zip(cols.iter_phrases(np.arange(start, end)), counts)
+    else:
+        pairs = filter(None, map(parse_count_line, iter_range_lines(path, start, end)))
+    for phrase, count in pairs:
+        rows += 1
+        for w in phrase.split():
+            c[w] += count
+    return c, rows
+
+
+def split_input(path: str, n_parts: int) -> List[Tuple[int, int]]:
+    if is_columnar(path):
+        n = len(PhraseColumns(path))
+        bounds = [n * i // n_parts for i in range(n_parts + 1)]
+        return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+    return split_byte_ranges(path, n_parts)
+
+
+def count_words_parallel(args) -> Tuple[List[str], np.ndarray, int]:
+    """
+    Параллельный подсчёт: диапазоны считаются в пуле, частичные счётчики
+    сливаются в порядке диапазонов, поэтому порядок первого появления слов
+    (а значит и порядок равных частот в выводе) совпадает с однопоточным.
+    """
+    ranges = split_input(args.input, args.workers * RANGES_PER_WORKER)
+    print(f"[info] counting {len(ranges)} ranges with {args.workers} workers", file=sys.stderr)
+
+    word_freq: Counter = Counter()
+    total_rows = 0
+    next_progress = args.progress_interval
+
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        futures = [ex.submit(count_words_range, args.input, a, b) for a, b in ranges]
+        for fut in futures:
+            c, rows = fut.result()
+            word_freq.update(c)
+            total_rows += rows
+            if total_rows >= next_progress:
+                print(f"[progress] processed {total_rows:,} lines", file=sys.stderr)
+                next_progress += args.progress_interval
+
+    words = list(word_freq)
+    freq = np.fromiter(word_freq.values(), dtype=np.int64, count=len(words))
+    return words, freq, total_rows
 
 
 def main():
@@ -11,13 +77,30 @@ def main():
     parser.add_argument(
         "-i", "--input",
         required=True,
-        help="Вход: файл с фразами и частотами (phrase<TAB>count).",
+        help="Вход: файл с фразами и частотами (phrase<TAB>count) или каталог *.cols.",
     )
     parser.add_argument(
         "-o", "--output",
         required=True,
         help="Выход: файл слов и частот (word<TAB>count), отсортированный по убыванию.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Число процессов. При > 1 вход делится на диапазоны и считается "
+            "параллельно (без кэша id слов). По умолчанию 1."
+        ),
+    )
+    parser.add_argument(
+        "--no-token-cache",
+        action="store_true",
+        help=(
+            "Не читать и не писать кэш id слов <input>.tokens "
+            "(по умолчанию он создаётся и переиспользуется шагом 4)."
+        ),
+    )
     parser.add_argument(
         "--progress-interval",
         type=int,
@@ -25,44 +108,31 @@ def main():
         help="Интервал прогресса по строкам. По умолчанию 1_000_000.",
     )
     args = parser.parse_args()
+    stats = StageStats("step3_word_freq", input=args.input)
 
-    word_freq = Counter()
-    total_lines = 0
-    next_progress = args.progress_interval
-
-    with open(args.input, "r", encoding="utf-8", errors="ignore") as fin:
-        for line in fin:
-            total_lines += 1
-            if total_lines >= next_progress:
-                print(f"[progress] processed {total_lines:,} lines", file=sys.stderr)
-                next_progress += args.progress_interval
-
-            line = line.rstrip("\n")
-            if not line:
-                continue
+    if args.workers > 1:
+        words, word_freq, total = count_words_parallel(args)
+    else:
+        tokens = load_tokens(args.input, not args.no_token_cache, args.progress_interval)
+        # частоты слов — взвешенный bincount по id, id 0 (пустое слово) не выводится
+        words, word_freq, total = tokens.words[1:], tokens.word_freq()[1:], len(tokens)
 
-            try:
-                phrase, count_str = line.rsplit("\t", 1)
-                count = int(count_str)
-            except ValueError:
-                continue
-
-            words = phrase.split()
-            for w in words:
-                if w:
-                    word_freq[w] += count
-
-    print(f"[info] total lines processed: {total_lines:,}", file=sys.stderr)
+    print(f"[info] total phrases: {total:,}", file=sys.stderr)
     print(f"[info] vocab size: {len(word_freq):,}", file=sys.stderr)
 
-    # сортировка по убыванию частоты
-    items = sorted(word_freq.items(), key=lambda x: x[1], reverse=True)
+    # сортировка по убыванию частоты; при равной — в порядке первого появления
+    order = np.argsort(-word_freq, kind="stable")
 
     with open(args.output, "w", encoding="utf-8") as fout:
-        for w, c in items:
-            fout.write(f"{w}\t{c}\n")
+        for wid, c in zip(order.tolist(), word_freq[order].tolist()):
+            fout.write(f"{words[wid]}\t{c}\n")
+
+    # сводка по словам: строки, квантили частот слов
+    stats.info["lines_in"] = total
+    stats.add_arrays(np.ones(len(order), dtype=np.int64), word_freq)
+    stats.write(args.output)
 
-    print(f"[done] written {len(items):,} words to {args.output}", file=sys.stderr)
+    print(f"[done] written {len(order):,} words to {args.output}", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,26 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import sys
+from contextlib import ExitStack
+from typing import Dict, List
 
+import numpy as np
 
-def load_top_vocab(path: str, top_n: int) -> set[str]:
-    vocab: set[str] = set()
+from phrase_columns import PhraseColumns, is_columnar, open_phrase_writer, write_subset
+from phrase_tokens import UNRANKED, load_tokens, parse_count_line
+from stage_stats import StageStats
+
+
+def load_word_ranks(path: str, max_n: int) -> dict[str, int]:
+    """
+    word -> ранг (номер строки в word_freq, с 1) для первых max_n строк.
+    Фраза входит в top-N ровно тогда, когда максимальный ранг её слов <= N.
+    """
+    ranks: dict[str, int] = {}
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
         for i, line in enumerate(f):
-            if i >= top_n:
+            if i >= max_n:
                 break
             line = line.rstrip("\n")
             if not line:
@@ -16,26 +29,114 @@ def load_top_vocab(path: str, top_n: int) -> set[str]:
                 word, _count = line.split("\t", 1)
             except ValueError:
                 continue
-            vocab.add(word)
-    return vocab
+            ranks.setdefault(word, i + 1)
+    return ranks
+
+
+def parse_top_ns(spec: str) -> List[int]:
+    try:
+        top_ns = sorted({int(x) for x in spec.split(",") if x.strip()})
+    except ValueError:
+        top_ns = []
+    if not top_ns or top_ns[0] <= 0:
+        raise argparse.ArgumentTypeError(
+            f"expected positive integers separated by commas, got {spec!r}"
+        )
+    return top_ns
+
+
+def output_paths(output: str, top_ns: List[int]) -> Dict[int, str]:
+    """
+    Путь выхода для каждого порога: {n} в -o подставляется явно, иначе
+    при нескольких порогах перед расширением вставляется .top<N>
+    (phrases.txt -> phrases.top5000.txt, phrases.cols -> phrases.top5000.cols).
+    """
+    if "{n}" in output:
+        return {n: output.replace("{n}", str(n)) for n in top_ns}
+    if len(top_ns) == 1:
+        return {top_ns[0]: output}
+    stem, ext = os.path.splitext(output.rstrip("/"))
+    return {n: f"{stem}.top{n}{ext}" for n in top_ns}
+
+
+def write_tsv_outputs(
+    args,
+    outputs: Dict[int, str],
+    max_rank: np.ndarray,
+    stats: Dict[int, StageStats],
+) -> None:
+    """
+    Один проход по TSV-входу: строка с корректным phrase<TAB>count номер row
+    пишется во все выходы с N >= max_rank[row].
+    """
+    top_ns = sorted(outputs)
+    row = 0
+    next_progress = args.progress_interval
+
+    with ExitStack() as stack, \
+         open(args.input, "r", encoding="utf-8", errors="ignore") as fin:
+        fouts = {
+            n: stack.enter_context(open_phrase_writer(path, {"count": "int64"}, stats[n]))
+            for n, path in outputs.items()
+        }
+
+        for line in fin:
+            parsed = parse_count_line(line)
+            if parsed is None:
+                continue
+            rank = max_rank[row]
+            row += 1
+            if row >= next_progress:
+                print(f"[progress] written {row:,} lines", file=sys.stderr)
+                next_progress += args.progress_interval
+
+            for n in reversed(top_ns):
+                if rank > n:
+                    break
+                fouts[n].write(*parsed)
+
+
+def print_summary(
+    outputs: Dict[int, str],
+    kept: Dict[int, int],
+    freq_sum: Dict[int, int],
+    total: int,
+    summary_path: str = "",
+) -> None:
+    print("\n=== SUMMARY ===")
+    print(f"{'top_n':>8} {'phrases':>12} {'share':>8} {'freq_sum':>14}  output")
+    for n in sorted(outputs):
+        share = kept[n] / total * 100 if total else 0
+        print(f"{n:>8} {kept[n]:>12,} {share:>7.2f}% {freq_sum[n]:>14,}  {outputs[n]}")
+
+    if summary_path:
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write("top_n\tphrases\tshare\tfreq_sum\toutput\n")
+            for n in sorted(outputs):
+                share = kept[n] / total if total else 0
+                f.write(f"{n}\t{kept[n]}\t{share:.6f}\t{freq_sum[n]}\t{outputs[n]}\n")
 
 
 def main():
     parser = argparse.ArgumentParser(
         description=(
             "Отфильтровать фразы по словарю: оставить только те, "
-            "в которых все слова входят в top-N слов."
+            "в которых все слова входят в top-N слов. Несколько N — "
+            "за один проход, по файлу на каждый порог."
         )
     )
     parser.add_argument(
         "-i", "--input",
         required=True,
-        help="Вход: phrase<TAB>count.",
+        help="Вход: phrase<TAB>count или каталог *.cols.",
     )
     parser.add_argument(
         "-o", "--output",
         required=True,
-        help="Выход: отфильтрованный phrase<TAB>count.",
+        help=(
+            "Выход: отфильтрованный phrase<TAB>count (*.cols — колоночный формат). "
+            "При нескольких --top-n: шаблон с {n} или к имени добавляется .top<N>."
+        ),
     )
     parser.add_argument(
         "--word-freq",
@@ -44,9 +145,12 @@ def main():
     )
     parser.add_argument(
         "--top-n",
-        type=int,
-        default=5000,
-        help="Сколько самых частотных слов включить в словарь. По умолчанию 5000.",
+        type=parse_top_ns,
+        default="5000",
+        help=(
+            "Сколько самых частотных слов включить в словарь. По умолчанию 5000. "
+            "Можно несколько порогов через запятую: 2000,3000,5000,8000."
+        ),
     )
     parser.add_argument(
         "--min-count",
@@ -60,47 +164,63 @@ def main():
         default=1_000_000,
         help="Интервал прогресса по строкам.",
     )
+    parser.add_argument(
+        "--no-token-cache",
+        action="store_true",
+        help="Не читать и не писать кэш id слов <input>.tokens.",
+    )
+    parser.add_argument(
+        "--summary",
+        default="",
+        help="Куда дополнительно записать сводку по порогам (TSV).",
+    )
 
     args = parser.parse_args()
 
-    vocab = load_top_vocab(args.word_freq, args.top_n)
-    print(f"[info] loaded vocab of {len(vocab):,} words (top-{args.top_n})", file=sys.stderr)
-
-    total = 0
-    kept = 0
-    next_progress = args.progress_interval
-
-    with open(args.input, "r", encoding="utf-8", errors="ignore") as fin, \
-         open(args.output, "w", encoding="utf-8") as fout:
-
-        for line in fin:
-            total += 1
-            if total >= next_progress:
-                print(f"[progress] processed {total:,} lines, kept {kept:,}", file=sys.stderr)
-                next_progress += args.progress_interval
-
-            line = line.rstrip("\n")
-            if not line:
-                continue
-
-            try:
-                phrase, count_str = line.rsplit("\t", 1)
-                count = int(count_str)
-            except ValueError:
-                continue
-
-            if count < args.min_count:
-                continue
+    top_ns = args.top_n
+    outputs = output_paths(args.output, top_ns)
+    stats = {
+        n: StageStats(
+            "step4_filter_phrases_by_vocab",
+            input=args.input, top_n=n, min_count=args.min_count,
+        )
+        for n in top_ns
+    }
+
+    ranks = load_word_ranks(args.word_freq, top_ns[-1])
+    print(
+        f"[info] loaded ranks of {len(ranks):,} words (top-{top_ns[-1]}), "
+        f"thresholds: {', '.join(map(str, top_ns))}",
+        file=sys.stderr,
+    )
 
-            words = phrase.split()
-            # если ВСЕ слова из допустимого словаря — оставляем фразу
-            if all(w in vocab for w in words):
-                fout.write(line + "\n")
-                kept += 1
+    # фразы -> id слов (CSR, кэш <input>.tokens общий с шагом 3);
+    # ранг фразы — максимальный ранг её слов, фраза входит в top-N при ранге <= N
+    tokens = load_tokens(args.input, not args.no_token_cache, args.progress_interval)
+    counts = np.asarray(tokens.counts)
+    max_rank = tokens.max_rank(tokens.rank_of_id(ranks))
+    max_rank[counts < args.min_count] = UNRANKED
+    total = len(tokens)
+    for st in stats.values():
+        st.info["lines_in"] = total
+
+    kept = {n: int(np.count_nonzero(max_rank <= n)) for n in top_ns}
+    freq_sum = {n: int(counts[max_rank <= n].sum()) for n in top_ns}
+
+    if is_columnar(args.input):
+        cols = PhraseColumns(args.input)
+        for n, path in outputs.items():
+            write_subset(cols, path, np.flatnonzero(max_rank <= n), stats=stats[n])
+    else:
+        write_tsv_outputs(args, outputs, max_rank, stats)
 
     print(f"[done] total lines: {total:,}", file=sys.stderr)
-    print(f"[done] kept: {kept:,}", file=sys.stderr)
-    print(f"[done] removed: {total - kept:,}", file=sys.stderr)
+    for n in top_ns:
+        print(
+            f"[done] top-{n}: kept {kept[n]:,}, removed {total - kept[n]:,} -> {outputs[n]}",
+            file=sys.stderr,
+        )
+    print_summary(outputs, kept, freq_sum, total, args.summary)
 
 
 if __name__ == "__main__":
@@ -2,15 +2,115 @@
 import argparse
 import sys
 
+from phrase_columns import PhraseColumns, is_columnar, weight_index
+from stage_stats import StageStats, read_stats
+
+
+def scan_file(path: str, progress_interval: int) -> StageStats:
+    """
+    Сводка пересчётом, если у файла нет свежего <file>.stats.json.
+    """
+    stats = StageStats("step5_count_phrase_lengths", input=path)
+
+    if is_columnar(path):
+        # длины считаются векторно по куче строк (или берутся из столбца length)
+        cols = PhraseColumns(path)
+        w = weight_index(cols.columns)
+        weights = None if w is None else list(cols.columns.values())[w]
+        stats.add_arrays(cols.lengths_in_words(), weights)
+        return stats
+
+    total = 0
+    next_progress = progress_interval
+    with open(path, "r", encoding="utf-8", errors="ignore") as fin:
+        for line in fin:
+            total += 1
+            if total >= next_progress:
+                print(f"[progress] {total:,} lines processed", file=sys.stderr)
+                next_progress += progress_interval
+
+            line = line.rstrip("\n")
+
+            # phrase, phrase<TAB>count или phrase<TAB>freq<TAB>cluster_size
+            parts = line.split("\t")
+            phrase = parts[0]
+            count = None
+            if len(parts) > 1:
+                try:
+                    count = int(parts[1])
+                except ValueError:
+                    pass
+
+            stats.add(" ".join(phrase.split()), count)
+    return stats
+
+
+def print_result(d: dict, min_len: int, max_len: int) -> None:
+    total = d["rows"]
+    length_hist = {int(k): v for k, v in d["length_hist"].items()}
+    weighted = {int(k): v for k, v in d.get("weighted_length_hist", {}).items()}
+    count_total = d.get("count_total", 0)
+
+    lengths = sorted(n for n in length_hist if n > 0)
+    if min_len > 0:
+        lengths = [n for n in lengths if n >= min_len]
+    if max_len > 0:
+        lengths = [n for n in lengths if n <= max_len]
+
+    print("\n=== RESULT ===")
+    print(f"Total phrases: {total:,}\n")
+    for n in lengths:
+        print(f"{n} words : {length_hist[n]:,}")
+    print("\nPercentages:")
+    for n in lengths:
+        pct = (length_hist[n] / total) * 100 if total else 0
+        print(f"{n} words : {pct:.2f} %")
+
+    if weighted:
+        print("\nWeighted by count:")
+        for n in lengths:
+            pct = (weighted.get(n, 0) / count_total) * 100 if count_total else 0
+            print(f"{n} words : {pct:.2f} %")
+    if d.get("count_quantiles"):
+        print("\nCount quantiles:")
+        for name, value in d["count_quantiles"].items():
+            print(f"{name:>6} : {value:,}")
+
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Подсчёт количества фраз длиной 2,3,4,5,6 слов в корпусе."
+        description=(
+            "Распределение фраз по длине (в словах). Берётся из сводки "
+            "<file>.stats.json, которую пишут шаги пайплайна; без неё файл пересчитывается."
+        )
     )
     parser.add_argument(
         "-i", "--input",
         required=True,
-        help="Файл фраз: phrase<TAB>count или просто phrase.",
+        nargs="+",
+        help="Файл(ы) фраз: phrase<TAB>count, просто phrase или каталог *.cols.",
+    )
+    parser.add_argument(
+        "--min-len",
+        type=int,
+        default=0,
+        help="Показывать длины от этой (0 = все встреченные).",
+    )
+    parser.add_argument(
+        "--max-len",
+        type=int,
+        default=0,
+        help="Показывать длины до этой (0 = все встреченные).",
+    )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Игнорировать сводки и пересчитать файлы.",
+    )
+    parser.add_argument(
+        "--write-sidecar",
+        action="store_true",
+        help="После пересчёта сохранить сводку рядом с файлом для следующих запусков.",
     )
     parser.add_argument(
         "--progress-interval",
@@ -20,37 +120,20 @@ def main():
     )
     args = parser.parse_args()
 
-    counts = {2: 0, 3: 0, 4: 0, 5: 0, 6: 0}
-    total = 0
-    next_progress = args.progress_interval
+    for path in args.input:
+        d = None if args.rescan else read_stats(path)
+        if d is not None:
+            print(f"[info] {path}: stats from sidecar ({d['stage']})", file=sys.stderr)
+        else:
+            print(f"[info] {path}: no fresh sidecar, scanning", file=sys.stderr)
+            stats = scan_file(path, args.progress_interval)
+            if args.write_sidecar:
+                stats.write(path)
+            d = stats.to_dict(path)
 
-    with open(args.input, "r", encoding="utf-8", errors="ignore") as fin:
-        for line in fin:
-            total += 1
-            if total >= next_progress:
-                print(f"[progress] {total:,} lines processed", file=sys.stderr)
-                next_progress += args.progress_interval
-
-            line = line.rstrip("\n")
-
-            if "\t" in line:
-                phrase, _freq = line.rsplit("\t", 1)
-            else:
-                phrase = line
-
-            words = phrase.split()
-            n = len(words)
-            if n in counts:
-                counts[n] += 1
-
-    print("\n=== RESULT ===")
-    print(f"Total phrases: {total:,}\n")
-    for n in range(2, 7):
-        print(f"{n} words : {counts[n]:,}")
-    print("\nPercentages:")
-    for n in range(2, 7):
-        pct = (counts[n] / total) * 100 if total else 0
-        print(f"{n} words : {pct:.2f} %")
+        if len(args.input) > 1:
+            print(f"\n##### {path}")
+        print_result(d, args.min_len, args.max_len)
 
 
 if __name__ == "__main__":